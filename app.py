@@ -1,16 +1,37 @@
 import datetime
-from flask import Flask, render_template, request, redirect, url_for
-import pandas as pd
+from flask import Flask, Request, Response, g, render_template, request, redirect, url_for
+from openpyxl import load_workbook
 import os
+import numpy as np
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import base64
-import mysql.connector
-from mysql.connector import Error
+import io
+from mysql.connector import Error, pooling
+from mysql.connector.errors import PoolError
 import time
 from minio import Minio
 from minio.error import S3Error
+from minio.commonconfig import CopySource
 import uuid
+import random
+import hashlib
+import hmac
+import itertools
+import re
+import zlib
+import threading
+import collections
+import heapq
+import json
+import shutil
+from zoneinfo import ZoneInfo
+from urllib.parse import urlencode
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -18,43 +39,74 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 logado = False
 load_dotenv()
 
-# Configuração do MinIO
+# Pool compartilhado para verificação de status das instâncias
+STATUS_CHECK_MAX_WORKERS = int(os.getenv('STATUS_CHECK_MAX_WORKERS', 8))
+STATUS_CHECK_DEADLINE = float(os.getenv('STATUS_CHECK_DEADLINE', 8))
+status_executor = ThreadPoolExecutor(max_workers=STATUS_CHECK_MAX_WORKERS, thread_name_prefix='status')
+
+# Snapshot compartilhado do /instance/fetchInstances, indexado por nome da instância
+INSTANCES_SNAPSHOT_TTL = float(os.getenv('INSTANCES_SNAPSHOT_TTL', 5))
+instances_snapshot = {'instances': {}, 'fetched_at': 0.0, 'refreshing': False, 'last_error_at': None}
+instances_snapshot_lock = threading.Lock()
+instances_refresh_lock = threading.Lock()
+
+# Monitor de saúde das instâncias: atualiza o snapshot em background com intervalo adaptativo
+INSTANCE_MONITOR_ENABLED = os.getenv('INSTANCE_MONITOR_ENABLED', 'True').lower() == 'true'
+INSTANCE_MONITOR_FAST_INTERVAL = float(os.getenv('INSTANCE_MONITOR_FAST_INTERVAL', 3))
+INSTANCE_MONITOR_INTERVAL = float(os.getenv('INSTANCE_MONITOR_INTERVAL', 15))
+INSTANCE_MONITOR_STABLE_INTERVAL = float(os.getenv('INSTANCE_MONITOR_STABLE_INTERVAL', 60))
+INSTANCE_MONITOR_STABLE_AFTER = float(os.getenv('INSTANCE_MONITOR_STABLE_AFTER', 300))
+INSTANCE_MONITOR_MAX_AGE = INSTANCE_MONITOR_STABLE_INTERVAL * 2
+INSTANCE_HISTORY_SIZE = int(os.getenv('INSTANCE_HISTORY_SIZE', 20))
+instance_history = {}     # nome -> deque de (timestamp, status_anterior, status_novo)
+instance_changed_at = {}  # nome -> timestamp da última transição
+instance_monitor_state = {'thread': None, 'running': False, 'interval': None, 'next_check_at': None}
+instance_monitor_wakeup = threading.Event()
+
+# Configuração do MinIO (cliente único por processo e bucket verificado em cache)
+minio_state = {'client': None, 'bucket_verified': False}
+minio_lock = threading.Lock()
+
 def get_minio_client():
-    """Retorna cliente do MinIO configurado"""
-    try:
-        endpoint = os.getenv('MINIO_ENDPOINT', 'localhost:9000')
-        access_key = os.getenv('MINIO_ACCESS_KEY', 'minioadmin')
-        secret_key = os.getenv('MINIO_SECRET_KEY', 'minioadmin')
-        secure = os.getenv('MINIO_SECURE', 'False').lower() == 'true'
-        
-        # Remover protocolo se presente no endpoint
-        if endpoint.startswith('https://'):
-            endpoint = endpoint.replace('https://', '')
-            secure = True  # Se URL tem https, forçar secure=True
-        elif endpoint.startswith('http://'):
-            endpoint = endpoint.replace('http://', '')
-            secure = False  # Se URL tem http, forçar secure=False
-        
-        print(f"Conectando MinIO: endpoint={endpoint}, secure={secure}")
-        
-        client = Minio(
-            endpoint,
-            access_key=access_key,
-            secret_key=secret_key,
-            secure=secure
-        )
+    """Retorna cliente do MinIO configurado (criado uma única vez por processo)"""
+    with minio_lock:
+        if minio_state['client'] is not None:
+            return minio_state['client']
         
-        # Testar conexão
-        client.list_buckets()
-        print("Conexão com MinIO estabelecida com sucesso")
-        
-        return client
-    except Exception as e:
-        print(f"Erro ao configurar MinIO: {e}")
-        return None
+        try:
+            endpoint = os.getenv('MINIO_ENDPOINT', 'localhost:9000')
+            access_key = os.getenv('MINIO_ACCESS_KEY', 'minioadmin')
+            secret_key = os.getenv('MINIO_SECRET_KEY', 'minioadmin')
+            secure = os.getenv('MINIO_SECURE', 'False').lower() == 'true'
+            
+            # Remover protocolo se presente no endpoint
+            if endpoint.startswith('https://'):
+                endpoint = endpoint.replace('https://', '')
+                secure = True  # Se URL tem https, forçar secure=True
+            elif endpoint.startswith('http://'):
+                endpoint = endpoint.replace('http://', '')
+                secure = False  # Se URL tem http, forçar secure=False
+            
+            print(f"Conectando MinIO: endpoint={endpoint}, secure={secure}")
+            
+            minio_state['client'] = Minio(
+                endpoint,
+                access_key=access_key,
+                secret_key=secret_key,
+                secure=secure
+            )
+            print("Cliente MinIO criado")
+            
+            return minio_state['client']
+        except Exception as e:
+            print(f"Erro ao configurar MinIO: {e}")
+            return None
 
 def ensure_bucket_exists():
-    """Garante que o bucket existe"""
+    """Garante que o bucket existe (verificado uma vez e mantido em cache)"""
+    if minio_state['bucket_verified']:
+        return True
+    
     try:
         client = get_minio_client()
         if not client:
@@ -71,6 +123,7 @@ def ensure_bucket_exists():
         else:
             print(f"Bucket '{bucket_name}' já existe")
         
+        minio_state['bucket_verified'] = True
         return True
     except Exception as e:
         print(f"Erro ao verificar/criar bucket: {e}")
@@ -109,10 +162,44 @@ def test_minio_connection():
         traceback.print_exc()
         return False
 
-def upload_video_to_minio(video_path, original_filename):
-    """Faz upload do vídeo para o MinIO e retorna a URL"""
+# Mídias endereçadas por conteúdo (sha256) e cache de URLs presigned
+MINIO_URL_EXPIRES = datetime.timedelta(days=int(os.getenv('MINIO_URL_EXPIRES_DAYS', 7)))
+MINIO_URL_MIN_VALIDITY = datetime.timedelta(hours=int(os.getenv('MINIO_URL_MIN_VALIDITY_HOURS', 48)))
+presigned_url_cache = {}
+presigned_url_lock = threading.Lock()
+
+def content_object_name(prefix, digest, original_filename):
+    """Nome do objeto derivado do hash do conteúdo (mesmo arquivo = mesmo objeto)"""
+    return f"{prefix}/{digest}{os.path.splitext(original_filename)[1].lower()}"
+
+def minio_object_exists(client, bucket_name, object_name):
+    """Verifica se o objeto já existe no bucket"""
+    try:
+        client.stat_object(bucket_name, object_name)
+        return True
+    except S3Error as e:
+        if e.code in ('NoSuchKey', 'NoSuchObject', 'ResourceNotFound'):
+            return False
+        raise
+
+def get_presigned_url(client, bucket_name, object_name):
+    """Retorna a URL presigned em cache, reassinando apenas quando estiver perto de expirar"""
+    now = datetime.datetime.now()
+    with presigned_url_lock:
+        cached = presigned_url_cache.get((bucket_name, object_name))
+    if cached and cached[1] - now >= MINIO_URL_MIN_VALIDITY:
+        print(f"Reutilizando URL presigned de {object_name} (válida até {cached[1]:%d/%m/%Y %H:%M})")
+        return cached[0]
+    
+    url = client.presigned_get_object(bucket_name, object_name, expires=MINIO_URL_EXPIRES)
+    with presigned_url_lock:
+        presigned_url_cache[(bucket_name, object_name)] = (url, now + MINIO_URL_EXPIRES)
+    return url
+
+def store_media_in_minio(source, original_filename, prefix='videos', content_type=None):
+    """Faz upload de uma mídia (caminho do arquivo ou bytes) para o MinIO sem reenviar conteúdo repetido e retorna o nome do objeto"""
     try:
-        print(f"Iniciando upload do vídeo: {original_filename}")
+        print(f"Iniciando upload da mídia: {original_filename}")
         
         client = get_minio_client()
         if not client:
@@ -126,24 +213,45 @@ def upload_video_to_minio(video_path, original_filename):
         if not ensure_bucket_exists():
             raise Exception("Erro ao garantir existência do bucket")
         
-        # Gerar nome único para o arquivo
-        file_extension = os.path.splitext(original_filename)[1]
-        unique_filename = f"videos/{uuid.uuid4()}{file_extension}"
-        print(f"Nome único gerado: {unique_filename}")
-        
-        # Upload do arquivo
-        print(f"Fazendo upload do arquivo: {video_path}")
-        client.fput_object(bucket_name, unique_filename, video_path)
-        print("Upload concluído com sucesso")
+        # Nome do objeto a partir do hash do conteúdo
+        if isinstance(source, bytes):
+            digest = hashlib.sha256(source).hexdigest()
+        else:
+            sha256 = hashlib.sha256()
+            with open(source, 'rb') as media:
+                for chunk in iter(lambda: media.read(1024 * 1024), b''):
+                    sha256.update(chunk)
+            digest = sha256.hexdigest()
+        object_name = content_object_name(prefix, digest, original_filename)
+        print(f"Nome por conteúdo gerado: {object_name}")
         
-        # Gerar URL pública (presigned URL com validade longa)
-        print("Gerando URL presigned...")
-        video_url = client.presigned_get_object(bucket_name, unique_filename, expires=datetime.timedelta(days=7))
+        def put():
+            if isinstance(source, bytes):
+                client.put_object(bucket_name, object_name, io.BytesIO(source), len(source),
+                                  content_type=content_type or 'application/octet-stream')
+            else:
+                client.fput_object(bucket_name, object_name, source, content_type=content_type or 'application/octet-stream')
         
-        print(f"Vídeo enviado para MinIO: {unique_filename}")
-        print(f"URL gerada: {video_url}")
+        if minio_object_exists(client, bucket_name, object_name):
+            print(f"Mídia já existe no MinIO, upload ignorado: {object_name}")
+        else:
+            # Upload do arquivo
+            print(f"Fazendo upload da mídia: {original_filename}")
+            try:
+                put()
+            except S3Error as e:
+                if e.code != 'NoSuchBucket':
+                    raise
+                # Bucket removido desde a última verificação: limpar cache e verificar novamente
+                print(f"Bucket '{bucket_name}' não encontrado no upload, verificando novamente...")
+                minio_state['bucket_verified'] = False
+                if not ensure_bucket_exists():
+                    raise Exception("Erro ao garantir existência do bucket")
+                put()
+            print("Upload concluído com sucesso")
         
-        return video_url
+        print(f"Mídia disponível no MinIO: {object_name}")
+        return object_name
         
     except S3Error as e:
         print(f"Erro S3 ao fazer upload: {e}")
@@ -156,6 +264,209 @@ def upload_video_to_minio(video_path, original_filename):
         traceback.print_exc()
         raise Exception(f"Erro MinIO: {str(e)}")
 
+def get_media_url(object_name):
+    """URL pública (presigned com validade longa, reaproveitada enquanto válida) de um objeto do bucket"""
+    media_url = get_presigned_url(get_minio_client(), os.getenv('MINIO_BUCKET_NAME', 'disparo'), object_name)
+    print(f"URL gerada: {media_url}")
+    return media_url
+
+def upload_media_to_minio(source, original_filename, prefix='videos', content_type=None):
+    """Faz upload de uma mídia para o MinIO e retorna a URL"""
+    return get_media_url(store_media_in_minio(source, original_filename, prefix, content_type))
+
+def upload_video_to_minio(video_path, original_filename):
+    """Faz upload do vídeo para o MinIO e retorna a URL"""
+    return upload_media_to_minio(video_path, original_filename, 'videos', 'video/mp4')
+
+# Envio de imagens: 'url' (MinIO), 'inline' (base64 no payload) ou 'auto' (inline até o limite)
+IMAGE_DELIVERY_MODE = os.getenv('IMAGE_DELIVERY_MODE', 'url').lower()
+IMAGE_INLINE_MAX_BYTES = int(os.getenv('IMAGE_INLINE_MAX_KB', 256)) * 1024
+
+def use_inline_image(image_size):
+    """Define se a imagem vai embutida em base64 no payload em vez de por URL"""
+    if IMAGE_DELIVERY_MODE == 'inline':
+        return True
+    if IMAGE_DELIVERY_MODE == 'auto':
+        return image_size <= IMAGE_INLINE_MAX_BYTES
+    return False
+
+# Upload de vídeo em streaming: o corpo da requisição vai direto para o MinIO
+VIDEO_MAX_BYTES = int(os.getenv('VIDEO_MAX_MB', 100)) * 1024 * 1024
+MINIO_PART_SIZE = max(5, int(os.getenv('MINIO_PART_SIZE_MB', 8))) * 1024 * 1024
+MINIO_PARALLEL_UPLOADS = int(os.getenv('MINIO_PARALLEL_UPLOADS', 4))
+MINIO_STREAM_QUEUE_CHUNKS = 64
+
+def find_stored_video(digest):
+    """Nome do vídeo já guardado no MinIO com este sha256 (calculado pelo navegador), ou None"""
+    if not re.fullmatch(r'[0-9a-f]{64}', digest or ''):
+        return None
+    client = get_minio_client()
+    if not client:
+        return None
+    object_name = content_object_name('videos', digest, 'video.mp4')
+    try:
+        if minio_object_exists(client, os.getenv('MINIO_BUCKET_NAME', 'disparo'), object_name):
+            return object_name
+    except S3Error as e:
+        print(f"Erro ao consultar vídeo {object_name} no MinIO: {e}")
+    return None
+
+class VideoTooLargeError(Exception):
+    """Vídeo excedeu o limite de tamanho durante o upload"""
+    
+    def __init__(self, size):
+        self.size = size
+        super().__init__(f'Vídeo muito grande ({size / (1024 * 1024):.1f}MB). Máximo permitido: {VIDEO_MAX_BYTES // (1024 * 1024)}MB')
+
+class MinioStreamUpload:
+    """Destino do parser multipart que envia o arquivo ao MinIO (multipart paralelo) enquanto chega"""
+    
+    def __init__(self, client, original_filename, content_type=None):
+        self.client = client
+        self.bucket_name = os.getenv('MINIO_BUCKET_NAME', 'disparo')
+        self.original_filename = original_filename
+        # Envia para um nome temporário; ao final o objeto é endereçado pelo hash do conteúdo
+        self.staging_name = f"videos/tmp/{uuid.uuid4()}{os.path.splitext(original_filename)[1].lower()}"
+        self.object_name = None
+        self.sha256 = hashlib.sha256()
+        self.content_type = content_type or 'video/mp4'
+        self.size = 0
+        self.too_large = False
+        self.received = False
+        self.finished = False
+        self.error = None
+        self.url = None
+        self.chunks = queue.Queue(maxsize=MINIO_STREAM_QUEUE_CHUNKS)
+        self.pending = bytearray()
+        self.eof = False
+        self.thread = threading.Thread(target=self._upload, daemon=True)
+        self.thread.start()
+    
+    def _put(self, item):
+        # Não bloquear o parser para sempre se o envio já falhou
+        while self.error is None:
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+    
+    # Lado do parser multipart (escrita)
+    def write(self, data):
+        if self.too_large or self.error is not None:
+            return len(data)
+        self.size += len(data)
+        if self.size > VIDEO_MAX_BYTES:
+            self.too_large = True
+            self._put(VideoTooLargeError(self.size))
+            return len(data)
+        self.sha256.update(data)
+        self._put(bytes(data))
+        return len(data)
+    
+    def seek(self, offset, whence=0):
+        # O Werkzeug chama seek(0) ao terminar de receber o arquivo
+        if not self.received:
+            self.received = True
+            self._put(None)
+        return 0
+    
+    # Lado do MinIO (leitura)
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.pending) < size):
+            item = self.chunks.get()
+            if item is None:
+                self.eof = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                self.pending.extend(item)
+        if size < 0:
+            size = len(self.pending)
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+    
+    def _upload(self):
+        try:
+            if not ensure_bucket_exists():
+                raise Exception("Erro ao garantir existência do bucket")
+            print(f"Iniciando upload em streaming: {self.staging_name}")
+            self.client.put_object(
+                self.bucket_name,
+                self.staging_name,
+                self,
+                length=-1,
+                part_size=MINIO_PART_SIZE,
+                content_type=self.content_type,
+                num_parallel_uploads=MINIO_PARALLEL_UPLOADS
+            )
+            
+            # Conteúdo repetido reaproveita o objeto existente; senão copia no próprio MinIO
+            self.object_name = content_object_name('videos', self.sha256.hexdigest(), self.original_filename)
+            if minio_object_exists(self.client, self.bucket_name, self.object_name):
+                print(f"Vídeo já existe no MinIO, reaproveitando: {self.object_name}")
+            else:
+                self.client.copy_object(self.bucket_name, self.object_name, CopySource(self.bucket_name, self.staging_name))
+            self.client.remove_object(self.bucket_name, self.staging_name)
+            
+            self.url = get_presigned_url(self.client, self.bucket_name, self.object_name)
+            print(f"Vídeo enviado para MinIO em streaming: {self.object_name} ({self.size / (1024 * 1024):.2f} MB)")
+        except Exception as e:
+            if isinstance(e, S3Error) and e.code == 'NoSuchBucket':
+                minio_state['bucket_verified'] = False
+            if not isinstance(e, VideoTooLargeError):
+                print(f"Erro no upload em streaming: {e}")
+            self.error = e
+    
+    def claim(self):
+        """Marca o envio como utilizado (não será descartado ao fim da requisição)"""
+        self.finished = True
+        return self
+    
+    def finish(self):
+        """Aguarda o fim do envio e retorna a URL presigned"""
+        self.finished = True
+        self.thread.join()
+        if self.too_large:
+            raise VideoTooLargeError(self.size)
+        if self.error is not None:
+            raise Exception(f"Erro MinIO: {str(self.error)}")
+        return self.url
+    
+    def discard(self):
+        """Cancela o envio quando a requisição não o utilizou (o objeto por conteúdo é mantido para reuso)"""
+        self.finished = True
+        if not self.received:
+            self._put(Exception("Upload cancelado"))
+        self.thread.join()
+        try:
+            self.client.remove_object(self.bucket_name, self.staging_name)
+        except Exception as e:
+            print(f"Erro ao descartar objeto {self.staging_name}: {e}")
+
+class StreamingRequest(Request):
+    """Request que envia vídeos MP4 do disparo direto ao MinIO, sem passar pelo disco"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == 'index' and filename and filename.lower().endswith('.mp4'):
+            client = get_minio_client()
+            if client:
+                upload = MinioStreamUpload(client, filename, content_type)
+                g.setdefault('minio_stream_uploads', []).append(upload)
+                return upload
+        # Fallback: arquivo temporário padrão do Werkzeug
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = StreamingRequest
+
+@app.teardown_request
+def discard_unfinished_uploads(exc):
+    """Descarta uploads em streaming que a rota não chegou a utilizar"""
+    for upload in g.pop('minio_stream_uploads', []):
+        if not upload.finished:
+            upload.discard()
+
 # Funções Evolution API
 def get_evolution_api_headers():
     """Retorna os headers para requisições à Evolution API"""
@@ -164,12 +475,66 @@ def get_evolution_api_headers():
         'apikey': os.getenv('EVOLUTION_API_KEY', '')
     }
 
+class EvolutionClient:
+    """Cliente da Evolution API com sessão persistente (keep-alive), pool de conexões e retentativas"""
+    
+    def __init__(self, base_url=None, pool_size=None, max_retries=None, connect_timeout=None, read_timeout=None):
+        self.base_url = (base_url if base_url is not None else os.getenv('EVOLUTION_BASE_URL', '')).rstrip('/')
+        pool_size = pool_size or int(os.getenv('EVOLUTION_POOL_SIZE', 20))
+        max_retries = max_retries if max_retries is not None else int(os.getenv('EVOLUTION_MAX_RETRIES', 2))
+        self.timeout = (
+            connect_timeout or float(os.getenv('EVOLUTION_CONNECT_TIMEOUT', 5)),
+            read_timeout or float(os.getenv('EVOLUTION_READ_TIMEOUT', 15))
+        )
+        
+        # Retentativas apenas em métodos idempotentes e falhas transitórias do gateway
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        
+        self.session = requests.Session()
+        self.session.headers.update(get_evolution_api_headers())
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def url(self, path):
+        """Monta a URL completa a partir do caminho do endpoint"""
+        return f"{self.base_url}/{path.lstrip('/')}"
+    
+    def request(self, method, path, timeout=None, **kwargs):
+        """Executa uma requisição pela sessão compartilhada com timeout padrão"""
+        return self.session.request(method, self.url(path), timeout=timeout or self.timeout, **kwargs)
+    
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+    
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+    
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+evolution_client = EvolutionClient()
+
+def instance_webhook_url():
+    """URL do webhook de MESSAGES_UPSERT registrada nas novas instâncias
+
+    Com INBOUND_WEBHOOK_URL e o token configurados, é o webhook de entrada deste app (que
+    alimenta as tabelas locais de chats); senão continua sendo o webhook do n8n.
+    """
+    if INBOUND_WEBHOOK_URL and INBOUND_WEBHOOK_TOKEN:
+        separator = '&' if '?' in INBOUND_WEBHOOK_URL else '?'
+        return f"{INBOUND_WEBHOOK_URL}{separator}{urlencode({'token': INBOUND_WEBHOOK_TOKEN})}"
+    return N8N_MESSAGES_WEBHOOK_URL
+
 def create_evolution_instance(instance_name):
     """Cria uma nova instância na Evolution API"""
     try:
-        url = f"{os.getenv('EVOLUTION_BASE_URL', '')}/instance/create"
-        headers = get_evolution_api_headers()
-        
         payload = {
             "instanceName": instance_name,
             "token": os.getenv('EVOLUTION_API_KEY', ''),
@@ -178,7 +543,7 @@ def create_evolution_instance(instance_name):
             "groupsIgnore": True,
             "syncFullHistory": True,
             "webhook": {
-                "url": "https://rede-confianca-n8n.lpl0df.easypanel.host/webhook/envia-msg-envio",
+                "url": instance_webhook_url(),
                 "base64": True,
                 "events": ["MESSAGES_UPSERT"],
             },
@@ -195,7 +560,7 @@ def create_evolution_instance(instance_name):
             "chatwootOrganization": "Rede Confiança"
         }
         
-        response = requests.post(url, json=payload, headers=headers)
+        response = evolution_client.post('/instance/create', json=payload)
         print(f"Response status: {response.status_code}")
         print(f"Response text: {response.text}")
         print(f"Response: {response}")
@@ -208,27 +573,34 @@ def create_evolution_instance(instance_name):
 def connect_evolution_instance(instance_name):
     """Conecta uma instância na Evolution API"""
     try:
-        url = f"{os.getenv('EVOLUTION_BASE_URL', '')}/instance/connect/{instance_name}"
-        headers = get_evolution_api_headers()
-        
-        response = requests.get(url, headers=headers)
+        response = evolution_client.get(f"/instance/connect/{instance_name}")
         return response.status_code == 200
     except Exception as e:
         print(f"Erro ao conectar instância Evolution: {e}")
         return False
 
+def extract_qr_code(data):
+    """Extrai o QR Code (base64 sem prefixo) da resposta do /instance/connect, se houver"""
+    if not isinstance(data, dict):
+        return None
+    for field in ('qrcode', 'base64', 'qr'):
+        qr_data = data.get(field)
+        if isinstance(qr_data, dict):
+            qr_data = qr_data.get('base64')
+        if isinstance(qr_data, str) and qr_data:
+            return qr_data.replace('data:image/png;base64,', '') if qr_data.startswith('data:') else qr_data
+    return None
+
 def get_qrcode_evolution(instance_name):
     """Busca o QR Code de uma instância na Evolution API"""
     try:
         # Primeiro tenta o endpoint de conexão
-        url = f"{os.getenv('EVOLUTION_BASE_URL', '')}/instance/connect/{instance_name}"
-        headers = get_evolution_api_headers()
+        url = evolution_client.url(f"/instance/connect/{instance_name}")
         
         print(f"Buscando QR Code para instância: {instance_name}")
         print(f"URL: {url}")
-        print(f"Headers: {headers}")
         
-        response = requests.get(url, headers=headers)
+        response = evolution_client.get(f"/instance/connect/{instance_name}")
         print(f"Response status: {response.status_code}")
         print(f"Response text: {response.text}")
         
@@ -237,26 +609,18 @@ def get_qrcode_evolution(instance_name):
             print(f"Response data: {data}")
             
             # O QR Code pode vir em diferentes formatos dependendo da Evolution API
-            if 'qrcode' in data:
-                qr_data = data['qrcode']
-                print(f"QR Code encontrado no campo 'qrcode'")
-                return qr_data.replace('data:image/png;base64,', '') if qr_data.startswith('data:') else qr_data
-            elif 'base64' in data:
-                qr_data = data['base64']
-                print(f"QR Code encontrado no campo 'base64'")
-                return qr_data.replace('data:image/png;base64,', '') if qr_data.startswith('data:') else qr_data
-            elif 'qr' in data:
-                qr_data = data['qr']
-                print(f"QR Code encontrado no campo 'qr'")
-                return qr_data.replace('data:image/png;base64,', '') if qr_data.startswith('data:') else qr_data
-            else:
+            qr_data = extract_qr_code(data)
+            if qr_data:
+                print("QR Code encontrado na resposta do connect")
+                return qr_data
+            if isinstance(data, dict):
                 print(f"Campos disponíveis na resposta: {list(data.keys())}")
         else:
             print(f"Erro na requisição: {response.status_code} - {response.text}")
         
         # Se não conseguir pelo endpoint de connect, tenta buscar instância específica
-        url2 = f"{os.getenv('EVOLUTION_BASE_URL', '')}/instance/{instance_name}"
-        response2 = requests.get(url2, headers=headers)
+        url2 = evolution_client.url(f"/instance/{instance_name}")
+        response2 = evolution_client.get(f"/instance/{instance_name}")
         print(f"Tentando URL alternativa: {url2}")
         print(f"Response status 2: {response2.status_code}")
         
@@ -271,24 +635,155 @@ def get_qrcode_evolution(instance_name):
         print(f"Erro ao buscar QR Code: {e}")
         return None
 
-def get_instance_status(instance_name):
-    """Verifica o status de uma instância na Evolution API"""
-    try:
-        headers = get_evolution_api_headers()
-        
-        print(f"Verificando status da instância: {instance_name}")
-        
-        # Lista de endpoints para tentar
-        endpoints = [
-            f"{os.getenv('EVOLUTION_BASE_URL', '')}/instance/{instance_name}",
-            f"{os.getenv('EVOLUTION_BASE_URL', '')}/instance/fetchInstances"
+def normalize_instance_status(status):
+    """Normaliza diferentes valores que significam "conectado" para 'open'"""
+    if status and status.lower() in ['open', 'connected', 'online']:
+        return 'open'
+    return status
+
+def parse_fetch_instances(instances):
+    """Converte a resposta do fetchInstances em um dict {nome_instancia: status}"""
+    parsed = {}
+    
+    # Se a resposta é uma lista
+    if isinstance(instances, list):
+        for instance in instances:
+            if not isinstance(instance, dict):
+                continue
+            # Verifica diferentes estruturas possíveis
+            instance_data = instance.get('instance', instance)
+            name = (
+                instance_data.get('instanceName') or
+                instance_data.get('name') or
+                instance.get('instanceName') or
+                instance.get('name')
+            )
+            if name:
+                parsed[name] = normalize_instance_status(
+                    instance_data.get('state') or
+                    instance_data.get('connectionStatus') or
+                    instance.get('state') or
+                    instance.get('connectionStatus') or
+                    'close'
+                )
+    
+    # Se a resposta é um objeto
+    elif isinstance(instances, dict):
+        for key, instance in instances.items():
+            if not isinstance(instance, dict):
+                continue
+            name = instance.get('instanceName') or instance.get('name') or key
+            parsed[name] = normalize_instance_status(
+                instance.get('state') or
+                instance.get('connectionStatus') or
+                'close'
+            )
+    
+    return parsed
+
+def record_instance_transitions(previous, statuses):
+    """Registra no histórico as instâncias cujo status mudou (chamar com instances_snapshot_lock)"""
+    now = time.time()
+    for name, status in statuses.items():
+        old_status = previous.get(name)
+        # Primeira leitura de uma instância não é transição
+        if old_status is None or old_status == status:
+            continue
+        instance_changed_at[name] = now
+        history = instance_history.get(name)
+        if history is None:
+            history = instance_history[name] = collections.deque(maxlen=INSTANCE_HISTORY_SIZE)
+        history.append((int(now), old_status, status))
+
+def get_instance_history(instance_name):
+    """Transições recentes da instância, da mais antiga para a mais nova"""
+    with instances_snapshot_lock:
+        return [
+            {
+                'at': at,
+                'hora': datetime.datetime.fromtimestamp(at).strftime('%d/%m %H:%M:%S'),
+                'from': old_status,
+                'to': status
+            }
+            for at, old_status, status in instance_history.get(instance_name, ())
         ]
+
+def refresh_instances_snapshot():
+    """Baixa o fetchInstances uma única vez e atualiza o snapshot compartilhado"""
+    parsed = None
+    try:
+        response = evolution_client.get('/instance/fetchInstances')
+        if response.status_code == 200:
+            parsed = parse_fetch_instances(response.json())
+            print(f"Snapshot de instâncias atualizado: {len(parsed)} instâncias")
+        else:
+            print(f"Erro ao atualizar snapshot de instâncias: {response.status_code}")
+    except Exception as e:
+        print(f"Erro ao atualizar snapshot de instâncias: {e}")
+    finally:
+        with instances_snapshot_lock:
+            # Em caso de falha mantém os dados anteriores, mas a idade continua contando da última carga boa
+            if parsed is not None:
+                record_instance_transitions(instances_snapshot['instances'], parsed)
+                instances_snapshot['instances'] = parsed
+                instances_snapshot['fetched_at'] = time.time()
+            else:
+                instances_snapshot['last_error_at'] = time.time()
+            instances_snapshot['refreshing'] = False
+    return parsed is not None
+
+def get_instances_snapshot():
+    """Retorna o snapshot {nome: status}; atualiza em background quando expirado"""
+    # Com o monitor rodando o snapshot é atualizado por ele; aqui só cobre o monitor parado
+    ttl = INSTANCE_MONITOR_MAX_AGE if instance_monitor_state['running'] else INSTANCES_SNAPSHOT_TTL
+    with instances_snapshot_lock:
+        fetched_at = instances_snapshot['fetched_at']
+        last_error_at = instances_snapshot['last_error_at']
+        # Depois de uma falha espera o TTL antes de tentar de novo (Evolution fora do ar)
+        backing_off = last_error_at is not None and time.time() - last_error_at < INSTANCES_SNAPSHOT_TTL
+        expired = time.time() - fetched_at > ttl
+        start_background = bool(fetched_at) and expired and not backing_off and not instances_snapshot['refreshing']
+        if start_background:
+            instances_snapshot['refreshing'] = True
+    
+    if not fetched_at and not backing_off:
+        # Primeira carga: apenas uma thread baixa a lista, as demais aguardam
+        with instances_refresh_lock:
+            if not instances_snapshot['fetched_at']:
+                refresh_instances_snapshot()
+    elif start_background:
+        # Serve o snapshot atual enquanto atualiza em background
+        threading.Thread(target=refresh_instances_snapshot, daemon=True).start()
+    
+    with instances_snapshot_lock:
+        return instances_snapshot['instances']
+
+def get_instances_snapshot_age():
+    """Idade do snapshot em segundos (None se nunca foi carregado)"""
+    with instances_snapshot_lock:
+        if not instances_snapshot['fetched_at']:
+            return None
+        return round(time.time() - instances_snapshot['fetched_at'], 1)
+
+def instances_snapshot_is_fresh():
+    """True se o snapshot tem dados de uma carga bem-sucedida recente (dentro do prazo do monitor)"""
+    with instances_snapshot_lock:
+        fetched_at = instances_snapshot['fetched_at']
+        return bool(fetched_at) and bool(instances_snapshot['instances']) and time.time() - fetched_at <= INSTANCE_MONITOR_MAX_AGE
+
+def get_instance_status(instance_name, timeout=None):
+    """Verifica o status de uma instância na Evolution API (timeout limita a consulta HTTP direta)"""
+    try:
+        # Primeiro consulta o snapshot compartilhado do fetchInstances
+        status = get_instances_snapshot().get(instance_name)
+        if status:
+            return status
         
-        # Tentar primeiro endpoint específico da instância
-        url = endpoints[0]
-        print(f"Tentando URL específica: {url}")
+        # Instância fora do snapshot (ex: recém-criada): consulta o endpoint específico
+        url = evolution_client.url(f"/instance/{instance_name}")
+        print(f"Instância {instance_name} fora do snapshot, tentando URL específica: {url}")
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = evolution_client.get(f"/instance/{instance_name}", timeout=timeout)
         print(f"Response status: {response.status_code}")
         
         if response.status_code == 200:
@@ -298,70 +793,7 @@ def get_instance_status(instance_name):
                 status = data.get('state') or data.get('connectionStatus') or data.get('status')
                 if status:
                     print(f"Status encontrado na URL específica: {status}")
-                    # Normalizar diferentes valores que significam "conectado"
-                    if status.lower() in ['open', 'connected', 'online']:
-                        return 'open'
-                    return status
-        
-        # Se não funcionou, tentar buscar todas as instâncias
-        url = endpoints[1]
-        print(f"Tentando URL geral: {url}")
-        
-        response = requests.get(url, headers=headers, timeout=10)
-        print(f"Response status 2: {response.status_code}")
-        
-        if response.status_code == 200:
-            instances = response.json()
-            print(f"Tipo de resposta: {type(instances)}")
-            
-            # Se a resposta é uma lista
-            if isinstance(instances, list):
-                for instance in instances:
-                    if isinstance(instance, dict):
-                        # Verifica diferentes estruturas possíveis
-                        instance_data = instance.get('instance', instance)
-                        name_check = (
-                            instance_data.get('instanceName') == instance_name or 
-                            instance_data.get('name') == instance_name or
-                            instance.get('instanceName') == instance_name or
-                            instance.get('name') == instance_name
-                        )
-                        
-                        if name_check:
-                            status = (
-                                instance_data.get('state') or 
-                                instance_data.get('connectionStatus') or 
-                                instance.get('state') or 
-                                instance.get('connectionStatus') or
-                                'close'
-                            )
-                            print(f"Status encontrado na lista: {status}")
-                            # Normalizar diferentes valores que significam "conectado"
-                            if status.lower() in ['open', 'connected', 'online']:
-                                return 'open'
-                            return status
-            
-            # Se a resposta é um objeto
-            elif isinstance(instances, dict):
-                for key, instance in instances.items():
-                    if isinstance(instance, dict):
-                        name_check = (
-                            instance.get('instanceName') == instance_name or 
-                            instance.get('name') == instance_name or
-                            key == instance_name
-                        )
-                        
-                        if name_check:
-                            status = (
-                                instance.get('state') or 
-                                instance.get('connectionStatus') or 
-                                'close'
-                            )
-                            print(f"Status encontrado no objeto: {status}")
-                            # Normalizar diferentes valores que significam "conectado"
-                            if status.lower() in ['open', 'connected', 'online']:
-                                return 'open'
-                            return status
+                    return normalize_instance_status(status)
         
         print("Status não encontrado em nenhum endpoint, retornando 'close'")
         return 'close'
@@ -375,64 +807,539 @@ def get_instance_status(instance_name):
         traceback.print_exc()
         return 'close'
 
+def instance_monitor_interval():
+    """Intervalo até a próxima rodada: rápido se alguma instância está conectando,
+    normal se alguma mudou há pouco e lento quando todas estão estáveis"""
+    now = time.time()
+    with instances_snapshot_lock:
+        statuses = dict(instances_snapshot['instances'])
+        changed_at = dict(instance_changed_at)
+    
+    interval = INSTANCE_MONITOR_STABLE_INTERVAL
+    for name, status in statuses.items():
+        if status == 'connecting':
+            return INSTANCE_MONITOR_FAST_INTERVAL
+        if now - changed_at.get(name, 0) < INSTANCE_MONITOR_STABLE_AFTER:
+            interval = INSTANCE_MONITOR_INTERVAL
+    return interval
+
+def wake_instance_monitor():
+    """Antecipa a próxima rodada do monitor (ex: logo após pedir uma conexão)"""
+    instance_monitor_wakeup.set()
+
+def instance_monitor_loop():
+    """Atualiza o snapshot de todas as instâncias (um único fetchInstances por rodada)"""
+    print("🩺 Monitor de instâncias iniciado")
+    instance_monitor_state['running'] = True
+    while True:
+        instance_monitor_wakeup.clear()
+        try:
+            # Após uma falha tenta de novo no intervalo normal, sem esperar o intervalo de estáveis
+            interval = instance_monitor_interval() if refresh_instances_snapshot() else INSTANCE_MONITOR_INTERVAL
+        except Exception as e:
+            print(f"Erro no monitor de instâncias: {e}")
+            interval = INSTANCE_MONITOR_INTERVAL
+        instance_monitor_state['interval'] = interval
+        instance_monitor_state['next_check_at'] = time.time() + interval
+        instance_monitor_wakeup.wait(interval)
+
+def start_instance_monitor():
+    """Inicia o monitor de instâncias neste processo (uma única vez); sem ele o snapshot é atualizado sob demanda"""
+    with instances_snapshot_lock:
+        if instance_monitor_state['thread'] is None:
+            instance_monitor_state['thread'] = threading.Thread(target=instance_monitor_loop, daemon=True, name='instance-monitor')
+            instance_monitor_state['thread'].start()
+
+# Push (Server-Sent Events) de status e QR Code: um watcher por instância, compartilhado pelas abas
+INSTANCE_WATCH_INTERVAL = float(os.getenv('INSTANCE_WATCH_INTERVAL', 2))
+INSTANCE_WATCH_OPEN_INTERVAL = float(os.getenv('INSTANCE_WATCH_OPEN_INTERVAL', 10))
+INSTANCE_QR_INTERVAL = float(os.getenv('INSTANCE_QR_INTERVAL', 15))
+INSTANCE_EVENTS_KEEPALIVE = float(os.getenv('INSTANCE_EVENTS_KEEPALIVE', 15))
+# Cada stream aberto ocupa uma thread do servidor: rodar com threads (app.run já usa threaded=True;
+# no Gunicorn, --worker-class gthread ou gevent), nunca só workers síncronos. O stream é encerrado
+# após esse tempo e o navegador reconecta sozinho (retry), então a thread é liberada com frequência
+INSTANCE_EVENTS_MAX_SECONDS = float(os.getenv('INSTANCE_EVENTS_MAX_SECONDS', 60))
+INSTANCE_EVENTS_QUEUE_SIZE = 20
+instance_watchers = {}
+instance_watchers_lock = threading.Lock()
+
+def fetch_connection_state(instance_name, fallback=True, timeout=None):
+    """Consulta o estado de uma única instância (connectionState) e atualiza o snapshot compartilhado
+
+    Com fallback=False retorna None se a consulta falhar, em vez de recorrer ao snapshot.
+    """
+    try:
+        response = evolution_client.get(f"/instance/connectionState/{instance_name}", timeout=timeout)
+        if response.status_code == 200:
+            data = response.json()
+            instance_data = data.get('instance', data) if isinstance(data, dict) else {}
+            status = instance_data.get('state') or instance_data.get('connectionStatus')
+            if status:
+                status = normalize_instance_status(status)
+                with instances_snapshot_lock:
+                    if instances_snapshot['fetched_at']:
+                        record_instance_transitions(instances_snapshot['instances'], {instance_name: status})
+                        # Troca por uma cópia: quem recebeu o dict de get_instances_snapshot itera sem o lock
+                        instances_snapshot['instances'] = {**instances_snapshot['instances'], instance_name: status}
+                return status
+    except Exception as e:
+        print(f"Erro ao consultar connectionState de {instance_name}: {e}")
+    
+    # Versões da Evolution sem connectionState: usa o caminho antigo (snapshot / /instance/<nome>)
+    return get_instance_status(instance_name, timeout=timeout) if fallback else None
+
+class InstanceWatcher:
+    """Acompanha status e QR Code de uma instância e repassa as mudanças aos inscritos
+
+    Cada aba conectada ao stream é um inscrito (uma fila). A thread de consulta só existe
+    enquanto houver inscritos e termina sozinha quando o último sai.
+    """
+    
+    def __init__(self, instance_name):
+        self.instance_name = instance_name
+        self.subscribers = set()
+        self.status = None
+        self.qr_code = None
+        self.qr_fetched_at = 0.0
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def status_event(self):
+        return {
+            'instance_name': self.instance_name,
+            'status': self.status,
+            'connected': self.status == 'open',
+            'timestamp': int(time.time())
+        }
+    
+    def qrcode_event(self):
+        return {
+            'instance_name': self.instance_name,
+            'qr_code': self.qr_code,
+            'timestamp': int(time.time())
+        }
+    
+    def subscribe(self):
+        """Registra um inscrito; quem chega depois recebe logo o último estado conhecido"""
+        subscriber = queue.Queue(maxsize=INSTANCE_EVENTS_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.status is not None:
+                subscriber.put_nowait(('status', self.status_event()))
+            if self.qr_code and self.status != 'open':
+                subscriber.put_nowait(('qrcode', self.qrcode_event()))
+            flow = get_connect_flow(self.instance_name)
+            if flow:
+                subscriber.put_nowait(('connect', flow))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True, name=f'watch-{self.instance_name}')
+                self.thread.start()
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+    
+    def publish(self, event, data):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                # Aba que não consome: perde eventos intermediários, o próximo traz o estado atual
+                pass
+    
+    def set_qr_code(self, qr_code):
+        """QR Code obtido por fora (ex: fluxo de conexão): publica sem nova consulta à Evolution"""
+        self.qr_fetched_at = time.time()
+        if qr_code and qr_code != self.qr_code:
+            self.qr_code = qr_code
+            self.publish('qrcode', self.qrcode_event())
+    
+    def poll(self):
+        """Uma rodada de consulta: publica status novo e, se desconectado, QR Code novo"""
+        status = fetch_connection_state(self.instance_name)
+        if status != self.status:
+            print(f"📡 Instância {self.instance_name}: {self.status} -> {status}")
+            self.status = status
+            if status == 'open':
+                self.qr_code = None
+            self.publish('status', self.status_event())
+        
+        if status != 'open' and time.time() - self.qr_fetched_at >= INSTANCE_QR_INTERVAL:
+            flow = get_connect_flow(self.instance_name)
+            if flow and flow['state'] in CONNECT_ACTIVE_STATES:
+                # O fluxo de conexão em andamento já vai entregar o QR Code
+                return
+            qr_code = get_qrcode_evolution(self.instance_name)
+            self.qr_fetched_at = time.time()
+            if qr_code and qr_code != self.qr_code:
+                self.qr_code = qr_code
+                self.publish('qrcode', self.qrcode_event())
+    
+    def run(self):
+        while True:
+            with instance_watchers_lock:
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        if instance_watchers.get(self.instance_name) is self:
+                            del instance_watchers[self.instance_name]
+                        return
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Erro no watcher da instância {self.instance_name}: {e}")
+            time.sleep(INSTANCE_WATCH_OPEN_INTERVAL if self.status == 'open' else INSTANCE_WATCH_INTERVAL)
+
+def subscribe_instance_events(instance_name):
+    """Inscreve uma aba no watcher da instância (criando-o se for o primeiro inscrito)"""
+    with instance_watchers_lock:
+        watcher = instance_watchers.get(instance_name)
+        if watcher is None:
+            watcher = instance_watchers[instance_name] = InstanceWatcher(instance_name)
+        return watcher, watcher.subscribe()
+
+def format_sse(event, data):
+    """Formata um evento no protocolo text/event-stream"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Fluxo de conexão/reconexão em background: a rota só agenda, a página acompanha pelo stream
+CONNECT_WORKERS = int(os.getenv('CONNECT_WORKERS', 8))
+CONNECT_QR_TIMEOUT = float(os.getenv('CONNECT_QR_TIMEOUT', 30))
+CONNECT_RETRY_INTERVAL = float(os.getenv('CONNECT_RETRY_INTERVAL', 2))
+CONNECT_FLOW_TTL = 600
+CONNECT_ACTIVE_STATES = ('pending', 'connecting')
+connect_executor = ThreadPoolExecutor(max_workers=CONNECT_WORKERS, thread_name_prefix='connect')
+connect_flows = {}
+connect_flows_lock = threading.Lock()
+
+def get_connect_flow(instance_name):
+    """Cópia do estado do fluxo de conexão da instância (None se não houver fluxo recente)"""
+    # get_instances_snapshot atualiza o snapshot quando expirado (monitor desligado)
+    status = get_instances_snapshot().get(instance_name)
+    with connect_flows_lock:
+        flow = connect_flows.get(instance_name)
+        if flow is None or time.time() - flow['updated_at'] > CONNECT_FLOW_TTL:
+            return None
+        # O QR Code foi escaneado: quem percebe é o monitor/watcher ao atualizar o snapshot
+        if flow['state'] == 'waiting_scan' and status == 'open':
+            flow['state'] = 'open'
+            flow['updated_at'] = time.time()
+        return {key: value for key, value in flow.items() if key != 'qr_code'}
+
+def update_connect_flow(instance_name, state, error=None, qr_code=None):
+    """Avança o fluxo e repassa o novo estado (e o QR Code) às abas inscritas na instância"""
+    with connect_flows_lock:
+        flow = connect_flows[instance_name]
+        flow['state'] = state
+        flow['error'] = error
+        flow['updated_at'] = time.time()
+        if qr_code:
+            flow['qr_code'] = qr_code
+            flow['qr_at'] = flow['updated_at']
+    print(f"🔌 Conexão {instance_name}: {state}{f' ({error})' if error else ''}")
+    
+    with instance_watchers_lock:
+        watcher = instance_watchers.get(instance_name)
+    if watcher:
+        if qr_code:
+            watcher.set_qr_code(qr_code)
+        watcher.publish('connect', get_connect_flow(instance_name))
+
+def get_cached_qr_code(instance_name):
+    """QR Code mais recente já obtido pelo watcher ou pelo fluxo de conexão (None se velho)"""
+    with instance_watchers_lock:
+        watcher = instance_watchers.get(instance_name)
+    if watcher and watcher.qr_code and time.time() - watcher.qr_fetched_at < INSTANCE_QR_INTERVAL:
+        return watcher.qr_code
+    with connect_flows_lock:
+        flow = connect_flows.get(instance_name)
+        if flow and flow.get('qr_code') and time.time() - flow['qr_at'] < INSTANCE_QR_INTERVAL:
+            return flow['qr_code']
+    return None
+
+def start_connect_flow(instance_name):
+    """Agenda a conexão da instância e retorna o fluxo imediatamente
+
+    Cliques repetidos enquanto um fluxo está em andamento reaproveitam o mesmo fluxo.
+    """
+    with connect_flows_lock:
+        flow = connect_flows.get(instance_name)
+        now = time.time()
+        if flow and flow['state'] in CONNECT_ACTIVE_STATES and now - flow['updated_at'] < CONNECT_FLOW_TTL:
+            return {key: value for key, value in flow.items() if key != 'qr_code'}
+        connect_flows[instance_name] = {
+            'instance_name': instance_name,
+            'state': 'pending',
+            'error': None,
+            'started_at': now,
+            'updated_at': now,
+            'qr_at': None
+        }
+    connect_executor.submit(run_connect_flow, instance_name)
+    return get_connect_flow(instance_name)
+
+def run_connect_flow(instance_name):
+    """pending -> connecting -> waiting_scan (QR Code disponível) | open | failed
+
+    As retentativas esperam aqui, no worker de conexão, e não na thread da requisição.
+    """
+    update_connect_flow(instance_name, 'connecting')
+    deadline = time.time() + CONNECT_QR_TIMEOUT
+    error = None
+    
+    while True:
+        try:
+            response = evolution_client.get(f"/instance/connect/{instance_name}")
+            data = response.json() if response.content else {}
+            if response.status_code in [200, 201]:
+                instance_data = data.get('instance', data) if isinstance(data, dict) else {}
+                state = normalize_instance_status(instance_data.get('state'))
+                qr_code = extract_qr_code(data)
+                if state == 'open':
+                    update_connect_flow(instance_name, 'open')
+                    break
+                if qr_code:
+                    update_connect_flow(instance_name, 'waiting_scan', qr_code=qr_code)
+                    break
+                error = 'QR Code ainda não disponível'
+            else:
+                error = f"Status {response.status_code}"
+                if isinstance(data, dict) and data.get('message'):
+                    error = str(data['message'])
+                if 400 <= response.status_code < 500:
+                    # Instância inexistente / requisição inválida: não adianta insistir
+                    update_connect_flow(instance_name, 'failed', error=error)
+                    break
+        except Exception as e:
+            error = str(e)
+        
+        if time.time() + CONNECT_RETRY_INTERVAL > deadline:
+            update_connect_flow(instance_name, 'failed', error=error)
+            break
+        time.sleep(CONNECT_RETRY_INTERVAL)
+    
+    # Com a instância conectando o monitor passa a consultar no intervalo rápido
+    wake_instance_monitor()
+
+# Reconexão em massa: um único stream acompanha todas as instâncias da grade de QR Codes
+BULK_RECONNECT_TICK = float(os.getenv('BULK_RECONNECT_TICK', 1))
+
+def refresh_connect_qr(instance_name):
+    """Busca em background um QR Code novo para o fluxo (QRs expiram e são rotacionados)
+
+    No máximo uma tentativa a cada INSTANCE_QR_INTERVAL, mesmo quando a anterior não trouxe QR
+    """
+    with connect_flows_lock:
+        flow = connect_flows.get(instance_name)
+        if flow is None or flow.get('qr_refreshing') or flow['state'] in CONNECT_ACTIVE_STATES:
+            return
+        if time.time() - flow.get('qr_attempt_at', 0) < INSTANCE_QR_INTERVAL:
+            return
+        flow['qr_refreshing'] = True
+        flow['qr_attempt_at'] = time.time()
+    
+    def refresh():
+        try:
+            qr_code = get_qrcode_evolution(instance_name)
+            if qr_code:
+                update_connect_flow(instance_name, 'waiting_scan', qr_code=qr_code)
+        finally:
+            with connect_flows_lock:
+                connect_flows[instance_name]['qr_refreshing'] = False
+    
+    connect_executor.submit(refresh)
+
+def get_bulk_reconnect_state(instance_name, status):
+    """Estado de uma instância na grade: status do snapshot, fluxo de conexão e QR Code vigente"""
+    flow = get_connect_flow(instance_name)
+    state = flow['state'] if flow else None
+    qr_code = None
+    if status != 'open' and state not in ('open', 'failed'):
+        qr_code = get_cached_qr_code(instance_name)
+        if qr_code is None:
+            refresh_connect_qr(instance_name)
+            # Enquanto o novo não chega, mantém o último QR (pode já ter expirado)
+            with connect_flows_lock:
+                qr_code = (connect_flows.get(instance_name) or {}).get('qr_code')
+    return {
+        'instance_name': instance_name,
+        'status': status,
+        'connected': status == 'open' or state == 'open',
+        'state': state,
+        'error': flow['error'] if flow else None,
+        'qr_code': qr_code
+    }
+
+def start_bulk_reconnect(instance_names):
+    """Dispara a conexão de várias instâncias em paralelo (pool de conexão) e retorna os fluxos"""
+    flows = [start_connect_flow(instance_name) for instance_name in instance_names]
+    print(f"🔌 Reconexão em massa: {len(flows)} instâncias agendadas")
+    return flows
+
+# Cache LRU em memória para listas de chats e páginas de mensagens
+CHAT_CACHE_MAX_BYTES = int(float(os.getenv('CHAT_CACHE_MAX_MB', 64)) * 1024 * 1024)
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv('CHAT_CACHE_MAX_ENTRIES', 5000))
+CHAT_MESSAGES_CACHE_TTL = float(os.getenv('CHAT_MESSAGES_CACHE_TTL', 120))
+# Páginas que podem crescer (mais recentes / polling) ficam pouco tempo, mas já atendem várias abas
+CHAT_RECENT_CACHE_TTL = float(os.getenv('CHAT_RECENT_CACHE_TTL', 5))
+
+class LRUCache:
+    """Cache LRU limitado por quantidade de itens e bytes estimados, com TTL por item
+
+    As chaves são tuplas (tipo, instância, ...), o que permite invalidar por prefixo
+    (ex: todas as páginas de mensagens de um chat). Os prefixos (tipo, instância) e
+    (tipo, instância, chat) têm um índice próprio, então invalidar custa só as chaves removidas.
+    """
+    
+    INDEXED_PREFIXES = (2, 3)
+    
+    def __init__(self, max_bytes, max_entries, default_ttl):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.entries = collections.OrderedDict()  # chave -> (valor, bytes, expira_em)
+        self.bytes = 0
+        self.groups = collections.defaultdict(set)  # prefixo -> chaves com esse prefixo
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0}
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def estimate_size(value):
+        """Tamanho aproximado do valor serializado (contabilidade de memória)"""
+        return len(json.dumps(value, default=str))
+    
+    def get(self, key):
+        """Retorna o valor em cache (ou None), marcando-o como usado recentemente"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if entry[2] < time.time():
+                self.remove(key)
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+    
+    def set(self, key, value, ttl=None):
+        """Guarda o valor, descartando os menos usados se passar dos limites"""
+        size = self.estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, time.time() + (ttl if ttl is not None else self.default_ttl))
+            self.bytes += size
+            for length in self.INDEXED_PREFIXES:
+                if len(key) >= length:
+                    self.groups[key[:length]].add(key)
+            while self.bytes > self.max_bytes or len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+    
+    def remove(self, key):
+        """Remove um item (chamado com o lock)"""
+        value, size, _ = self.entries.pop(key)
+        self.bytes -= size
+        for length in self.INDEXED_PREFIXES:
+            if len(key) >= length:
+                group = self.groups.get(key[:length])
+                if group is not None:
+                    group.discard(key)
+                    if not group:
+                        del self.groups[key[:length]]
+    
+    def invalidate(self, *prefix):
+        """Remove todos os itens cuja chave começa com `prefix`; retorna quantos foram removidos"""
+        return self.invalidate_many([prefix])
+    
+    def invalidate_many(self, prefixes):
+        """Invalida vários prefixos adquirindo o lock uma única vez (ex: um lote do webhook)"""
+        removed = 0
+        with self.lock:
+            for prefix in prefixes:
+                prefix = tuple(prefix)
+                if len(prefix) in self.INDEXED_PREFIXES:
+                    keys = list(self.groups.get(prefix, ()))
+                else:
+                    keys = [key for key in self.entries if key[:len(prefix)] == prefix]
+                for key in keys:
+                    if key in self.entries:
+                        self.remove(key)
+                removed += len(keys)
+            self.stats['invalidations'] += removed
+        return removed
+    
+    def metrics(self):
+        """Contadores e ocupação do cache"""
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(
+                self.stats,
+                entries=len(self.entries),
+                bytes=self.bytes,
+                max_bytes=self.max_bytes,
+                hit_rate=round(self.stats['hits'] / lookups, 3) if lookups else None
+            )
+
+chat_cache = LRUCache(CHAT_CACHE_MAX_BYTES, CHAT_CACHE_MAX_ENTRIES, CHAT_MESSAGES_CACHE_TTL)
+
+def invalidate_chat_cache(instance_name, remote_jid=None):
+    """Descarta do cache o que mudou com uma nova mensagem: as páginas do chat e a lista de chats da instância"""
+    if remote_jid:
+        chat_cache.invalidate('messages', instance_name, remote_jid)
+    else:
+        chat_cache.invalidate('messages', instance_name)
+    chat_cache.invalidate('chats', instance_name)
+
+# Lista de chats: só a página pedida vem da Evolution (findChats com take/skip)
+CHATS_PAGE_SIZE = int(os.getenv('CHATS_PAGE_SIZE', 50))
+CHATS_LIST_TTL = float(os.getenv('CHATS_LIST_TTL', 30))
+
+def parse_evolution_chats(chats):
+    """Converte registros do findContacts/findChats em contatos, mais recentes primeiro (sem grupos)"""
+    contacts = []
+    for chat in chats:
+        if not isinstance(chat, dict):
+            continue
+        remote_jid = chat.get('remoteJid') or chat.get('id')
+        # Ignorar grupos e registros sem jid
+        if not remote_jid or remote_jid.endswith('@g.us'):
+            continue
+        contacts.append({
+            'remoteJid': remote_jid,
+            'profilePicUrl': chat.get('profilePicUrl', ''),
+            'name': chat.get('pushName') or remote_jid.split('@')[0],
+            'pushName': chat.get('pushName', ''),
+            'updatedAt': chat.get('updatedAt') or ''
+        })
+    
+    # Mais recentes primeiro; remoteJid desempata para o cursor ser estável
+    contacts.sort(key=lambda contact: contact['remoteJid'])
+    contacts.sort(key=lambda contact: contact['updatedAt'], reverse=True)
+    return contacts
+
 def get_contacts_from_instance(instance_name):
-    """Busca todos os contatos/chats de uma instância via Evolution API"""
+    """Busca todos os contatos/chats de uma instância via Evolution API, ordenados pelo updatedAt mais recente"""
     contacts = []
-    base_url = os.getenv('EVOLUTION_BASE_URL', '')
-    headers = get_evolution_api_headers()
     try:
-        # Tentar primeiro o endpoint padrão
-        url = f"{base_url}/chat/findContacts/{instance_name}"
-        print(f"🔍 Buscando chats para instância: {instance_name}")
-        print(f"🔗 URL: {url}")
-        
-        response = requests.post(url, headers=headers, timeout=15)
-        print(f"📊 Status da resposta: {response.status_code}")
+        response = evolution_client.post(f"/chat/findContacts/{instance_name}")
         
         # Se falhou, tentar endpoint alternativo
         if response.status_code != 200:
-            print("⚠️ Tentando endpoint alternativo...")
-            url_alt = f"{base_url}/chat/findChats/{instance_name}"
-            print(f"🔗 URL alternativa: {url_alt}")
-            response = requests.post(url_alt, headers=headers, timeout=15)
-            print(f"📊 Status da resposta alternativa: {response.status_code}")
+            print(f"⚠️ findContacts retornou {response.status_code}, tentando findChats...")
+            response = evolution_client.post(f"/chat/findChats/{instance_name}")
         
         if response.status_code == 200:
             data = response.json()
-            print(f"📋 Dados recebidos: tipo={type(data)}, tamanho={len(data) if isinstance(data, (list, dict)) else 'N/A'}")
-            
-            chats = data if isinstance(data, list) else data.get('data', [])
-            print(f"💬 Chats encontrados: {len(chats)}")
-            
-            for i, chat in enumerate(chats):
-                if i < 3:  # Log apenas os primeiros 3 para debug
-                    print(f"📱 Chat {i+1}: {chat}")
-                
-                remote_jid = chat.get('remoteJid') or chat.get('id')
-                print(f"🆔 RemoteJid encontrado: {remote_jid}")
-                
-                if remote_jid and not remote_jid.endswith('@g.us'):
-                    # Formatar timestamp
-                    formatted_time = chat.get('updatedAt', '')
-                    if formatted_time and 'T' in formatted_time:
-                        try:
-                            # Parse ISO format: 2025-08-12T10:03:11.000Z
-                            dt = datetime.datetime.fromisoformat(formatted_time.replace('Z', '+00:00'))
-                            formatted_time = dt.strftime('%d/%m/%Y %H:%M')
-                        except:
-                            formatted_time = 'Data inválida'
-                    
-                    contact = {
-                        'remoteJid': remote_jid,
-                        'profilePicUrl': chat.get('profilePicUrl', ''),
-                        'name': chat.get('pushName') or remote_jid.split('@')[0],
-                        'pushName': chat.get('pushName', ''),
-                        'formatted_time': formatted_time
-                    }
-                    contacts.append(contact)
-                    print(f"✅ Contato adicionado: {contact['name']} ({remote_jid})")
-                else:
-                    print(f"⏭️ Ignorando chat (grupo ou inválido): {remote_jid}")
+            contacts = parse_evolution_chats(data if isinstance(data, list) else data.get('data', []))
         else:
             print(f"❌ Erro ao buscar contatos na Evolution API: {response.status_code} - {response.text}")
     except Exception as e:
@@ -440,187 +1347,2057 @@ def get_contacts_from_instance(instance_name):
         import traceback
         traceback.print_exc()
     
-    print(f"📊 Total de contatos retornados: {len(contacts)}")
+    print(f"📊 Chats carregados da instância {instance_name}: {len(contacts)}")
     return contacts
 
-def get_messages_from_chat(instance_name, remote_jid):
-    """Busca mensagens de um chat específico via Evolution API"""
-    base_url = os.getenv('EVOLUTION_BASE_URL', '')
-    headers = get_evolution_api_headers()
-    messages = []
+def fetch_chats_page(instance_name, offset, limit):
+    """Uma página do findChats (a Evolution ordena por updatedAt desc): (contatos, tem_mais)
+
+    Retorna None se a chamada falhar ou se a versão da Evolution ignorar take/skip.
+    """
     try:
-        url = f"{base_url}/chat/findMessages/{instance_name}"
-        payload = {
-            "where": {
-                "key" : {
-                    "remoteJid": remote_jid
-                }
-            }
-        }
-        response = requests.post(url, json=payload, headers=headers, timeout=15)
-        if response.status_code == 200:
-            data = response.json()
-            msgs = data if isinstance(data, list) else data.get('data', [])
-            for msg in msgs:
-                # Formatar timestamp
-                if msg.get('messageTimestamp'):
-                    import datetime
-                    try:
-                        msg['formatted_time'] = datetime.datetime.fromtimestamp(
-                            int(msg['messageTimestamp']) / 1000
-                        ).strftime('%d/%m/%Y %H:%M')
-                    except:
-                        msg['formatted_time'] = 'Data inválida'
-                else:
-                    msg['formatted_time'] = 'Sem data'
-                messages.append(msg)
-        else:
-            print(f"❌ Erro ao buscar mensagens na Evolution API: {response.status_code} - {response.text}")
+        response = evolution_client.post(
+            f"/chat/findChats/{instance_name}",
+            json={"where": {}, "take": limit + 1, "skip": offset}
+        )
+        if response.status_code != 200:
+            print(f"❌ Erro ao buscar página de chats na Evolution API: {response.status_code} - {response.text}")
+            return None
+        data = response.json()
+        chats = data if isinstance(data, list) else data.get('data', [])
     except Exception as e:
-        print(f"❌ Erro ao buscar mensagens na Evolution API: {e}")
-    return messages
+        print(f"❌ Erro ao buscar página de chats na Evolution API: {e}")
+        return None
+    
+    if len(chats) > limit + 1:
+        print(f"⚠️ findChats ignorou take/skip ({len(chats)} chats); usando a lista completa")
+        return None
+    # O registro extra só indica se existe próxima página
+    return parse_evolution_chats(chats[:limit]), len(chats) > limit
 
-def update_whatsapp_number_description(numero_id, new_description, link_planilha=None):
-    """Atualiza a descrição e link da planilha de um número do WhatsApp"""
-    connection = get_db_connection()
-    if not connection:
-        return False
+def get_all_instance_chats(instance_name):
+    """Lista completa de chats (busca por nome/número), reaproveitada do cache por CHATS_LIST_TTL segundos"""
+    contacts = chat_cache.get(('chats', instance_name, 'all'))
+    if contacts is None:
+        contacts = get_contacts_from_instance(instance_name)
+        chat_cache.set(('chats', instance_name, 'all'), contacts, ttl=CHATS_LIST_TTL)
+    return contacts
+
+def get_instance_chats(instance_name, cursor=None, search=None, limit=CHATS_PAGE_SIZE):
+    """Uma página da lista de chats: (chats, próximo cursor, total ou None se desconhecido)
+
+    Com o webhook de entrada configurado e as conversas antigas já copiadas, a página vem
+    das tabelas locais (SQL com LIMIT). Senão, sem busca, só a página pedida é buscada na
+    Evolution (cursor "o:<offset>"). O findChats não filtra por nome/número: a busca (e
+    versões da Evolution que ignoram take/skip) usa a lista completa, paginada em memória.
+    """
+    cache_key = ('chats', instance_name, cursor, search, limit)
+    cached = chat_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    result = None
+    if local_chats_ready(instance_name):
+        result = load_local_chats(instance_name, cursor, search, limit)
+    if result is None and not search and (not cursor or cursor.startswith('o:')):
+        offset = parse_offset_cursor(cursor)
+        fetched = fetch_chats_page(instance_name, offset, limit)
+        if fetched is not None:
+            contacts, has_more = fetched
+            page = [dict(contact, formatted_time=format_chat_time(contact['updatedAt'])) for contact in contacts]
+            result = (page, f"o:{offset + limit}" if has_more else None, None)
+    if result is None:
+        result = paginate_chats(get_all_instance_chats(instance_name), cursor, search, limit)
+    
+    chat_cache.set(cache_key, result, ttl=CHATS_LIST_TTL)
+    return result
+
+def format_chat_time(updated_at):
+    """Formata o updatedAt ISO (2025-08-12T10:03:11.000Z) para exibição"""
+    if not updated_at or 'T' not in updated_at:
+        return updated_at
+    try:
+        dt = datetime.datetime.fromisoformat(updated_at.replace('Z', '+00:00'))
+        return dt.strftime('%d/%m/%Y %H:%M')
+    except ValueError:
+        return 'Data inválida'
+
+def encode_chat_cursor(contact):
+    """Cursor da página seguinte: posição (updatedAt, remoteJid) do último chat retornado"""
+    return f"{contact['updatedAt']}|{contact['remoteJid']}"
+
+def parse_offset_cursor(cursor):
+    """Offset de um cursor "o:<n>" (0 se ausente ou inválido)"""
+    try:
+        return max(0, int(cursor[2:])) if cursor and cursor.startswith('o:') else 0
+    except ValueError:
+        return 0
+
+def paginate_chats(contacts, cursor=None, search=None, limit=CHATS_PAGE_SIZE):
+    """Retorna (página, próximo cursor, total) dos chats filtrados pela busca (nome ou número)"""
+    if search:
+        term = search.strip().lower()
+        digits = re.sub(r'\D', '', term)
+        contacts = [
+            contact for contact in contacts
+            if term in contact['name'].lower()
+            or term in contact['pushName'].lower()
+            or (digits and digits in contact['remoteJid'])
+        ]
     
+    start = 0
+    if cursor and cursor.startswith('o:'):
+        # Cursor de página da Evolution quando a paginação remota falhou no meio da rolagem
+        start = min(parse_offset_cursor(cursor), len(contacts))
+    elif cursor:
+        updated_at, _, remote_jid = cursor.partition('|')
+        # Ordem: updatedAt decrescente, remoteJid crescente
+        start = next(
+            (
+                index for index, contact in enumerate(contacts)
+                if contact['updatedAt'] < updated_at
+                or (contact['updatedAt'] == updated_at and contact['remoteJid'] > remote_jid)
+            ),
+            len(contacts)
+        )
+    
+    page = [dict(contact, formatted_time=format_chat_time(contact['updatedAt'])) for contact in contacts[start:start + limit]]
+    next_cursor = encode_chat_cursor(page[-1]) if page and start + limit < len(contacts) else None
+    return page, next_cursor, len(contacts)
+
+# Histórico de mensagens paginado por messageTimestamp (mais novas após / mais antigas antes de um cursor)
+CHAT_MESSAGES_PAGE_SIZE = int(os.getenv('CHAT_MESSAGES_PAGE_SIZE', 50))
+
+def message_timestamp(msg):
+    """messageTimestamp da mensagem em segundos (aceita valores em milissegundos)"""
+    try:
+        timestamp = int(msg.get('messageTimestamp') or 0)
+    except (TypeError, ValueError):
+        return 0
+    return timestamp // 1000 if timestamp > 10 ** 12 else timestamp
+
+def message_sort_key(msg):
+    """Posição da mensagem no histórico: (messageTimestamp, id), o id desempata o mesmo segundo"""
+    return message_timestamp(msg), (msg.get('key') or {}).get('id') or ''
+
+def format_message_time(timestamp):
+    """Formata o timestamp da mensagem (horário de Brasília)
+
+    Mesma regra que a tela /mensagens sempre usou (segundos, servidor em UTC, -3h). A antiga
+    fetch_chat_messages dividia por 1000 e mostrava 1970 para os segundos que a Evolution devolve.
+    """
+    if not timestamp:
+        return 'Sem data'
+    try:
+        dt = datetime.datetime.fromtimestamp(timestamp) - datetime.timedelta(hours=3)
+        return dt.strftime('%d/%m/%Y %H:%M')
+    except (OverflowError, OSError, ValueError):
+        return 'Data inválida'
+
+def fetch_chat_messages(instance_name, remote_jid, after=None, before=None, limit=CHAT_MESSAGES_PAGE_SIZE,
+                        after_id=None, before_id=None):
+    """Busca uma página de mensagens do chat em ordem cronológica (messageTimestamp, id)
+
+    after: só mensagens com messageTimestamp >= after (polling incremental); retorna as `limit` mais
+        antigas a partir de after, para o cliente avançar com after=newest sem pular mensagens
+    before: só mensagens com messageTimestamp <= before (histórico mais antigo)
+    after_id / before_id: id da última mensagem vista no cursor; exclui o próprio cursor e o que vem
+        antes (ou depois) dele no mesmo segundo, para mais de `limit` mensagens no mesmo timestamp
+        não travarem a paginação
+    Sem cursor, retorna as `limit` mais recentes. Sem id no cursor, o cliente descarta ids repetidos do limite.
+    Páginas ficam em cache até chegar mensagem nova no chat (invalidate_chat_cache) ou expirar o TTL.
+    """
+    cache_key = ('messages', instance_name, remote_jid, after, before, limit, after_id, before_id)
+    cached = chat_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # Mensagens gravadas pelo webhook de entrada; polling (after) só fica no banco local
+    # enquanto o webhook da instância estiver entregando eventos
+    local = None
+    if after is None or inbound_feed_fresh(instance_name):
+        local = load_local_messages(instance_name, remote_jid, after, before, limit, after_id, before_id)
+    if local is not None and (local or after is not None):
+        for msg in local:
+            msg['formatted_time'] = format_message_time(msg['messageTimestamp'])
+        chat_cache.set(cache_key, local)
+        return local
+    
+    where = {"key": {"remoteJid": remote_jid}}
+    if after is not None or before is not None:
+        where["messageTimestamp"] = {
+            key: value for key, value in (("gte", after), ("lte", before)) if value is not None
+        }
+    forward = after is not None and before is None
+    
+    def find_messages(page):
+        """Uma página da Evolution (da mais recente para a mais antiga): (registros, total de páginas)"""
+        payload = {"where": where, "page": page, "offset": limit, "limit": limit}
+        response = evolution_client.post(f"/chat/findMessages/{instance_name}", json=payload)
+        if response.status_code != 200:
+            raise Exception(f"{response.status_code} - {response.text}")
+        data = response.json()
+        if isinstance(data, list):
+            return data, 1
+        records = data.get('messages', {}).get('records') or data.get('data', [])
+        return records, int(data.get('messages', {}).get('pages') or 1)
+    
+    messages = []
+    try:
+        records, pages = find_messages(1)
+        if forward and pages > 1:
+            # Polling: as mais antigas depois de after ficam nas últimas páginas
+            records, _ = find_messages(pages)
+            if len(records) < limit:
+                records = records + find_messages(pages - 1)[0]
+        for msg in records:
+            timestamp = message_timestamp(msg)
+            # Garantir o recorte mesmo se a API ignorar o filtro de timestamp
+            if (after is not None and timestamp < after) or (before is not None and timestamp > before):
+                continue
+            message_id = (msg.get('key') or {}).get('id') or ''
+            if (after_id is not None and timestamp == after and message_id <= after_id) or \
+                    (before_id is not None and timestamp == before and message_id >= before_id):
+                continue
+            msg['messageTimestamp'] = timestamp
+            msg['formatted_time'] = format_message_time(timestamp)
+            messages.append(msg)
+    except Exception as e:
+        print(f"❌ Erro ao buscar mensagens na Evolution API: {e}")
+        return []
+    
+    messages.sort(key=message_sort_key)
+    messages = messages[:limit] if forward else messages[-limit:]
+    chat_cache.set(cache_key, messages, ttl=CHAT_MESSAGES_CACHE_TTL if before is not None else CHAT_RECENT_CACHE_TTL)
+    return messages
+
+def serialize_message(msg):
+    """Campos de exibição da mensagem para a API JSON do chat"""
+    key = msg.get('key') or {}
+    content = msg.get('message') or {}
+    item = {
+        'id': key.get('id'),
+        'fromMe': bool(key.get('fromMe', msg.get('fromMe', False))),
+        'pushName': msg.get('pushName', ''),
+        'messageTimestamp': message_timestamp(msg),
+        'formatted_time': msg.get('formatted_time') or format_message_time(message_timestamp(msg)),
+        'text': None,
+        'image_url': None,
+        'label': None
+    }
+    if content.get('conversation'):
+        item['text'] = content['conversation']
+    elif (content.get('extendedTextMessage') or {}).get('text'):
+        item['text'] = content['extendedTextMessage']['text']
+    elif content.get('imageMessage'):
+        item['label'] = '📷 Imagem'
+        item['image_url'] = content['imageMessage'].get('url')
+        item['text'] = content['imageMessage'].get('caption')
+    elif content.get('videoMessage'):
+        item['label'] = '🎥 Vídeo'
+        item['text'] = content['videoMessage'].get('caption')
+    elif content.get('documentMessage'):
+        item['label'] = f"📄 {content['documentMessage'].get('fileName') or 'Documento'}"
+    elif content.get('audioMessage'):
+        item['label'] = '🎵 Áudio'
+    elif content.get('contactMessage'):
+        item['label'] = f"👤 Contato: {content['contactMessage'].get('displayName', '')}"
+    else:
+        item['label'] = '💬 Mensagem não suportada ou vazia'
+    return item
+
+def get_messages_from_chat(instance_name, remote_jid):
+    """Busca as mensagens mais recentes de um chat específico via Evolution API"""
+    return fetch_chat_messages(instance_name, remote_jid)
+
+# Webhook de entrada (MESSAGES_UPSERT): eventos enfileirados e gravados em lote no banco local
+INBOUND_WEBHOOK_TOKEN = os.getenv('INBOUND_WEBHOOK_TOKEN', '')
+# Endereço de /webhook/evolution visto pela Evolution, registrado nas instâncias criadas pelo app
+INBOUND_WEBHOOK_URL = os.getenv('INBOUND_WEBHOOK_URL', '')
+N8N_MESSAGES_WEBHOOK_URL = os.getenv('N8N_MESSAGES_WEBHOOK_URL', 'https://rede-confianca-n8n.lpl0df.easypanel.host/webhook/envia-msg-envio')
+# Sem eventos da instância há mais que isso (s), o polling de mensagens volta a consultar a Evolution
+INBOUND_STALE_AFTER = float(os.getenv('INBOUND_STALE_AFTER', 600))
+CHAT_SOURCE = os.getenv('CHAT_SOURCE', 'local')  # local (tabelas do webhook) ou evolution
+INBOUND_QUEUE_SIZE = int(os.getenv('INBOUND_QUEUE_SIZE', 100000))
+INBOUND_BATCH_SIZE = int(os.getenv('INBOUND_BATCH_SIZE', 1000))
+INBOUND_FLUSH_INTERVAL = float(os.getenv('INBOUND_FLUSH_INTERVAL', 0.5))
+INBOUND_MAX_RETRIES = int(os.getenv('INBOUND_MAX_RETRIES', 3))
+inbound_queue = queue.Queue(maxsize=INBOUND_QUEUE_SIZE)
+inbound_metrics = {'received': 0, 'stored': 0, 'dropped': 0, 'rejected': 0, 'batches': 0}
+inbound_state = {'tables_ready': False, 'writer': None, 'last_stored_at': {}}
+# Cópia única das conversas anteriores ao webhook: instância -> 'running' | 'done'
+CHAT_BACKFILL_PAGE_SIZE = int(os.getenv('CHAT_BACKFILL_PAGE_SIZE', 1000))
+chat_backfill_state = {}
+inbound_lock = threading.Lock()
+
+def ensure_chat_store_tables(cursor):
+    """Cria as tabelas locais de conversas e mensagens se ainda não existirem"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_conversas (
+            instancia VARCHAR(50) NOT NULL,
+            remote_jid VARCHAR(100) NOT NULL,
+            push_name VARCHAR(255) NULL,
+            last_message_timestamp BIGINT NOT NULL,
+            PRIMARY KEY (instancia, remote_jid),
+            INDEX idx_instancia_ultima (instancia, last_message_timestamp)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_mensagens (
+            instancia VARCHAR(50) NOT NULL,
+            message_id VARCHAR(100) NOT NULL,
+            remote_jid VARCHAR(100) NOT NULL,
+            from_me BOOLEAN NOT NULL,
+            push_name VARCHAR(255) NULL,
+            message_type VARCHAR(50) NULL,
+            message_timestamp BIGINT NOT NULL,
+            payload LONGTEXT NOT NULL,
+            PRIMARY KEY (instancia, message_id),
+            INDEX idx_chat_timestamp (instancia, remote_jid, message_timestamp)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_backfill (
+            instancia VARCHAR(50) PRIMARY KEY,
+            concluido_em DATETIME NOT NULL
+        )
+    """)
+
+def parse_upsert_event(event):
+    """Extrai as linhas de mensagem de um evento MESSAGES_UPSERT (data pode ser objeto ou lista)"""
+    if str(event.get('event', '')).lower().replace('_', '.') != 'messages.upsert':
+        return []
+    instance_name = event.get('instance')
+    data = event.get('data')
+    records = data if isinstance(data, list) else [data] if isinstance(data, dict) else []
+    
+    rows = []
+    for record in records:
+        key = record.get('key') or {}
+        remote_jid = key.get('remoteJid')
+        # Mesmo recorte da lista de chats: sem grupos e status
+        if not instance_name or not key.get('id') or not remote_jid or remote_jid.endswith(('@g.us', '@broadcast')):
+            continue
+        rows.append((
+            instance_name,
+            key['id'],
+            remote_jid,
+            bool(key.get('fromMe')),
+            record.get('pushName') or '',
+            record.get('messageType'),
+            message_timestamp(record) or int(time.time()),
+            json.dumps({field: record.get(field) for field in ('key', 'pushName', 'message', 'messageType', 'messageTimestamp')})
+        ))
+    return rows
+
+def use_local_chat_store():
+    """As telas de chat leem das tabelas locais só se o webhook de entrada estiver configurado"""
+    return CHAT_SOURCE == 'local' and bool(INBOUND_WEBHOOK_TOKEN)
+
+def inbound_feed_fresh(instance_name):
+    """True se o webhook gravou mensagens da instância há menos de INBOUND_STALE_AFTER segundos
+
+    Só então um polling vazio no banco local significa "nada novo": sem eventos recentes (webhook
+    apontando para outro lugar, processo recém-iniciado ou gravação parada) a Evolution é consultada.
+    """
+    with inbound_lock:
+        stored_at = inbound_state['last_stored_at'].get(instance_name)
+    return stored_at is not None and time.time() - stored_at < INBOUND_STALE_AFTER
+
+def prepare_chat_store(cursor):
+    """Garante as tabelas locais uma vez por processo"""
+    if not inbound_state['tables_ready']:
+        ensure_chat_store_tables(cursor)
+        inbound_state['tables_ready'] = True
+
+def store_inbound_messages(rows):
+    """Grava um lote de mensagens e atualiza as conversas (INSERT em lote)"""
+    connection = get_db_connection()
+    if not connection:
+        raise Exception('Banco indisponível')
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        prepare_chat_store(cursor)
+        
+        cursor.executemany(
+            """INSERT IGNORE INTO chat_mensagens
+               (instancia, message_id, remote_jid, from_me, push_name, message_type, message_timestamp, payload)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+            rows
+        )
+        
+        # Uma linha por conversa: mensagem mais recente e nome do contato (só de mensagens recebidas)
+        chats = {}
+        for instance_name, _, remote_jid, from_me, push_name, _, timestamp, _ in rows:
+            previous = chats.get((instance_name, remote_jid), ('', 0))
+            chats[(instance_name, remote_jid)] = (
+                push_name if push_name and not from_me else previous[0],
+                max(timestamp, previous[1])
+            )
+        cursor.executemany(
+            """INSERT INTO chat_conversas (instancia, remote_jid, push_name, last_message_timestamp)
+               VALUES (%s, %s, %s, %s)
+               ON DUPLICATE KEY UPDATE
+                   push_name = COALESCE(NULLIF(VALUES(push_name), ''), push_name),
+                   last_message_timestamp = GREATEST(last_message_timestamp, VALUES(last_message_timestamp))""",
+            [(instance_name, remote_jid, push_name, timestamp) for (instance_name, remote_jid), (push_name, timestamp) in chats.items()]
+        )
+        connection.commit()
+    finally:
+        release_db_connection(connection, cursor)
+    
+    stored_at = time.time()
+    with inbound_lock:
+        inbound_state['last_stored_at'].update((instance_name, stored_at) for instance_name, _ in chats)
+    
+    # Uma invalidação por chat e uma única da lista de chats por instância, tudo com um só lock
+    prefixes = [('messages', instance_name, remote_jid) for instance_name, remote_jid in chats]
+    prefixes.extend(('chats', instance_name) for instance_name in {instance_name for instance_name, _ in chats})
+    chat_cache.invalidate_many(prefixes)
+
+def inbound_writer_loop():
+    """Consome a fila do webhook juntando até INBOUND_BATCH_SIZE mensagens ou INBOUND_FLUSH_INTERVAL segundos"""
+    while True:
+        batch = list(inbound_queue.get())
+        deadline = time.time() + INBOUND_FLUSH_INTERVAL
+        while len(batch) < INBOUND_BATCH_SIZE:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.extend(inbound_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        
+        for attempt in range(INBOUND_MAX_RETRIES + 1):
+            try:
+                store_inbound_messages(batch)
+                with inbound_lock:
+                    inbound_metrics['stored'] += len(batch)
+                    inbound_metrics['batches'] += 1
+                break
+            except Exception as e:
+                print(f"Erro ao gravar lote de {len(batch)} mensagens (tentativa {attempt + 1}): {e}")
+                time.sleep(min(10, 2 ** attempt))
+        else:
+            with inbound_lock:
+                inbound_metrics['dropped'] += len(batch)
+
+def start_inbound_writer():
+    """Inicia a thread de gravação do webhook no primeiro evento recebido"""
+    with inbound_lock:
+        if inbound_state['writer'] is None:
+            inbound_state['writer'] = threading.Thread(target=inbound_writer_loop, daemon=True, name='inbound-writer')
+            inbound_state['writer'].start()
+
+def chat_updated_at_timestamp(updated_at):
+    """updatedAt ISO da Evolution em segundos (0 se ausente ou inválido)"""
+    try:
+        return int(datetime.datetime.fromisoformat(updated_at.replace('Z', '+00:00')).timestamp())
+    except (AttributeError, ValueError):
+        return 0
+
+def backfill_local_chats(instance_name):
+    """Copia para chat_conversas, página a página, as conversas que já existiam na Evolution antes do webhook"""
+    offset = 0
+    total = 0
+    try:
+        while True:
+            fetched = fetch_chats_page(instance_name, offset, CHAT_BACKFILL_PAGE_SIZE)
+            if fetched is None:
+                # Evolution sem take/skip: a lista inteira uma única vez, aqui em background
+                contacts, has_more = get_contacts_from_instance(instance_name), False
+            else:
+                contacts, has_more = fetched
+            
+            connection = get_db_connection()
+            if not connection:
+                raise Exception('Banco indisponível')
+            cursor = None
+            try:
+                cursor = connection.cursor()
+                prepare_chat_store(cursor)
+                if contacts:
+                    # Dados vindos do webhook têm prioridade sobre os da cópia
+                    cursor.executemany(
+                        """INSERT INTO chat_conversas (instancia, remote_jid, push_name, last_message_timestamp)
+                           VALUES (%s, %s, %s, %s)
+                           ON DUPLICATE KEY UPDATE
+                               push_name = COALESCE(NULLIF(push_name, ''), VALUES(push_name)),
+                               last_message_timestamp = GREATEST(last_message_timestamp, VALUES(last_message_timestamp))""",
+                        [
+                            (instance_name, contact['remoteJid'], contact['pushName'], chat_updated_at_timestamp(contact['updatedAt']))
+                            for contact in contacts
+                        ]
+                    )
+                if not has_more:
+                    cursor.execute(
+                        "REPLACE INTO chat_backfill (instancia, concluido_em) VALUES (%s, UTC_TIMESTAMP())",
+                        (instance_name,)
+                    )
+                connection.commit()
+            finally:
+                release_db_connection(connection, cursor)
+            
+            total += len(contacts)
+            offset += CHAT_BACKFILL_PAGE_SIZE
+            if not has_more:
+                break
+        
+        with inbound_lock:
+            chat_backfill_state[instance_name] = 'done'
+        chat_cache.invalidate('chats', instance_name)
+        print(f"📥 Conversas da instância {instance_name} copiadas da Evolution: {total}")
+    except Exception as e:
+        print(f"Erro ao copiar conversas da instância {instance_name}: {e}")
+        with inbound_lock:
+            chat_backfill_state.pop(instance_name, None)
+
+def local_chats_ready(instance_name):
+    """True se a lista de chats da instância pode vir só das tabelas locais
+
+    Na primeira consulta de cada instância inicia a cópia das conversas antigas em
+    background; até ela terminar a lista continua vindo da Evolution.
+    """
+    if not use_local_chat_store():
+        return False
+    with inbound_lock:
+        state = chat_backfill_state.get(instance_name)
+    if state is not None:
+        return state == 'done'
+    
+    connection = get_db_connection()
+    if not connection:
+        return False
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        prepare_chat_store(cursor)
+        cursor.execute("SELECT 1 FROM chat_backfill WHERE instancia = %s", (instance_name,))
+        done = cursor.fetchone() is not None
+    except Error as e:
+        print(f"Erro ao consultar cópia de conversas: {e}")
+        return False
+    finally:
+        release_db_connection(connection, cursor)
+    
+    with inbound_lock:
+        if instance_name in chat_backfill_state:
+            return chat_backfill_state[instance_name] == 'done'
+        chat_backfill_state[instance_name] = 'done' if done else 'running'
+    if not done:
+        threading.Thread(target=backfill_local_chats, args=(instance_name,), daemon=True, name=f'backfill-{instance_name}').start()
+    return done
+
+# (a, b) < (x, y) escrito por extenso: o MySQL não usa o índice na comparação de tuplas
+CHATS_KEYSET_CONDITION = " AND (last_message_timestamp < %s OR (last_message_timestamp = %s AND remote_jid < %s))"
+
+def load_local_chats(instance_name, cursor=None, search=None, limit=CHATS_PAGE_SIZE):
+    """Uma página das conversas locais (mesmo formato de get_instance_chats): (chats, próximo cursor, total)
+
+    Ordem (last_message_timestamp, remote_jid) decrescente, paginada por keyset com LIMIT
+    sobre o índice (instancia, last_message_timestamp). Cursor "t:<timestamp>|<remote_jid>".
+    O total (COUNT) fica em cache por instância e busca, não é recontado a cada página.
+    """
+    if not use_local_chat_store():
+        return None
+    
+    where = "instancia = %s"
+    params = [instance_name]
+    if search:
+        term = search.strip()
+        digits = re.sub(r'\D', '', term)
+        if digits:
+            where += " AND (push_name LIKE %s OR remote_jid LIKE %s)"
+            params.extend([f"%{term}%", f"%{digits}%"])
+        else:
+            where += " AND push_name LIKE %s"
+            params.append(f"%{term}%")
+    
+    page_where = where
+    page_params = list(params)
+    offset = 0
+    if cursor and cursor.startswith('t:'):
+        timestamp, _, remote_jid = cursor[2:].partition('|')
+        timestamp = int(timestamp) if timestamp.isdigit() else 0
+        page_where += CHATS_KEYSET_CONDITION
+        page_params.extend([timestamp, timestamp, remote_jid])
+    elif cursor and cursor.startswith('o:'):
+        # Cursores de páginas que vieram da Evolution antes de a cópia local terminar
+        offset = parse_offset_cursor(cursor)
+    elif cursor:
+        updated_at, _, remote_jid = cursor.partition('|')
+        timestamp = chat_updated_at_timestamp(updated_at)
+        page_where += CHATS_KEYSET_CONDITION
+        page_params.extend([timestamp, timestamp, remote_jid])
+    
+    connection = get_db_connection()
+    if not connection:
+        return None
+    db_cursor = None
+    try:
+        db_cursor = connection.cursor(dictionary=True)
+        prepare_chat_store(db_cursor)
+        db_cursor.execute(
+            f"""SELECT remote_jid, push_name, last_message_timestamp FROM chat_conversas
+               WHERE {page_where}
+               ORDER BY last_message_timestamp DESC, remote_jid DESC
+               LIMIT %s OFFSET %s""",
+            page_params + [limit + 1, offset]
+        )
+        rows = db_cursor.fetchall()
+        total = chat_cache.get(('chats', instance_name, 'total', search))
+        if total is None:
+            db_cursor.execute(f"SELECT COUNT(*) AS total FROM chat_conversas WHERE {where}", params)
+            total = db_cursor.fetchone()['total']
+            chat_cache.set(('chats', instance_name, 'total', search), total, ttl=CHATS_LIST_TTL)
+    except Error as e:
+        print(f"Erro ao ler conversas locais: {e}")
+        return None
+    finally:
+        release_db_connection(connection, db_cursor)
+    
+    page = []
+    for row in rows[:limit]:
+        updated_at = datetime.datetime.fromtimestamp(row['last_message_timestamp'], datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        page.append({
+            'remoteJid': row['remote_jid'],
+            'profilePicUrl': '',
+            'name': row['push_name'] or row['remote_jid'].split('@')[0],
+            'pushName': row['push_name'] or '',
+            'updatedAt': updated_at,
+            'formatted_time': format_chat_time(updated_at)
+        })
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = f"t:{last['last_message_timestamp']}|{last['remote_jid']}"
+    return page, next_cursor, total
+
+def load_local_messages(instance_name, remote_jid, after=None, before=None, limit=CHAT_MESSAGES_PAGE_SIZE,
+                        after_id=None, before_id=None):
+    """Página de mensagens gravadas pelo webhook (mesmo recorte de fetch_chat_messages), em ordem cronológica
+
+    Ordem (message_timestamp, message_id): no InnoDB o índice (instancia, remote_jid, message_timestamp)
+    já termina na chave primária, então o desempate pelo id também sai do índice.
+    """
+    if not use_local_chat_store():
+        return None
+    connection = get_db_connection()
+    if not connection:
+        return None
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        prepare_chat_store(cursor)
+        query = "SELECT payload, message_timestamp FROM chat_mensagens WHERE instancia = %s AND remote_jid = %s"
+        params = [instance_name, remote_jid]
+        if after is not None and after_id is not None:
+            query += " AND (message_timestamp > %s OR (message_timestamp = %s AND message_id > %s))"
+            params.extend([after, after, after_id])
+        elif after is not None:
+            query += " AND message_timestamp >= %s"
+            params.append(after)
+        if before is not None and before_id is not None:
+            query += " AND (message_timestamp < %s OR (message_timestamp = %s AND message_id < %s))"
+            params.extend([before, before, before_id])
+        elif before is not None:
+            query += " AND message_timestamp <= %s"
+            params.append(before)
+        # Polling (só after) avança a partir das mais antigas; os demais recortes pegam as mais recentes
+        forward = after is not None and before is None
+        direction = 'ASC' if forward else 'DESC'
+        query += f" ORDER BY message_timestamp {direction}, message_id {direction} LIMIT %s"
+        params.append(limit)
+        cursor.execute(query, params)
+        
+        rows = cursor.fetchall()
+        messages = []
+        for payload, timestamp in (rows if forward else reversed(rows)):
+            msg = json.loads(payload)
+            msg['messageTimestamp'] = timestamp
+            messages.append(msg)
+        return messages
+    except Error as e:
+        print(f"Erro ao ler mensagens locais: {e}")
+        return None
+    finally:
+        release_db_connection(connection, cursor)
+
+def update_whatsapp_number_description(numero_id, new_description, link_planilha=None):
+    """Atualiza a descrição e link da planilha de um número do WhatsApp"""
+    connection = get_db_connection()
+    if not connection:
+        return False
+    
+    try:
+        cursor = connection.cursor()
+        if link_planilha is not None:
+            query = "UPDATE numeros SET descricao = %s, link_planilha = %s WHERE id = %s"
+            cursor.execute(query, (new_description, link_planilha, numero_id))
+        else:
+            query = "UPDATE numeros SET descricao = %s WHERE id = %s"
+            cursor.execute(query, (new_description, numero_id))
+        connection.commit()
+        return True
+    except Error as e:
+        print(f"Erro ao atualizar descrição: {e}")
+        return False
+    finally:
+        release_db_connection(connection, cursor)
+
+def delete_whatsapp_number(numero_id):
+    """Remove um número do WhatsApp do banco de dados"""
+    connection = get_db_connection()
+    if not connection:
+        return False
+    
+    try:
+        cursor = connection.cursor()
+        query = "DELETE FROM numeros WHERE id = %s"
+        cursor.execute(query, (numero_id,))
+        connection.commit()
+        return cursor.rowcount > 0  # Retorna True se algum registro foi deletado
+    except Error as e:
+        print(f"Erro ao remover número: {e}")
+        return False
+    finally:
+        release_db_connection(connection, cursor)
+
+# Configuração do banco de dados
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+db_pools = {}
+db_pool_metrics = {}
+db_pools_lock = threading.Lock()
+
+def get_pooled_connection(pool_name, pool_size, **config):
+    """Empresta uma conexão do pool (criado sob demanda), validando-a antes de entregar"""
+    with db_pools_lock:
+        metrics = db_pool_metrics.setdefault(pool_name, {
+            'pool_size': pool_size,
+            'borrowed': 0,
+            'exhausted': 0,
+            'timeouts': 0,
+            'invalid': 0
+        })
+        pool = db_pools.get(pool_name)
+        if pool is None:
+            pool = pooling.MySQLConnectionPool(
+                pool_name=pool_name,
+                pool_size=pool_size,
+                pool_reset_session=True,
+                **config
+            )
+            db_pools[pool_name] = pool
+    
+    deadline = time.time() + DB_POOL_TIMEOUT
+    while True:
+        try:
+            connection = pool.get_connection()
+        except PoolError:
+            # Pool esgotado: aguarda uma conexão ser devolvida até o prazo
+            with db_pools_lock:
+                metrics['exhausted'] += 1
+            if time.time() >= deadline:
+                with db_pools_lock:
+                    metrics['timeouts'] += 1
+                raise
+            time.sleep(0.05)
+            continue
+        
+        # Validar a conexão antes de entregar (o servidor pode ter encerrado por inatividade)
+        try:
+            connection.ping(reconnect=False)
+        except Error:
+            with db_pools_lock:
+                metrics['invalid'] += 1
+            try:
+                connection.reconnect(attempts=1, delay=0)
+            except Error:
+                release_db_connection(connection)
+                raise
+        
+        with db_pools_lock:
+            metrics['borrowed'] += 1
+        return connection
+
+def release_db_connection(connection, cursor=None):
+    """Fecha o cursor e devolve a conexão ao pool, mesmo que ela tenha caído"""
+    try:
+        if cursor is not None:
+            cursor.close()
+    except Error:
+        pass
+    try:
+        connection.close()
+    except Error:
+        pass
+
+def get_db_connection():
+    """Conexão com o banco principal do sistema"""
+    try:
+        return get_pooled_connection(
+            'sistema',
+            int(os.getenv('DB_POOL_SIZE', 5)),
+            host=os.getenv('DB_HOST', 'localhost'),
+            database=os.getenv('DB_NAME', 'whatsapp'),
+            user=os.getenv('DB_USER', 'root'),
+            password=os.getenv('DB_PASSWORD', ''),
+            #port=int(os.getenv('DB_PORT', 3306))
+        )
+    except Error as e:
+        print(f"Erro ao conectar ao MySQL (sistema): {e}")
+        return None
+
+def get_evolution_db_connection():
+    """Conexão com o banco da Evolution API"""
+    try:
+        return get_pooled_connection(
+            'evolution',
+            int(os.getenv('EVOLUTION_DB_POOL_SIZE', 5)),
+            host=os.getenv('EVOLUTION_DB_HOST', 'localhost'),
+            database=os.getenv('EVOLUTION_DB_NAME', 'evolution'),
+            user=os.getenv('EVOLUTION_DB_USER', 'root'),
+            password=os.getenv('EVOLUTION_DB_PASSWORD', ''),
+            #port=int(os.getenv('EVOLUTION_DB_PORT', 3306))
+        )
+    except Error as e:
+        print(f"Erro ao conectar ao MySQL (Evolution): {e}")
+        return None
+
+def get_db_pool_metrics():
+    """Retorna as métricas de uso dos pools de conexão"""
+    with db_pools_lock:
+        return {name: dict(metrics) for name, metrics in db_pool_metrics.items()}
+
+def apply_instance_status(number, status):
+    """Preenche status e classe CSS do número a partir do status da Evolution (None = desconhecido)"""
+    if status is None:
+        number['status'] = 'Desconhecido'
+        number['status_class'] = 'unknown'
+    elif status in ['open', 'connected']:
+        number['status'] = 'Conectado'
+        number['status_class'] = 'connected'
+    elif status == 'connecting':
+        number['status'] = 'Conectando'
+        number['status_class'] = 'connecting'
+    else:
+        number['status'] = 'Desconectado'
+        number['status_class'] = 'disconnected'
+
+def get_whatsapp_numbers():
+    """Busca todos os números do WhatsApp cadastrados com status da Evolution"""
+    connection = get_db_connection()
+    if not connection:
+        return []
+    
+    try:
+        cursor = connection.cursor(dictionary=True)
+        # Buscar dados da tabela numeros do sistema principal
+        query = "SELECT * FROM numeros ORDER BY id"
+        cursor.execute(query)
+        numbers = cursor.fetchall()
+    except Error as e:
+        print(f"Erro ao buscar números: {e}")
+        return []
+    finally:
+        # Devolver a conexão ao pool antes das verificações de status
+        release_db_connection(connection, cursor)
+    
+    print(f"Números encontrados no banco principal: {len(numbers)}")
+    
+    if instance_monitor_state['running'] and instances_snapshot_is_fresh():
+        # Monitor ativo com snapshot recente: status vem da memória, sem nenhuma chamada HTTP
+        with instances_snapshot_lock:
+            statuses = dict(instances_snapshot['instances'])
+        for number in numbers:
+            # Instância ausente do fetchInstances não existe (mais) na Evolution
+            apply_instance_status(number, statuses.get(number['instancia'], 'close'))
+            number['history'] = get_instance_history(number['instancia'])
+        return numbers
+    
+    # Sem monitor: verificar status de todas as instâncias em paralelo, com prazo total.
+    # Com o monitor e snapshot velho ou vazio (Evolution falhando), consulta cada instância direto.
+    deadline = time.time() + STATUS_CHECK_DEADLINE
+    monitor_running = instance_monitor_state['running']
+    
+    def check_status(instance_name):
+        # Uma tarefa em execução não pode ser cancelada: ela mesma desiste depois do prazo
+        # e cada consulta HTTP fica limitada ao tempo que resta, sem prender o worker
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        if monitor_running:
+            return fetch_connection_state(instance_name, fallback=False, timeout=remaining)
+        return get_instance_status(instance_name, timeout=remaining)
+    
+    futures = {
+        status_executor.submit(check_status, number['instancia']): number
+        for number in numbers
+    }
+    not_done = wait(futures, timeout=max(0, deadline - time.time())).not_done
+    
+    for future, number in futures.items():
+        if future in not_done:
+            future.cancel()
+            print(f"Prazo esgotado ao verificar status da instância {number['instancia']}")
+            apply_instance_status(number, None)
+            continue
+        try:
+            apply_instance_status(number, future.result())
+        except Exception as e:
+            print(f"Erro ao verificar status da instância {number['instancia']}: {e}")
+            apply_instance_status(number, 'close')
+    
+    return numbers
+
+def create_whatsapp_number(numero, remotejid, descricao, instancia, link_planilha=None):
+    """Cria um novo número do WhatsApp"""
+    connection = get_db_connection()
+    if not connection:
+        return False
+    
+    try:
+        cursor = connection.cursor()
+        # Usar a tabela correta: numeros
+        query = "INSERT INTO numeros (numero, remotejid, descricao, instancia, link_planilha) VALUES (%s, %s, %s, %s, %s)"
+        cursor.execute(query, (numero, remotejid, descricao, instancia, link_planilha))
+        connection.commit()
+        return True
+    except Error as e:
+        print(f"Erro ao criar número: {e}")
+        return False
+    finally:
+        release_db_connection(connection, cursor)
+
+# Importação de leads da planilha (streaming, uma linha por vez)
+LEAD_COLUMNS = {
+    'filial': 'Filial',
+    'data': 'Data',
+    'nome': 'Nome Cliente',
+    'plano': 'Plano',
+    'telefone': 'Acesso',
+    'complemento': 'Complemento'
+}
+
+def format_lead_value(value):
+    """Converte o valor da célula para texto (vazio se não preenchido)"""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, str):
+        return value.strip()
+    return str(value)
+
+def iter_leads_from_excel(excel_file):
+    """Lê a planilha em modo read-only e gera os leads normalizados um a um (memória constante)"""
+    workbook = load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header:
+            return
+        
+        # Índice de cada coluna necessária (colunas ausentes ficam vazias)
+        positions = {str(name).strip(): i for i, name in enumerate(header) if name is not None}
+        columns = [(key, positions.get(column)) for key, column in LEAD_COLUMNS.items()]
+        
+        for row in rows:
+            lead = {
+                key: format_lead_value(row[index]) if index is not None and index < len(row) else ''
+                for key, index in columns
+            }
+            # Ignorar linhas totalmente vazias
+            if any(lead.values()):
+                yield lead
+    finally:
+        workbook.close()
+
+def iter_chunks(items, size):
+    """Agrupa um iterável em listas de até `size` itens, sem materializar tudo"""
+    items = iter(items)
+    chunk = list(itertools.islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(items, size))
+
+# Normalização dos telefones (coluna Acesso) em blocos vetorizados com numpy/pandas
+PHONE_COUNTRY_CODE = os.getenv('PHONE_COUNTRY_CODE', '55')
+PHONE_NORMALIZE_BLOCK = int(os.getenv('PHONE_NORMALIZE_BLOCK', 100000))
+PHONE_MAX_DIGITS = 18
+
+def normalize_phone_numbers(values):
+    """Normaliza telefones para números E.164 (sem '+') em operações vetorizadas; inválidos viram 0
+
+    Os textos são concatenados (um por linha) num único buffer de bytes e os dígitos de cada
+    linha viram um inteiro. Valores com cara de float do Excel (só dígitos e um único ponto)
+    perdem a parte decimal se ela for só de zeros e ficam inválidos caso contrário
+    (119999.9999); nos demais, os outros caracteres são ignorados. Zeros de discagem à
+    esquerda (011...) não contam e números com DDD (10 ou 11 dígitos) ganham o código do país.
+    """
+    count = len(values)
+    if not count:
+        return np.zeros(0, dtype=np.int64)
+    try:
+        text = '\n'.join(values)
+    except TypeError:
+        text = '\n'.join(map(str, values))
+    if text.count('\n') != count - 1:
+        text = '\n'.join(str(value).replace('\n', ' ') for value in values)
+    codes = np.frombuffer(text.encode('ascii', 'replace') + b'\n', dtype=np.uint8)
+    
+    # Dígitos de cada linha alinhados à direita numa matriz de largura fixa
+    newline = codes == 10
+    selected = newline | ((codes >= 48) & (codes <= 57))
+    compact = codes[selected] - np.uint8(48)
+    ends = np.flatnonzero(newline[selected])
+    digits = np.diff(ends, prepend=-1) - 1
+    columns = np.arange(PHONE_MAX_DIGITS, 0, -1)
+    matrix = compact.take(ends[:, None] - columns, mode='clip')
+    matrix *= columns <= digits[:, None]
+    numbers = matrix.astype(np.int64) @ 10 ** (columns - 1)
+    valid = digits <= PHONE_MAX_DIGITS
+    
+    # Linhas com cara de float: exatamente um ponto e todo o resto dígitos
+    dot_at = np.flatnonzero(codes == 46)
+    if len(dot_at):
+        row_ends = np.flatnonzero(newline)
+        dot_rows = np.searchsorted(row_ends, dot_at)
+        dots = np.bincount(dot_rows, minlength=count)
+        float_rows = (dots == 1) & (np.diff(row_ends, prepend=-1) - 1 - digits == 1)
+        dot_at, dot_rows = dot_at[float_rows[dot_rows]], dot_rows[float_rows[dot_rows]]
+        # Linhas com mais de PHONE_MAX_DIGITS dígitos já são inválidas: o expoente só não pode estourar
+        scale = 10 ** np.minimum(row_ends[dot_rows] - dot_at - 1, PHONE_MAX_DIGITS)
+        valid[dot_rows] &= numbers[dot_rows] % scale == 0
+        numbers[dot_rows] //= scale
+    
+    prefix, prefix_length = int(PHONE_COUNTRY_CODE), len(PHONE_COUNTRY_CODE)
+    lengths = np.searchsorted(10 ** np.arange(PHONE_MAX_DIGITS + 1, dtype=np.int64), numbers, side='right')
+    local = (lengths == 10) | (lengths == 11)
+    numbers[local] += prefix * 10 ** lengths[local]
+    lengths += prefix_length * local
+    valid &= (lengths == 12) | (lengths == 13)
+    valid &= numbers // 10 ** np.clip(lengths - prefix_length, 0, PHONE_MAX_DIGITS) == prefix
+    return np.where(valid, numbers, 0)
+
+def normalize_leads(leads, stats):
+    """Normaliza os telefones dos leads, descarta inválidos e duplicados e acumula as contagens em `stats`"""
+    stats.setdefault('leads_invalid', 0)
+    stats.setdefault('leads_duplicated', 0)
+    seen = set()
+    for block in iter_chunks(leads, PHONE_NORMALIZE_BLOCK):
+        phones = normalize_phone_numbers([lead['telefone'] for lead in block])
+        invalid = phones == 0
+        duplicated = ~invalid & pd.Series(phones).duplicated().to_numpy()
+        repeated = seen.intersection(phones.tolist())
+        if repeated:
+            # Duplicados de blocos anteriores (interseção com o set é mais barata que isin com set grande)
+            duplicated |= np.isin(phones, np.fromiter(repeated, dtype=np.int64, count=len(repeated)))
+        stats['leads_invalid'] += int(invalid.sum())
+        stats['leads_duplicated'] += int(duplicated.sum())
+        
+        keep = ~(invalid | duplicated)
+        accepted = phones[keep].tolist()
+        seen.update(accepted)
+        kept = list(itertools.compress(block, keep))
+        for lead, phone in zip(kept, map(str, accepted)):
+            lead['telefone'] = phone
+            lead['remoteJid'] = phone + '@s.whatsapp.net'
+        yield from kept
+
+# Verificação prévia (em lotes) de quais números têm WhatsApp, com cache no banco
+WHATSAPP_PRECHECK_DEFAULT = os.getenv('WHATSAPP_PRECHECK_DEFAULT', 'False').lower() == 'true'
+WHATSAPP_CHECK_BATCH_SIZE = int(os.getenv('WHATSAPP_CHECK_BATCH_SIZE', 200))
+WHATSAPP_CHECK_CONCURRENCY = int(os.getenv('WHATSAPP_CHECK_CONCURRENCY', 4))
+WHATSAPP_CHECK_TTL = datetime.timedelta(days=int(os.getenv('WHATSAPP_CHECK_TTL_DAYS', 30)))
+WHATSAPP_CHECK_BLOCK = int(os.getenv('WHATSAPP_CHECK_BLOCK', 2000))
+whatsapp_checks_state = {'table_ready': False}
+
+def ensure_whatsapp_checks_table(cursor):
+    """Cria a tabela de cache da verificação de números se ainda não existir"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS whatsapp_checks (
+            numero VARCHAR(20) PRIMARY KEY,
+            existe BOOLEAN NOT NULL,
+            jid VARCHAR(100) NULL,
+            checked_at DATETIME NOT NULL,
+            INDEX idx_checked_at (checked_at)
+        )
+    """)
+
+def prepare_whatsapp_checks_table(cursor):
+    """Garante a tabela de cache uma vez por processo"""
+    if not whatsapp_checks_state['table_ready']:
+        ensure_whatsapp_checks_table(cursor)
+        whatsapp_checks_state['table_ready'] = True
+
+def load_cached_whatsapp_checks(numbers):
+    """Busca no cache os números verificados dentro do TTL: {numero: (existe, jid)}"""
+    connection = get_db_connection()
+    if not connection:
+        return {}
+    cursor = None
+    cached = {}
+    try:
+        cursor = connection.cursor()
+        prepare_whatsapp_checks_table(cursor)
+        since = datetime.datetime.utcnow() - WHATSAPP_CHECK_TTL
+        for batch in iter_chunks(numbers, 1000):
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(
+                f"SELECT numero, existe, jid FROM whatsapp_checks WHERE numero IN ({placeholders}) AND checked_at >= %s",
+                (*batch, since)
+            )
+            for numero, existe, jid in cursor.fetchall():
+                cached[numero] = (bool(existe), jid)
+    except Error as e:
+        print(f"Erro ao consultar cache de verificação: {e}")
+    finally:
+        release_db_connection(connection, cursor)
+    return cached
+
+def save_whatsapp_checks(results):
+    """Grava (ou renova) no cache o resultado das verificações"""
+    if not results:
+        return
+    connection = get_db_connection()
+    if not connection:
+        return
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        prepare_whatsapp_checks_table(cursor)
+        now = datetime.datetime.utcnow()
+        cursor.executemany(
+            """INSERT INTO whatsapp_checks (numero, existe, jid, checked_at) VALUES (%s, %s, %s, %s)
+               ON DUPLICATE KEY UPDATE existe = VALUES(existe), jid = VALUES(jid), checked_at = VALUES(checked_at)""",
+            [(numero, existe, jid, now) for numero, (existe, jid) in results.items()]
+        )
+        connection.commit()
+    except Error as e:
+        print(f"Erro ao gravar cache de verificação: {e}")
+    finally:
+        release_db_connection(connection, cursor)
+
+def fetch_whatsapp_numbers_batch(instance_name, numbers):
+    """Consulta na Evolution API quais números do lote têm WhatsApp: {numero: (existe, jid)}"""
+    response = evolution_client.post(f"/chat/whatsappNumbers/{instance_name}", json={'numbers': numbers})
+    response.raise_for_status()
+    
+    body = response.json()
+    if not isinstance(body, list):
+        # Resposta inesperada (ex: objeto de erro com status 200): o lote fica sem verificação
+        raise ValueError(f"resposta inesperada da Evolution: {str(body)[:200]}")
+    
+    requested = set(numbers)
+    results = {}
+    for item in body:
+        if not isinstance(item, dict):
+            continue
+        jid = item.get('jid')
+        # A Evolution pode devolver o número em outro formato (ex: sem o 9º dígito); casar pelo jid se preciso
+        numero = str(item.get('number', ''))
+        if numero not in requested and jid:
+            numero = jid.split('@')[0]
+        if numero in requested:
+            results[numero] = (bool(item.get('exists')), jid if item.get('exists') else None)
+    return results
+
+def check_whatsapp_numbers(instance_name, numbers):
+    """Verifica os números (cache + Evolution em lotes paralelos); números sem resposta ficam de fora"""
+    results = load_cached_whatsapp_checks(numbers)
+    missing = [numero for numero in numbers if numero not in results]
+    if not missing:
+        return results
+    
+    checked = {}
+    batches = list(iter_chunks(missing, WHATSAPP_CHECK_BATCH_SIZE))
+    with ThreadPoolExecutor(max_workers=min(WHATSAPP_CHECK_CONCURRENCY, len(batches)), thread_name_prefix='whatsapp-check') as executor:
+        futures = {executor.submit(fetch_whatsapp_numbers_batch, instance_name, batch): batch for batch in batches}
+        for future in futures:
+            try:
+                checked.update(future.result())
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Erro ao verificar lote de {len(futures[future])} números na instância {instance_name}: {e}")
+    
+    save_whatsapp_checks(checked)
+    results.update(checked)
+    return results
+
+def precheck_leads(leads, instance_name, stats):
+    """Descarta os leads sem WhatsApp; números que não puderam ser verificados seguem para o envio"""
+    stats.setdefault('leads_not_on_whatsapp', 0)
+    stats.setdefault('leads_unchecked', 0)
+    for block in iter_chunks(leads, WHATSAPP_CHECK_BLOCK):
+        results = check_whatsapp_numbers(instance_name, [lead['telefone'] for lead in block])
+        for lead in block:
+            result = results.get(lead['telefone'])
+            if result is None:
+                stats['leads_unchecked'] += 1
+            elif not result[0]:
+                stats['leads_not_on_whatsapp'] += 1
+                continue
+            elif result[1]:
+                # jid real do WhatsApp (pode diferir do número da planilha)
+                lead['remoteJid'] = result[1]
+            yield lead
+
+# Personalização das mensagens (@variáveis) feita no servidor
+MESSAGE_RENDER_DEFAULT = os.getenv('MESSAGE_RENDER_DEFAULT', 'False').lower() == 'true'
+MESSAGE_PREVIEW_LIMIT = int(os.getenv('MESSAGE_PREVIEW_LIMIT', 5))
+# Variáveis mais longas primeiro para que @nome não "roube" o início de outra variável
+MESSAGE_VARIABLE_PATTERN = re.compile('@(' + '|'.join(sorted(LEAD_COLUMNS, key=len, reverse=True)) + ')')
+
+class MessageTemplate:
+    """Template de mensagem compilado uma vez: textos fixos intercalados com as chaves do lead"""
+    
+    def __init__(self, template):
+        self.template = template
+        # split com grupo de captura: [texto, chave, texto, chave, ..., texto]
+        parts = MESSAGE_VARIABLE_PATTERN.split(template)
+        self.head = parts[0]
+        self.plan = list(zip(parts[1::2], parts[2::2]))
+        self.variables = sorted({key for key, _ in self.plan})
+    
+    def render(self, lead):
+        """Substitui as variáveis do template pelos valores do lead"""
+        if not self.plan:
+            return self.head
+        return self.head + ''.join(lead[key] + text for key, text in self.plan)
+
+def compile_message_templates(*templates):
+    """Compila as variações de mensagem preenchidas (a principal é obrigatória)"""
+    return [MessageTemplate(template) for template in templates if template]
+
+def choose_message_variant(lead, variant_count, index):
+    """Escolhe a variação de forma determinística pelo telefone (ou pela posição do lead)"""
+    if variant_count == 1:
+        return 0
+    key = lead.get('telefone') or str(index)
+    return zlib.crc32(key.encode('utf-8')) % variant_count
+
+def render_campaign_messages(templates, leads):
+    """Gera os leads com a mensagem final (`mensagem`) e a variação usada (`variante`, a partir de 1)"""
+    variant_count = len(templates)
+    for index, lead in enumerate(leads):
+        variant = choose_message_variant(lead, variant_count, index)
+        yield dict(lead, mensagem=templates[variant].render(lead), variante=variant + 1)
+
+def preview_campaign_messages(templates, leads, limit=MESSAGE_PREVIEW_LIMIT):
+    """Renderiza apenas os primeiros `limit` leads para conferência antes do disparo"""
+    return list(itertools.islice(render_campaign_messages(templates, leads), limit))
+
+# Divisão de uma campanha entre várias instâncias (números) conectadas
+SHARD_STATUS_INTERVAL = float(os.getenv('SHARD_STATUS_INTERVAL', 15))
+SHARD_ERROR_WINDOW = int(os.getenv('SHARD_ERROR_WINDOW', 50))
+
+class InstanceBalancer:
+    """Distribui os envios entre instâncias por round-robin ponderado suave
+
+    O peso de cada instância vem do status (só 'open' recebe envios) e da taxa de erro
+    recente; o status é reconsultado periodicamente, então uma instância que desconecta
+    no meio da campanha deixa de receber leads e as demais absorvem o volume.
+    """
+    
+    def __init__(self, instances, status_getter=None):
+        self.instances = list(dict.fromkeys(instances))
+        self.status_getter = status_getter or get_instance_status
+        self.statuses = {}
+        self.results = {name: collections.deque(maxlen=SHARD_ERROR_WINDOW) for name in self.instances}
+        self.current = {name: 0.0 for name in self.instances}
+        self.assigned = {name: 0 for name in self.instances}
+        self.checked_at = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+    
+    def needs_refresh(self):
+        """Status ainda não consultado ou intervalo expirado (chamado com o lock)"""
+        return self.checked_at is None or time.time() - self.checked_at >= SHARD_STATUS_INTERVAL
+    
+    def refresh_statuses(self, force=False):
+        """Reconsulta o status das instâncias se o intervalo expirou
+
+        Só uma thread consulta por vez. Enquanto não houver nenhum status, as demais esperam
+        (sem status todos os pesos seriam 0); depois, seguem com o status anterior.
+        """
+        with self.lock:
+            if not force and not self.needs_refresh():
+                return
+            loaded = bool(self.statuses)
+        if not self.refresh_lock.acquire(blocking=not loaded):
+            return
+        try:
+            with self.lock:
+                # Outra thread pode ter consultado enquanto esta esperava
+                if not force and not self.needs_refresh():
+                    return
+            statuses = {name: self.status_getter(name) for name in self.instances}
+            with self.lock:
+                self.statuses = statuses
+                self.checked_at = time.time()
+        finally:
+            self.refresh_lock.release()
+    
+    def weight(self, name):
+        """Peso atual da instância (chamado com o lock)"""
+        if self.statuses.get(name) != 'open':
+            return 0.0
+        results = self.results[name]
+        error_rate = results.count(False) / len(results) if results else 0.0
+        return max(0.05, 1.0 - error_rate)
+    
+    def choose(self, exclude=()):
+        """Escolhe a próxima instância; se o status confirmar que nenhuma está conectada, reveza entre todas"""
+        self.refresh_statuses()
+        with self.lock:
+            candidates = [name for name in self.instances if name not in exclude]
+            if not candidates:
+                return None
+            weights = {name: self.weight(name) for name in candidates}
+            if not any(weights.values()):
+                weights = dict.fromkeys(candidates, 1.0)
+            total = sum(weights.values())
+            for name, weight in weights.items():
+                self.current[name] += weight
+            chosen = max(weights, key=lambda name: self.current[name])
+            self.current[chosen] -= total
+            self.assigned[chosen] += 1
+            return chosen
+    
+    def record(self, name, ok):
+        """Registra o resultado de um envio; falhas forçam nova consulta de status"""
+        with self.lock:
+            self.results[name].append(ok)
+            if not ok:
+                self.checked_at = None
+    
+    def snapshot(self):
+        """Resumo por instância para o progresso do job"""
+        with self.lock:
+            return {
+                name: {
+                    'status': self.statuses.get(name),
+                    'weight': round(self.weight(name), 2),
+                    'assigned': self.assigned[name]
+                }
+                for name in self.instances
+            }
+
+# Disparo para o webhook do n8n em lotes paralelos com retentativa por lote
+DISPARO_WEBHOOK_URL = os.getenv('DISPARO_WEBHOOK_URL', 'https://rede-confianca-n8n.lpl0df.easypanel.host/webhook/disparo-rede-confianca')
+WEBHOOK_CHUNK_SIZE = int(os.getenv('WEBHOOK_CHUNK_SIZE', 500))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', 4))
+WEBHOOK_MAX_RETRIES = int(os.getenv('WEBHOOK_MAX_RETRIES', 3))
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', 60))
+
+webhook_session = requests.Session()
+webhook_session.mount('http://', HTTPAdapter(pool_maxsize=WEBHOOK_MAX_CONCURRENCY))
+webhook_session.mount('https://', HTTPAdapter(pool_maxsize=WEBHOOK_MAX_CONCURRENCY))
+
+def post_webhook_chunk(payload, correlation_id):
+    """Envia um lote ao webhook, repetindo com backoff exponencial em falhas transitórias"""
+    last_error = None
+    for attempt in range(WEBHOOK_MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(min(30, 2 ** (attempt - 1)) + random.uniform(0, 0.5))
+        try:
+            response = webhook_session.post(
+                DISPARO_WEBHOOK_URL,
+                json=payload,
+                headers={'X-Correlation-ID': correlation_id},
+                timeout=WEBHOOK_TIMEOUT
+            )
+            if response.status_code < 400:
+                print(f"Lote {correlation_id} enviado: {response.status_code}")
+                return True, None
+            last_error = f"HTTP {response.status_code}"
+            # Erros do cliente (exceto 429) não mudam com nova tentativa
+            if response.status_code < 500 and response.status_code != 429:
+                break
+        except requests.exceptions.RequestException as e:
+            last_error = str(e)
+        print(f"Lote {correlation_id} falhou (tentativa {attempt + 1}): {last_error}")
+    return False, last_error
+
+def dispatch_campaign(base_payload, leads, on_progress=None, balancer=None, instance_links=None):
+    """Divide os leads em lotes e envia ao webhook com concorrência limitada; retorna o resumo
+
+    Com `balancer`, cada lote é atribuído a uma das instâncias da campanha (campo `instancia`).
+    """
+    campaign_id = uuid.uuid4().hex[:12]
+    summary = {
+        'campaign_id': campaign_id,
+        'chunks_total': 0,
+        'chunks_ok': 0,
+        'chunks_failed': 0,
+        'leads_total': 0,
+        'leads_failed': 0,
+        'failed_chunks': []
+    }
+    
+    def collect(futures, in_flight):
+        for future in futures:
+            correlation_id, size, instance_name = in_flight.pop(future)
+            ok, error = future.result()
+            if balancer:
+                balancer.record(instance_name, ok)
+            if ok:
+                summary['chunks_ok'] += 1
+            else:
+                summary['chunks_failed'] += 1
+                summary['leads_failed'] += size
+                summary['failed_chunks'].append({'chunk_id': correlation_id, 'leads': size, 'error': error})
+            if balancer:
+                summary['instances'] = balancer.snapshot()
+            if on_progress:
+                on_progress(summary)
+    
+    if balancer:
+        balancer.refresh_statuses(force=True)
+    
+    with ThreadPoolExecutor(max_workers=WEBHOOK_MAX_CONCURRENCY, thread_name_prefix='webhook') as executor:
+        in_flight = {}
+        for index, chunk in enumerate(iter_chunks(leads, WEBHOOK_CHUNK_SIZE), start=1):
+            correlation_id = f"{campaign_id}-{index:04d}"
+            payload = dict(base_payload, leads=chunk, campaign_id=campaign_id, chunk_id=correlation_id, chunk_index=index)
+            instance_name = None
+            if balancer:
+                instance_name = balancer.choose()
+                payload.update(instancia=instance_name, link_planilha=(instance_links or {}).get(instance_name, base_payload['link_planilha']))
+            in_flight[executor.submit(post_webhook_chunk, payload, correlation_id)] = (correlation_id, len(chunk), instance_name)
+            summary['chunks_total'] += 1
+            summary['leads_total'] += len(chunk)
+            
+            # Limitar lotes em memória aguardando envio
+            if len(in_flight) >= WEBHOOK_MAX_CONCURRENCY * 2:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done, in_flight)
+        collect(wait(in_flight).done, in_flight)
+    
+    print(f"Resumo do disparo {campaign_id}: {summary['chunks_ok']}/{summary['chunks_total']} lotes enviados")
+    return summary
+
+# Disparo nativo pela Evolution API, com limite de envio por instância (token bucket)
+DISPATCH_BACKEND = os.getenv('DISPATCH_BACKEND', 'webhook')  # webhook (n8n) ou evolution
+SEND_RATE_PER_MINUTE = float(os.getenv('SEND_RATE_PER_MINUTE', 20))
+SEND_BURST = int(os.getenv('SEND_BURST', 3))
+SEND_JITTER_SECONDS = float(os.getenv('SEND_JITTER_SECONDS', 2))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 2))
+SEND_FAILED_LEADS_LIMIT = 100
+
+class TokenBucket:
+    """Limitador de taxa: `rate_per_minute` fichas por minuto, acumulando no máximo `burst`
+    
+    `clock` e `sleep` podem ser trocados (ex: relógio simulado nos testes)
+    """
+    
+    def __init__(self, rate_per_minute, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Bloqueia até haver uma ficha disponível e a consome"""
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            self.sleep(delay)
+
+# Um bucket por instância, compartilhado entre campanhas simultâneas do mesmo número
+send_buckets = {}
+send_buckets_lock = threading.Lock()
+
+def get_send_bucket(instance_name):
+    """Retorna o token bucket da instância (criado no primeiro uso)"""
+    with send_buckets_lock:
+        if instance_name not in send_buckets:
+            send_buckets[instance_name] = TokenBucket(SEND_RATE_PER_MINUTE, SEND_BURST)
+        return send_buckets[instance_name]
+
+def build_evolution_messages(payload, lead):
+    """Monta as chamadas de envio do lead: mídias (a primeira leva a mensagem como legenda) ou só texto"""
+    number = lead['remoteJid'].split('@')[0]
+    text = lead['mensagem']
+    messages = []
+    if payload['haImg']:
+        messages.append(('sendMedia', {
+            'number': number,
+            'mediatype': 'image',
+            'media': payload['image_url'] or payload['base64'],
+            'caption': text
+        }))
+        text = None
+    if payload['haVideo']:
+        messages.append(('sendMedia', {
+            'number': number,
+            'mediatype': 'video',
+            'mimetype': 'video/mp4',
+            'media': payload['video_url'],
+            'fileName': 'video.mp4',
+            'caption': text or ''
+        }))
+        text = None
+    if text:
+        messages.append(('sendText', {'number': number, 'text': text}))
+    return messages
+
+def send_lead_via_evolution(instance_name, payload, lead):
+    """Envia as mensagens de um lead respeitando o limite da instância; retorna (ok, erro)"""
+    bucket = get_send_bucket(instance_name)
+    for endpoint, body in build_evolution_messages(payload, lead):
+        last_error = None
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            if attempt:
+                time.sleep(min(30, 2 ** (attempt - 1)))
+            bucket.acquire()
+            # Intervalo aleatório para não enviar em ritmo exato (padrão de robô)
+            if SEND_JITTER_SECONDS:
+                time.sleep(random.uniform(0, SEND_JITTER_SECONDS))
+            try:
+                response = evolution_client.post(f"/message/{endpoint}/{instance_name}", json=body)
+                if response.status_code < 400:
+                    last_error = None
+                    invalidate_chat_cache(instance_name, lead['remoteJid'])
+                    break
+                last_error = f"HTTP {response.status_code}"
+                if response.status_code < 500 and response.status_code != 429:
+                    break
+            except requests.exceptions.RequestException as e:
+                last_error = str(e)
+        if last_error:
+            return False, last_error
+    return True, None
+
+def send_lead_balanced(balancer, payload, lead):
+    """Envia o lead pela instância escolhida; se falhar, tenta uma vez por outra instância"""
+    tried = set()
+    error = 'Nenhuma instância disponível'
+    for _ in range(min(2, len(balancer.instances))):
+        instance_name = balancer.choose(exclude=tried)
+        ok, error = send_lead_via_evolution(instance_name, payload, lead)
+        balancer.record(instance_name, ok)
+        if ok:
+            return True, None
+        tried.add(instance_name)
+    return False, error
+
+def send_campaign_via_evolution(payload, leads, on_progress=None, balancer=None, instance_links=None):
+    """Envia os leads (com mensagem já renderizada) direto pela Evolution API; retorna o resumo com os contadores"""
+    balancer = balancer or InstanceBalancer([payload['instancia']])
+    workers = SEND_WORKERS * len(balancer.instances)
+    started_at = time.time()
+    summary = {
+        'campaign_id': uuid.uuid4().hex[:12],
+        'backend': 'evolution',
+        'leads_total': 0,
+        'sent': 0,
+        'failed': 0,
+        'per_minute': 0,
+        'failed_leads': []
+    }
+    
+    def collect(futures, in_flight):
+        for future in futures:
+            lead = in_flight.pop(future)
+            ok, error = future.result()
+            if ok:
+                summary['sent'] += 1
+            else:
+                summary['failed'] += 1
+                if len(summary['failed_leads']) < SEND_FAILED_LEADS_LIMIT:
+                    summary['failed_leads'].append({'telefone': lead['telefone'], 'error': error})
+            elapsed = time.time() - started_at
+            summary['per_minute'] = round(summary['sent'] * 60 / elapsed, 1) if elapsed else 0
+            summary['instances'] = balancer.snapshot()
+            if on_progress:
+                on_progress(summary)
+    
+    # Status consultado antes de qualquer worker começar a escolher instâncias
+    balancer.refresh_statuses(force=True)
+    
+    # Workers proporcionais ao número de instâncias: cada uma tem seu próprio limite de envio
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='send') as executor:
+        in_flight = {}
+        for lead in leads:
+            in_flight[executor.submit(send_lead_balanced, balancer, payload, lead)] = lead
+            summary['leads_total'] += 1
+            if len(in_flight) >= workers * 2:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done, in_flight)
+        collect(wait(in_flight).done, in_flight)
+    
+    print(f"Resumo do envio {summary['campaign_id']} ({', '.join(balancer.instances)}): {summary['sent']} enviadas, {summary['failed']} falhas")
+    return summary
+
+# Fila de jobs de disparo executados em background
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_HISTORY_LIMIT = int(os.getenv('JOB_HISTORY_LIMIT', 200))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+jobs = collections.OrderedDict()
+jobs_lock = threading.Lock()
+
+def create_job(description):
+    """Registra um novo job na fila e retorna seu id"""
+    now = time.time()
+    job = {
+        'id': uuid.uuid4().hex,
+        'description': description,
+        'status': 'queued',
+        'stage': 'queued',
+        'progress': {},
+        'result': None,
+        'error': None,
+        'created_at': now,
+        'updated_at': now
+    }
+    with jobs_lock:
+        jobs[job['id']] = job
+        # Descartar os jobs finalizados mais antigos
+        finished = [job_id for job_id, item in jobs.items() if item['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(jobs) - JOB_HISTORY_LIMIT)]:
+            del jobs[job_id]
+    return job['id']
+
+def update_job(job_id, **fields):
+    """Atualiza estágio/progresso de um job"""
+    with jobs_lock:
+        if job_id in jobs:
+            jobs[job_id].update(fields, updated_at=time.time())
+
+def get_job(job_id):
+    """Retorna uma cópia do estado atual do job (None se não existir)"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        return dict(job, progress=dict(job['progress'])) if job else None
+
+def enqueue_job(job_id, target, *args):
+    """Executa target(job_id, *args) em um worker, registrando conclusão ou erro no job"""
+    def run():
+        update_job(job_id, status='running')
+        try:
+            result = target(job_id, *args)
+            update_job(job_id, status='done', stage='done', result=result)
+        except Exception as e:
+            print(f"Erro no job {job_id}: {e}")
+            import traceback
+            traceback.print_exc()
+            update_job(job_id, status='failed', stage='failed', error=str(e))
+    
+    job_executor.submit(run)
+    return job_id
+
+def resolve_media_urls(media_objects):
+    """Gera (ou reaproveita) as URLs presigned das mídias da campanha"""
+    return {
+        'image_url': get_media_url(media_objects['image']) if media_objects.get('image') else None,
+        'video_url': get_media_url(media_objects['video']) if media_objects.get('video') else None
+    }
+
+def prepare_campaign_media(campaign):
+    """Envia/codifica as mídias da campanha e retorna os campos de mídia do payload"""
+    media = {'haImg': False, 'base64': None, 'image_url': None, 'haVideo': False, 'video_url': None}
+    media_objects = {}
+    
+    image = campaign.get('image')
+    if image:
+        media['haImg'] = True
+        if use_inline_image(len(image['bytes'])):
+            media['base64'] = base64.b64encode(image['bytes']).decode('utf-8')
+            print(f"Imagem convertida para base64, tamanho: {len(media['base64'])} caracteres")
+        else:
+            media_objects['image'] = store_media_in_minio(image['bytes'], image['filename'], 'images', image['mimetype'])
+            print("Imagem enviada para MinIO com sucesso")
+    
+    video = campaign.get('video')
+    if video:
+        media['haVideo'] = True
+        if video.get('object_name'):
+            # Vídeo que já estava no MinIO (mesmo conteúdo enviado antes)
+            media_objects['video'] = video['object_name']
+        elif video.get('upload'):
+            # Vídeo já enviado ao MinIO em streaming durante o recebimento da requisição
+            video['upload'].finish()
+            media_objects['video'] = video['upload'].object_name
+        else:
+            # Fallback: arquivo salvo em disco
+            media_objects['video'] = store_media_in_minio(video['path'], video['filename'], 'videos', 'video/mp4')
+            print("Vídeo enviado para MinIO com sucesso")
+    
+    campaign['media_objects'] = media_objects
+    media.update(resolve_media_urls(media_objects))
+    return media
+
+def cleanup_campaign_files(campaign):
+    """Remove os arquivos temporários da campanha"""
+    paths = [campaign.get('excel_path'), (campaign.get('video') or {}).get('path')]
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+            print(f"Arquivo temporário removido: {path}")
+
+def fail_campaign_job(job_id, campaign, error):
+    """Marca como falho o job recusado na validação e remove os arquivos que já foram gravados"""
+    cleanup_campaign_files(campaign)
+    update_job(job_id, status='failed', stage='failed', error=error)
+    return error
+
+def build_campaign_payload(campaign, media):
+    """Monta o payload base (sem leads) enviado ao webhook"""
+    return {
+        'message': campaign['message'],
+        'message2': campaign['message2'] or campaign['message'],
+        'message3': campaign['message3'] or campaign['message'],
+        **media,
+        'data_agendamento': campaign['data_agendamento'],
+        'horario_agendamento': campaign['horario_agendamento'],
+        'instancia': campaign['instancia'],
+        'link_planilha': campaign['link_planilha'],
+        'mensagens_renderizadas': campaign.get('render_messages', False)
+    }
+
+def dispatch_campaign_leads(job_id, campaign, media):
+    """Lê os leads da planilha (renderizando as mensagens se pedido) e envia pelo webhook ou pela Evolution, atualizando o progresso do job"""
+    native = campaign.get('dispatch_backend') == 'evolution'
+    # O envio direto pela Evolution sempre precisa da mensagem final de cada lead
+    if native:
+        campaign = dict(campaign, render_messages=True)
+    payload = build_campaign_payload(campaign, media)
+    # Log do payload sem os base64 (que são muito grandes)
+    payload_debug = dict(payload, base64=None, base64_size=len(payload['base64']) if payload['base64'] else 0)
+    print("Payload debug:", payload_debug)
+    if native:
+        print(f"Enviando pela Evolution API ({SEND_RATE_PER_MINUTE:g} mensagens/min por instância)...")
+    else:
+        print(f"Enviando para webhook em lotes de {WEBHOOK_CHUNK_SIZE} leads...")
+    
+    update_job(job_id, stage='dispatch')
+    phone_stats = {}
+    leads = normalize_leads(iter_leads_from_excel(campaign['excel_path']), phone_stats)
+    if campaign.get('precheck_numbers'):
+        leads = precheck_leads(leads, campaign['instancia'], phone_stats)
+    if payload['mensagens_renderizadas']:
+        templates = compile_message_templates(campaign['message'], campaign['message2'], campaign['message3'])
+        leads = render_campaign_messages(templates, leads)
+    instances = campaign.get('instancias') or [campaign['instancia']]
+    balancer = InstanceBalancer(instances) if native or len(instances) > 1 else None
+    send = send_campaign_via_evolution if native else dispatch_campaign
+    summary = send(
+        payload,
+        leads,
+        on_progress=lambda progress: update_job(job_id, progress=dict(progress, **phone_stats)),
+        balancer=balancer,
+        instance_links=campaign.get('links_planilha')
+    )
+    summary.update(phone_stats)
+    update_job(job_id, progress=dict(summary))
+    print(f"Telefones descartados: {phone_stats['leads_invalid']} inválidos, {phone_stats['leads_duplicated']} duplicados, {phone_stats.get('leads_not_on_whatsapp', 0)} sem WhatsApp")
+    
+    if summary['leads_total'] == 0:
+        raise Exception(f"Nenhum lead válido encontrado na planilha ({phone_stats['leads_invalid']} telefones inválidos, {phone_stats['leads_duplicated']} duplicados, {phone_stats.get('leads_not_on_whatsapp', 0)} sem WhatsApp)")
+    if native and summary['sent'] == 0:
+        raise Exception(f"Erro ao enviar pela Evolution API: nenhuma das {summary['leads_total']} mensagens foi enviada ({summary['failed_leads'][0]['error']})")
+    if not native and summary['chunks_ok'] == 0:
+        raise Exception(f"Erro ao enviar dados para o webhook: nenhum dos {summary['chunks_total']} lotes foi aceito ({summary['failed_chunks'][0]['error']})")
+    
+    payload_debug['leads_count'] = summary['leads_total']
+    payload_debug['dispatch'] = summary
+    return payload_debug
+
+def run_broadcast_job(job_id, campaign):
+    """Pipeline do disparo: mídias -> (agendamento) -> leads da planilha -> webhook em lotes"""
+    try:
+        update_job(job_id, stage='media')
+        media = prepare_campaign_media(campaign)
+        
+        # Campanha agendada: fica persistida e o agendador dispara no horário
+        if campaign.get('scheduled_at'):
+            schedule_id = save_scheduled_campaign(campaign, media)
+            update_job(job_id, stage='scheduled')
+            return {'schedule_id': schedule_id, 'scheduled_at': campaign['scheduled_at'].isoformat() + 'Z'}
+        
+        return dispatch_campaign_leads(job_id, campaign, media)
+    finally:
+        cleanup_campaign_files(campaign)
+
+# Agendador de campanhas: persistidas no banco e disparadas pelo app no horário
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'True').lower() == 'true'
+SCHEDULE_TIMEZONE = ZoneInfo(os.getenv('SCHEDULE_TIMEZONE', 'America/Sao_Paulo'))
+# Campanha em execução renova updated_at a cada SCHEDULE_HEARTBEAT_INTERVAL segundos; sem
+# renovação por SCHEDULE_STALE_AFTER segundos (processo caiu) ela é marcada 'interrupted'
+SCHEDULE_HEARTBEAT_INTERVAL = float(os.getenv('SCHEDULE_HEARTBEAT_INTERVAL', 60))
+SCHEDULE_STALE_AFTER = int(os.getenv('SCHEDULE_STALE_AFTER', 600))
+SCHEDULED_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], 'agendados')
+os.makedirs(SCHEDULED_FOLDER, exist_ok=True)
+scheduler_heap = []
+scheduler_condition = threading.Condition()
+scheduler_state = {'thread': None, 'running': set()}
+
+def parse_schedule(data_agendamento, horario_agendamento):
+    """Converte data/hora do formulário (fuso SCHEDULE_TIMEZONE) para datetime UTC sem tzinfo"""
+    if not data_agendamento:
+        return None
+    local = datetime.datetime.strptime(f"{data_agendamento} {horario_agendamento or '00:00'}", '%Y-%m-%d %H:%M')
+    return local.replace(tzinfo=SCHEDULE_TIMEZONE).astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+def ensure_scheduled_campaigns_table(cursor):
+    """Cria a tabela de campanhas agendadas se ainda não existir"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS campanhas_agendadas (
+            id VARCHAR(32) PRIMARY KEY,
+            instancia VARCHAR(50) NOT NULL,
+            scheduled_at DATETIME NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            campaign LONGTEXT NOT NULL,
+            error TEXT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            INDEX idx_status_scheduled (status, scheduled_at)
+        )
+    """)
+
+def save_scheduled_campaign(campaign, media):
+    """Persiste a campanha agendada (planilha em disco, resto no banco) e a coloca no agendador"""
+    schedule_id = uuid.uuid4().hex
+    excel_path = os.path.join(SCHEDULED_FOLDER, f"{schedule_id}.xlsx")
+    shutil.move(campaign['excel_path'], excel_path)
+    campaign['excel_path'] = None
+    
+    stored = {
+        'message': campaign['message'],
+        'message2': campaign['message2'],
+        'message3': campaign['message3'],
+        'instancia': campaign['instancia'],
+        'instancias': campaign['instancias'],
+        'link_planilha': campaign['link_planilha'],
+        'links_planilha': campaign['links_planilha'],
+        'render_messages': campaign['render_messages'],
+        'precheck_numbers': campaign['precheck_numbers'],
+        'dispatch_backend': campaign['dispatch_backend'],
+        'media': dict(media, image_url=None, video_url=None),
+        'media_objects': campaign['media_objects'],
+        'excel_path': excel_path
+    }
+    
+    connection = get_db_connection()
+    if not connection:
+        os.remove(excel_path)
+        raise Exception('Erro ao conectar ao banco para salvar o agendamento')
+    cursor = None
     try:
         cursor = connection.cursor()
-        if link_planilha is not None:
-            query = "UPDATE numeros SET descricao = %s, link_planilha = %s WHERE id = %s"
-            cursor.execute(query, (new_description, link_planilha, numero_id))
-        else:
-            query = "UPDATE numeros SET descricao = %s WHERE id = %s"
-            cursor.execute(query, (new_description, numero_id))
+        ensure_scheduled_campaigns_table(cursor)
+        cursor.execute(
+            "INSERT INTO campanhas_agendadas (id, instancia, scheduled_at, campaign) VALUES (%s, %s, %s, %s)",
+            (schedule_id, campaign['instancia'], campaign['scheduled_at'], json.dumps(stored))
+        )
         connection.commit()
-        return True
-    except Error as e:
-        print(f"Erro ao atualizar descrição: {e}")
-        return False
+    except Error:
+        os.remove(excel_path)
+        raise
     finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+        release_db_connection(connection, cursor)
+    
+    schedule_campaign_run(schedule_id, campaign['scheduled_at'])
+    print(f"Campanha {schedule_id} agendada para {campaign['scheduled_at']} UTC")
+    return schedule_id
 
-def delete_whatsapp_number(numero_id):
-    """Remove um número do WhatsApp do banco de dados"""
+def schedule_campaign_run(schedule_id, scheduled_at):
+    """Coloca a campanha no heap do agendador e acorda o loop se ela for a próxima"""
+    due = scheduled_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+    with scheduler_condition:
+        heapq.heappush(scheduler_heap, (due, schedule_id))
+        scheduler_condition.notify()
+
+def update_scheduled_campaign(schedule_id, status, error=None, expected_status=None):
+    """Atualiza o status do agendamento; com expected_status só altera se ainda estiver nele"""
     connection = get_db_connection()
     if not connection:
         return False
-    
+    cursor = None
     try:
         cursor = connection.cursor()
-        query = "DELETE FROM numeros WHERE id = %s"
-        cursor.execute(query, (numero_id,))
+        query = "UPDATE campanhas_agendadas SET status = %s, error = %s WHERE id = %s"
+        params = [status, error, schedule_id]
+        if expected_status:
+            query += " AND status = %s"
+            params.append(expected_status)
+        cursor.execute(query, params)
         connection.commit()
-        return cursor.rowcount > 0  # Retorna True se algum registro foi deletado
+        return cursor.rowcount > 0
     except Error as e:
-        print(f"Erro ao remover número: {e}")
+        print(f"Erro ao atualizar agendamento {schedule_id}: {e}")
         return False
     finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+        release_db_connection(connection, cursor)
 
-# Configuração do banco de dados
-def get_db_connection():
-    """Conexão com o banco principal do sistema"""
-    try:
-        connection = mysql.connector.connect(
-            host=os.getenv('DB_HOST', 'localhost'),
-            database=os.getenv('DB_NAME', 'whatsapp'),
-            user=os.getenv('DB_USER', 'root'),
-            password=os.getenv('DB_PASSWORD', ''),
-            #port=int(os.getenv('DB_PORT', 3306))
-        )
-        return connection
-    except Error as e:
-        print(f"Erro ao conectar ao MySQL (sistema): {e}")
+def load_scheduled_campaign(schedule_id):
+    """Carrega os dados da campanha agendada"""
+    connection = get_db_connection()
+    if not connection:
         return None
+    cursor = None
+    try:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute("SELECT campaign FROM campanhas_agendadas WHERE id = %s", (schedule_id,))
+        row = cursor.fetchone()
+        return json.loads(row['campaign']) if row else None
+    finally:
+        release_db_connection(connection, cursor)
 
-def get_evolution_db_connection():
-    """Conexão com o banco da Evolution API"""
+def touch_scheduled_campaign(schedule_id):
+    """Renova o updated_at da campanha em execução (sinal de que o processo segue vivo)"""
+    connection = get_db_connection()
+    if not connection:
+        return
+    cursor = None
     try:
-        connection = mysql.connector.connect(
-            host=os.getenv('EVOLUTION_DB_HOST', 'localhost'),
-            database=os.getenv('EVOLUTION_DB_NAME', 'evolution'),
-            user=os.getenv('EVOLUTION_DB_USER', 'root'),
-            password=os.getenv('EVOLUTION_DB_PASSWORD', ''),
-            #port=int(os.getenv('EVOLUTION_DB_PORT', 3306))
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE campanhas_agendadas SET updated_at = CURRENT_TIMESTAMP WHERE id = %s AND status = 'running'",
+            (schedule_id,)
         )
-        return connection
+        connection.commit()
     except Error as e:
-        print(f"Erro ao conectar ao MySQL (Evolution): {e}")
-        return None
+        print(f"Erro ao renovar agendamento {schedule_id}: {e}")
+    finally:
+        release_db_connection(connection, cursor)
 
-def get_whatsapp_numbers():
-    """Busca todos os números do WhatsApp cadastrados com status da Evolution"""
-    connection = get_db_connection()
-    if not connection:
-        return []
+def run_scheduled_campaign(job_id, schedule_id):
+    """Dispara uma campanha agendada que chegou no horário"""
+    stored = None
+    stop_heartbeat = threading.Event()
+    
+    def heartbeat():
+        while not stop_heartbeat.wait(SCHEDULE_HEARTBEAT_INTERVAL):
+            touch_scheduled_campaign(schedule_id)
     
+    with scheduler_condition:
+        scheduler_state['running'].add(schedule_id)
+    threading.Thread(target=heartbeat, daemon=True, name=f'heartbeat-{schedule_id}').start()
     try:
-        cursor = connection.cursor(dictionary=True)
-        # Buscar dados da tabela numeros do sistema principal
-        query = "SELECT * FROM numeros ORDER BY id"
-        cursor.execute(query)
-        numbers = cursor.fetchall()
-        
-        print(f"Números encontrados no banco principal: {len(numbers)}")
-        
-        # Para cada número, verificar status na Evolution API via HTTP
-        for number in numbers:
-            try:
-                # Verificar status via API da Evolution (mais confiável)
-                status = get_instance_status(number['instancia'])
-                
-                if status in ['open', 'connected']:
-                    number['status'] = 'Conectado'
-                    number['status_class'] = 'connected'
-                elif status == 'connecting':
-                    number['status'] = 'Conectando'
-                    number['status_class'] = 'connecting'
-                else:
-                    number['status'] = 'Desconectado'
-                    number['status_class'] = 'disconnected'
-                    
-            except Exception as e:
-                print(f"Erro ao verificar status da instância {number['instancia']}: {e}")
-                number['status'] = 'Desconectado'
-                number['status_class'] = 'disconnected'
-        
-        return numbers
+        stored = load_scheduled_campaign(schedule_id)
+        if not stored:
+            raise Exception(f'Agendamento {schedule_id} não encontrado')
         
-    except Error as e:
-        print(f"Erro ao buscar números: {e}")
-        return []
+        update_job(job_id, stage='media')
+        media = dict(stored['media'], **resolve_media_urls(stored['media_objects']))
+        campaign = dict(stored, data_agendamento=None, horario_agendamento=None)
+        result = dispatch_campaign_leads(job_id, campaign, media)
+        update_scheduled_campaign(schedule_id, 'done')
+        return dict(result, schedule_id=schedule_id)
+    except Exception as e:
+        update_scheduled_campaign(schedule_id, 'failed', str(e))
+        raise
     finally:
-        if connection and connection.is_connected():
-            cursor.close()
-            connection.close()
+        stop_heartbeat.set()
+        with scheduler_condition:
+            scheduler_state['running'].discard(schedule_id)
+        if stored and os.path.exists(stored['excel_path']):
+            os.remove(stored['excel_path'])
 
-def create_whatsapp_number(numero, remotejid, descricao, instancia, link_planilha=None):
-    """Cria um novo número do WhatsApp"""
+def start_due_campaign(schedule_id):
+    """Reivindica o agendamento (evita disparo duplicado entre processos) e o coloca na fila de jobs"""
+    if not update_scheduled_campaign(schedule_id, 'running', expected_status='pending'):
+        print(f"Agendamento {schedule_id} já iniciado ou cancelado")
+        return
+    job_id = create_job(f"Agendamento {schedule_id}")
+    enqueue_job(job_id, run_scheduled_campaign, schedule_id)
+    print(f"Agendamento {schedule_id} iniciado: job {job_id}")
+
+def recover_stale_campaigns(cursor):
+    """Marca como 'interrupted' as campanhas 'running' sem heartbeat (processo caiu ou reiniciou)
+
+    Não há como saber quais leads já receberam a mensagem, então a campanha não é disparada de
+    novo: alguém confere os envios e, se for o caso, volta o status para 'pending' (a planilha
+    continua guardada). As campanhas em execução neste processo nunca são marcadas.
+    """
+    with scheduler_condition:
+        running = list(scheduler_state['running'])
+    query = """UPDATE campanhas_agendadas SET status = 'interrupted', error = 'Interrompida durante o envio; confira os envios antes de reagendar'
+               WHERE status = 'running' AND updated_at < NOW() - INTERVAL %s SECOND"""
+    if running:
+        query += f" AND id NOT IN ({', '.join(['%s'] * len(running))})"
+    cursor.execute(query, (SCHEDULE_STALE_AFTER, *running))
+    if cursor.rowcount:
+        print(f"⚠️ Agendamentos interrompidos (não serão reenviados automaticamente): {cursor.rowcount}")
+
+def load_pending_campaigns():
+    """Recarrega os agendamentos pendentes (ex: após reinício do app) e marca os interrompidos"""
     connection = get_db_connection()
     if not connection:
         return False
-    
+    cursor = None
     try:
-        cursor = connection.cursor()
-        # Usar a tabela correta: numeros
-        query = "INSERT INTO numeros (numero, remotejid, descricao, instancia, link_planilha) VALUES (%s, %s, %s, %s, %s)"
-        cursor.execute(query, (numero, remotejid, descricao, instancia, link_planilha))
+        cursor = connection.cursor(dictionary=True)
+        ensure_scheduled_campaigns_table(cursor)
+        recover_stale_campaigns(cursor)
         connection.commit()
-        return True
+        cursor.execute("SELECT id, scheduled_at FROM campanhas_agendadas WHERE status = 'pending'")
+        rows = cursor.fetchall()
     except Error as e:
-        print(f"Erro ao criar número: {e}")
+        print(f"Erro ao carregar agendamentos pendentes: {e}")
         return False
     finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+        release_db_connection(connection, cursor)
+    
+    with scheduler_condition:
+        queued = {schedule_id for _, schedule_id in scheduler_heap}
+    for row in rows:
+        # Recarga periódica: não duplica o que já está no heap
+        if row['id'] not in queued:
+            schedule_campaign_run(row['id'], row['scheduled_at'])
+    print(f"Agendamentos pendentes carregados: {len(rows)}")
+    return True
+
+def campaign_scheduler_loop():
+    """Loop do agendador: dorme até o próximo horário do heap (sem consultar a tabela a cada segundo)
+
+    A cada SCHEDULE_STALE_AFTER segundos recarrega a tabela (pendentes criados por outros
+    processos) e marca as campanhas interrompidas.
+    """
+    while not load_pending_campaigns():
+        time.sleep(30)
+    next_recovery = time.time() + SCHEDULE_STALE_AFTER
+    
+    while True:
+        schedule_id = None
+        with scheduler_condition:
+            now = time.time()
+            delay = scheduler_heap[0][0] - now if scheduler_heap else float('inf')
+            if delay > 0:
+                # Acorda no horário, quando entrar um agendamento mais próximo ou na próxima recuperação
+                if now < next_recovery:
+                    scheduler_condition.wait(timeout=min(delay, next_recovery - now))
+            else:
+                schedule_id = heapq.heappop(scheduler_heap)[1]
+        
+        if schedule_id is None:
+            if time.time() >= next_recovery:
+                load_pending_campaigns()
+                next_recovery = time.time() + SCHEDULE_STALE_AFTER
+            continue
+        try:
+            start_due_campaign(schedule_id)
+        except Exception as e:
+            print(f"Erro ao iniciar agendamento {schedule_id}: {e}")
+
+def start_scheduler():
+    """Inicia o agendador neste processo (uma única vez; rode-o em apenas um processo do servidor)"""
+    with scheduler_condition:
+        if scheduler_state['thread'] is None:
+            scheduler_state['thread'] = threading.Thread(target=campaign_scheduler_loop, daemon=True, name='scheduler')
+            scheduler_state['thread'].start()
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -642,48 +3419,21 @@ def login():
 def reconectar_numero(instancia):
     """Rota para reconectar um número desconectado"""
     try:
-        # Tentar conectar a instância na Evolution API
-        connect_url = f"{os.getenv('EVOLUTION_BASE_URL', '')}/instance/connect/{instancia}"
-        headers = get_evolution_api_headers()
-        
-        print(f"Tentando reconectar instância: {instancia}")
-        print(f"URL: {connect_url}")
+        # A conexão roda em background; a página recebe o QR Code pelo stream da instância
+        flow = start_connect_flow(instancia)
+        print(f"Reconexão da instância {instancia} agendada (estado: {flow['state'] if flow else '-'})")
         
-        # Primeiro tentar conectar
-        connect_response = requests.get(connect_url, headers=headers, timeout=10)
-        print(f"Response status: {connect_response.status_code}")
-        print(f"Response text: {connect_response.text}")
-        
-        if connect_response.status_code in [200, 201]:
-            print(f"Instância {instancia} conectada/reconectada com sucesso")
-            
-            # Aguardar um pouco e obter QR Code
-            time.sleep(2)
-            qr_code = get_qrcode_evolution(instancia)
-            
-            return render_template('criar_numero.html', 
-                                 instancia=instancia, 
-                                 show_qr=True,
-                                 qr_code=qr_code,
-                                 reconnect=True)
-        else:
-            error_msg = f"Erro ao reconectar: Status {connect_response.status_code}"
-            try:
-                error_data = connect_response.json()
-                if 'message' in error_data:
-                    error_msg = error_data['message']
-            except:
-                pass
-            
-            return render_template('numeros.html', 
-                                 numbers=get_whatsapp_numbers(),
-                                 error=error_msg)
+        return render_template('criar_numero.html', 
+                             instancia=instancia, 
+                             show_qr=True,
+                             qr_code=None,
+                             connect_pending=True,
+                             reconnect=True)
             
     except Exception as e:
         print(f"Erro ao reconectar: {e}")
-        return render_template('numeros.html', 
-                             numbers=get_whatsapp_numbers(),
-                             error=f"Erro ao reconectar: {str(e)}")
+        return render_numeros(numbers=get_whatsapp_numbers(),
+                              error=f"Erro ao reconectar: {str(e)}")
 
 @app.route('/numeros')
 def numeros():
@@ -692,7 +3442,64 @@ def numeros():
         return redirect(url_for('login'))
     
     numbers = get_whatsapp_numbers()
-    return render_template('numeros.html', numbers=numbers)
+    return render_numeros(numbers=numbers)
+
+@app.route('/numeros/reconectar-todos', methods=['GET', 'POST'])
+def reconectar_todos():
+    """Reconecta de uma vez todos os números que não estão conectados e mostra a grade de QR Codes"""
+    if not logado:
+        return redirect(url_for('login'))
+    
+    numbers = get_whatsapp_numbers()
+    if request.method == 'POST':
+        disconnected = [number['instancia'] for number in numbers if number['status_class'] != 'connected']
+        if not disconnected:
+            return render_numeros(numbers=numbers, error='Nenhum número desconectado para reconectar')
+        start_bulk_reconnect(disconnected)
+        return redirect(url_for('reconectar_todos', instancias=','.join(disconnected)))
+    
+    selected = [name for name in request.args.get('instancias', '').split(',') if name]
+    numbers_by_instance = {number['instancia']: number for number in numbers}
+    items = [
+        numbers_by_instance.get(name) or {'instancia': name, 'numero': name, 'descricao': ''}
+        for name in selected
+    ]
+    return render_template('reconectar_todos.html', numbers=items, instancias=','.join(selected))
+
+@app.route('/api/reconnect-events')
+def reconnect_events():
+    """Stream (Server-Sent Events) da grade de reconexão: um evento por instância que mudou"""
+    if not logado:
+        return {'status': 'error', 'message': 'Não autorizado'}, 401
+    
+    instance_names = [name for name in request.args.get('instancias', '').split(',') if name][:200]
+    
+    def stream():
+        # Status do snapshot (monitor ou, sem ele, get_instances_snapshot a cada INSTANCES_SNAPSHOT_TTL), fluxos e QRs em cache:
+        # uma única consulta fetchInstances compartilhada, nunca uma chamada por instância a cada tick
+        last_sent = {}
+        last_write = time.time()
+        deadline = last_write + INSTANCE_EVENTS_MAX_SECONDS
+        yield 'retry: 3000\n\n'
+        while time.time() < deadline:
+            # Sem o monitor, a leitura dispara a atualização do snapshot quando ele expira
+            statuses = get_instances_snapshot()
+            for instance_name in instance_names:
+                state = get_bulk_reconnect_state(instance_name, statuses.get(instance_name))
+                if last_sent.get(instance_name) != state:
+                    last_sent[instance_name] = state
+                    last_write = time.time()
+                    yield format_sse('instance', state)
+            if time.time() - last_write >= INSTANCE_EVENTS_KEEPALIVE:
+                last_write = time.time()
+                yield ': ping\n\n'
+            time.sleep(BULK_RECONNECT_TICK)
+    
+    return Response(
+        stream(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/numeros/criar', methods=['GET', 'POST'])
 def criar_numero():
@@ -707,11 +3514,12 @@ def criar_numero():
             if instancia:
                 # Criar instância na Evolution API
                 if create_evolution_instance(instancia):
-                    # Buscar QR Code
-                    qr_code = get_qrcode_evolution(instancia)
+                    # QR Code chega pelo stream assim que o fluxo de conexão obtiver
+                    start_connect_flow(instancia)
                     return render_template('criar_numero.html', 
                                          instancia=instancia, 
-                                         qr_code=qr_code,
+                                         qr_code=None,
+                                         connect_pending=True,
                                          show_qr=True)
                 else:
                     return render_template('criar_numero.html', 
@@ -728,25 +3536,17 @@ def criar_numero():
             if not all([numero, remotejid, descricao, instancia]):
                 return render_template('criar_numero.html', error='Todos os campos são obrigatórios')
             
-            # Verificar se a instância está conectada com múltiplas tentativas
-            status = None
-            max_attempts = 3
-            for attempt in range(max_attempts):
-                status = get_instance_status(instancia)
-                print(f"Tentativa {attempt + 1} de verificação de status: {status}")
-                
-                if status == 'open':
-                    break
-                    
-                # Aguardar um pouco antes da próxima tentativa
-                if attempt < max_attempts - 1:
-                    time.sleep(2)
+            # A página só libera o botão depois que o stream confirma a conexão;
+            # aqui basta uma consulta direta ao estado atual, sem esperas
+            status = fetch_connection_state(instancia)
+            print(f"Verificação de status antes de salvar: {status}")
             
             if status != 'open':
-                qr_code = get_qrcode_evolution(instancia)
+                start_connect_flow(instancia)
                 return render_template('criar_numero.html', 
                                      instancia=instancia,
-                                     qr_code=qr_code,
+                                     qr_code=None,
+                                     connect_pending=True,
                                      show_qr=True,
                                      error=f'WhatsApp ainda não está conectado (Status: {status}). Escaneie o QR Code novamente.')
             
@@ -765,22 +3565,15 @@ def check_instance_status(instance_name):
         return {'status': 'error', 'message': 'Não autorizado'}, 401
     
     try:
-        # Verificar status com múltiplas tentativas para maior confiabilidade
-        status = None
-        for attempt in range(2):
-            status = get_instance_status(instance_name)
-            if status and status != 'close':
-                break
-            if attempt == 0:  # Só dar timeout na primeira tentativa
-                time.sleep(1)
-        
+        # Status vem do snapshot compartilhado do fetchInstances
+        status = get_instance_status(instance_name)
         qr_code = None
         
         print(f"Status da instância {instance_name}: {status}")
         
-        # Se não está conectado, tentar buscar QR Code
+        # Se não está conectado, reaproveita o QR Code recente ou busca um novo
         if status not in ['open', 'connected', 'online']:
-            qr_code = get_qrcode_evolution(instance_name)
+            qr_code = get_cached_qr_code(instance_name) or get_qrcode_evolution(instance_name)
             print(f"QR Code obtido: {'Sim' if qr_code else 'Não'}")
         
         # Mapear status para valores mais claros
@@ -791,6 +3584,7 @@ def check_instance_status(instance_name):
             'connected': connected,
             'qr_code': qr_code,
             'timestamp': int(time.time()),
+            'snapshot_age': get_instances_snapshot_age(),
             'instance_name': instance_name
         }
     except Exception as e:
@@ -804,6 +3598,75 @@ def check_instance_status(instance_name):
             'instance_name': instance_name
         }, 500
 
+@app.route('/api/instance-events/<string:instance_name>')
+def instance_events(instance_name):
+    """Stream (Server-Sent Events) com as mudanças de status e os novos QR Codes da instância"""
+    if not logado:
+        return {'status': 'error', 'message': 'Não autorizado'}, 401
+    
+    def stream():
+        # A inscrição acontece dentro do gerador para que o finally sempre a desfaça
+        watcher, subscriber = subscribe_instance_events(instance_name)
+        deadline = time.time() + INSTANCE_EVENTS_MAX_SECONDS
+        try:
+            yield 'retry: 3000\n\n'
+            while time.time() < deadline:
+                try:
+                    event, data = subscriber.get(timeout=INSTANCE_EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    # Comentário SSE: mantém a conexão viva e detecta abas fechadas
+                    yield ': ping\n\n'
+                    continue
+                yield format_sse(event, data)
+        finally:
+            watcher.unsubscribe(subscriber)
+    
+    return Response(
+        stream(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/debug/instances')
+def debug_instances():
+    """Debug do monitor de instâncias: snapshot, intervalo atual e transições recentes"""
+    if not logado:
+        return redirect(url_for('login'))
+    
+    statuses = dict(get_instances_snapshot())
+    next_check_at = instance_monitor_state['next_check_at']
+    return {
+        'monitor_running': instance_monitor_state['running'],
+        'interval': instance_monitor_state['interval'],
+        'next_check_in': round(next_check_at - time.time(), 1) if next_check_at else None,
+        'snapshot_age': get_instances_snapshot_age(),
+        'last_error_at': instances_snapshot['last_error_at'],
+        'instances': {
+            name: {'status': status, 'history': get_instance_history(name)}
+            for name, status in statuses.items()
+        }
+    }
+
+@app.route('/debug/instance-watchers')
+def debug_instance_watchers():
+    """Debug dos watchers de instância ativos"""
+    if not logado:
+        return redirect(url_for('login'))
+    
+    with instance_watchers_lock:
+        watchers = list(instance_watchers.values())
+    return {
+        'watchers': [
+            {
+                'instance': watcher.instance_name,
+                'status': watcher.status,
+                'subscribers': len(watcher.subscribers),
+                'has_qr': watcher.qr_code is not None
+            }
+            for watcher in watchers
+        ]
+    }
+
 @app.route('/debug/qr/<string:instance_name>')
 def debug_qr(instance_name):
     """Debug para QR Code"""
@@ -818,7 +3681,108 @@ def debug_qr(instance_name):
         'qr_code': qr_code,
         'status': status,
         'has_qr': qr_code is not None,
-        'qr_length': len(qr_code) if qr_code else 0
+        'qr_length': len(qr_code) if qr_code else 0,
+        'snapshot_age': get_instances_snapshot_age()
+    }
+
+@app.route('/debug/db-pool')
+def debug_db_pool():
+    """Debug para os pools de conexão MySQL"""
+    if not logado:
+        return redirect(url_for('login'))
+    
+    return {
+        'pools': get_db_pool_metrics(),
+        'pool_timeout': DB_POOL_TIMEOUT
+    }
+
+@app.route('/debug/cache')
+def debug_cache():
+    """Debug do cache de chats e mensagens"""
+    if not logado:
+        return redirect(url_for('login'))
+    
+    return {'chat_cache': chat_cache.metrics()}
+
+@app.route('/webhook/evolution', methods=['POST'])
+def webhook_evolution():
+    """Recebe eventos da Evolution (MESSAGES_UPSERT) e os enfileira para gravação em lote"""
+    token = request.headers.get('X-Webhook-Token') or request.args.get('token', '')
+    if not INBOUND_WEBHOOK_TOKEN or not hmac.compare_digest(token.encode(), INBOUND_WEBHOOK_TOKEN.encode()):
+        return {'status': 'error', 'message': 'Não autorizado'}, 401
+    
+    event = request.get_json(silent=True)
+    events = event if isinstance(event, list) else [event] if isinstance(event, dict) else []
+    rows = [row for item in events for row in parse_upsert_event(item)]
+    if not rows:
+        return {'status': 'ignored'}
+    
+    start_inbound_writer()
+    try:
+        inbound_queue.put_nowait(rows)
+    except queue.Full:
+        with inbound_lock:
+            inbound_metrics['rejected'] += len(rows)
+        return {'status': 'error', 'message': 'Fila cheia'}, 503
+    with inbound_lock:
+        inbound_metrics['received'] += len(rows)
+    return {'status': 'queued', 'messages': len(rows)}
+
+@app.route('/debug/inbound')
+def debug_inbound():
+    """Debug do webhook de entrada"""
+    if not logado:
+        return redirect(url_for('login'))
+    
+    with inbound_lock:
+        return dict(inbound_metrics, queue=inbound_queue.qsize(), local_chat_store=use_local_chat_store())
+
+@app.route('/api/jobs/<string:job_id>')
+def job_status(job_id):
+    """API para acompanhar o estágio e o progresso de um job de disparo"""
+    if not logado:
+        return {'status': 'error', 'message': 'Não autorizado'}, 401
+    
+    job = get_job(job_id)
+    if not job:
+        return {'status': 'error', 'message': 'Job não encontrado'}, 404
+    return job
+
+@app.route('/api/videos/<string:digest>')
+def api_video_exists(digest):
+    """Informa se um vídeo com este sha256 já está no MinIO (o formulário então não reenvia o arquivo)"""
+    if not logado:
+        return {'status': 'error', 'message': 'Não autorizado'}, 401
+    return {'status': 'success', 'exists': find_stored_video(digest.lower()) is not None}
+
+@app.route('/api/preview-mensagens', methods=['POST'])
+def preview_mensagens():
+    """API para pré-visualizar as primeiras mensagens personalizadas da planilha"""
+    if not logado:
+        return {'status': 'error', 'message': 'Não autorizado'}, 401
+    
+    file = request.files.get('excel_file')
+    message = request.form.get('message', '').strip()
+    if not message:
+        return {'status': 'error', 'message': 'Mensagem principal é obrigatória'}, 400
+    if not file or not file.filename.endswith('.xlsx'):
+        return {'status': 'error', 'message': 'Por favor, selecione um arquivo Excel válido (.xlsx)'}, 400
+    
+    templates = compile_message_templates(message, request.form.get('message2', '').strip(), request.form.get('message3', '').strip())
+    limit = min(request.args.get('limit', MESSAGE_PREVIEW_LIMIT, type=int), 50)
+    leads = iter_leads_from_excel(file.stream)
+    try:
+        preview = preview_campaign_messages(templates, normalize_leads(leads, {}), limit)
+    except Exception as e:
+        return {'status': 'error', 'message': f'Erro ao ler a planilha: {str(e)}'}, 400
+    finally:
+        leads.close()
+    
+    return {
+        'status': 'success',
+        'variantes': len(templates),
+        'variaveis': sorted({key for template in templates for key in template.variables}),
+        'mensagens': preview
     }
 
 @app.route('/debug/minio')
@@ -851,10 +3815,6 @@ def editar_numero(numero_id):
     if not logado:
         return redirect(url_for('login'))
     
-    connection = get_db_connection()
-    if not connection:
-        return redirect(url_for('numeros'))
-    
     if request.method == 'POST':
         nova_descricao = request.form.get('descricao', '').strip()
         link_planilha = request.form.get('link_planilha', '').strip()
@@ -862,6 +3822,10 @@ def editar_numero(numero_id):
             if update_whatsapp_number_description(numero_id, nova_descricao, link_planilha):
                 return redirect(url_for('numeros'))
     
+    connection = get_db_connection()
+    if not connection:
+        return redirect(url_for('numeros'))
+    
     # Buscar dados do número
     try:
         cursor = connection.cursor(dictionary=True)
@@ -877,9 +3841,7 @@ def editar_numero(numero_id):
         print(f"Erro ao buscar número: {e}")
         return redirect(url_for('numeros'))
     finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+        release_db_connection(connection, cursor)
 
 @app.route('/numeros/remover/<int:numero_id>', methods=['POST'])
 def remover_numero(numero_id):
@@ -893,81 +3855,100 @@ def remover_numero(numero_id):
         else:
             # Se não conseguiu remover, volta para a lista com erro
             numbers = get_whatsapp_numbers()
-            return render_template('numeros.html', 
-                                 numbers=numbers, 
-                                 error='Erro ao remover o número. Verifique se ele existe.')
+            return render_numeros(numbers=numbers,
+                                  error='Erro ao remover o número. Verifique se ele existe.')
     except Exception as e:
         print(f"Erro ao remover número: {e}")
         numbers = get_whatsapp_numbers()
-        return render_template('numeros.html', 
-                             numbers=numbers, 
-                             error=f'Erro ao remover número: {str(e)}')
+        return render_numeros(numbers=numbers,
+                              error=f'Erro ao remover número: {str(e)}')
 
 @app.route('/chats/<string:instancia>')
 def visualizar_chats(instancia):
-    """Visualiza todos os chats de uma instância"""
+    """Visualiza os chats de uma instância (primeira página; as demais são carregadas sob demanda)"""
     if not logado:
         return redirect(url_for('login'))
     
-    # Buscar todos os contatos/chats da instância
-    contacts = get_contacts_from_instance(instancia)
+    contacts, next_cursor, total = get_instance_chats(instancia)
     remote_jid = request.args.get('remoteJid')
     messages = []
     contact_info = None
+    selected_contact = None
     if remote_jid:
         messages, contact_info = get_messages_and_info(instancia, remote_jid)
+        selected_contact = next((contact for contact in contacts if contact['remoteJid'] == remote_jid), None)
     return render_template('chats.html', 
                          contacts=contacts,
+                         next_cursor=next_cursor,
+                         total_contacts=total,
                          instancia=instancia,
                          selected_jid=remote_jid,
+                         selected_contact=selected_contact,
                          messages=messages,
+                         page_size=CHAT_MESSAGES_PAGE_SIZE,
                          contact_info=contact_info)
 
-def get_messages_and_info(instance_name, remote_jid, limit=50):
-    """Busca mensagens e info do contato via Evolution API"""
-    base_url = os.getenv('EVOLUTION_BASE_URL', '')
-    headers = get_evolution_api_headers()
-    messages = []
+@app.route('/api/chats/<string:instancia>')
+def api_chats(instancia):
+    """API paginada da lista de chats: ?cursor=...&q=busca&limit=N"""
+    if not logado:
+        return {'status': 'error', 'message': 'Não autorizado'}, 401
+    
+    limit = min(request.args.get('limit', CHATS_PAGE_SIZE, type=int), 200)
+    contacts, next_cursor, total = get_instance_chats(
+        instancia,
+        cursor=request.args.get('cursor'),
+        search=request.args.get('q'),
+        limit=limit
+    )
+    return {'status': 'success', 'chats': contacts, 'next_cursor': next_cursor, 'total': total}
+
+def get_messages_and_info(instance_name, remote_jid, limit=CHAT_MESSAGES_PAGE_SIZE):
+    """Busca as mensagens mais recentes e info do contato via Evolution API"""
+    messages = fetch_chat_messages(instance_name, remote_jid, limit=limit)
     contact_info = None
-    try:
-        url = f"{base_url}/chat/findMessages/{instance_name}"
-        payload = {
-            "where": {
-                "key": {
-                    "remoteJid": remote_jid
-                }
-            },
-            "limit": limit
+    # Info do contato
+    if messages and 'key' in messages[0]:
+        contact_info = {
+            'remoteJid': messages[0]['key']['remoteJid'],
+            'fromMe': messages[0]['key'].get('fromMe', False),
+            'pushName': next((msg.get('pushName') for msg in messages if not msg['key'].get('fromMe') and msg.get('pushName')), '')
         }
-        response = requests.post(url, json=payload, headers=headers, timeout=15)
-        if response.status_code == 200:
-            data = response.json()
-            records = data.get('messages', {}).get('records', [])
-            for msg in records:
-                # Formatar timestamp e subtrair 3 horas
-                if msg.get('messageTimestamp'):
-                    import datetime
-                    try:
-                        dt = datetime.datetime.fromtimestamp(int(msg['messageTimestamp'])) - datetime.timedelta(hours=3)
-                        msg['formatted_time'] = dt.strftime('%d/%m/%Y %H:%M')
-                    except:
-                        msg['formatted_time'] = 'Data inválida'
-                else:
-                    msg['formatted_time'] = 'Sem data'
-                messages.append(msg)
-            # Info do contato
-            if records and 'key' in records[0]:
-                contact_info = {
-                    'remoteJid': records[0]['key']['remoteJid'],
-                    'fromMe': records[0]['key'].get('fromMe', False),
-                    'pushName': records[0].get('pushName', '')
-                }
-        else:
-            print(f"❌ Erro ao buscar mensagens na Evolution API: {response.status_code} - {response.text}")
-    except Exception as e:
-        print(f"❌ Erro ao buscar mensagens na Evolution API: {e}")
     return messages, contact_info
 
+@app.route('/api/mensagens/<string:instancia>/<string:remote_jid>')
+def api_mensagens(instancia, remote_jid):
+    """API do histórico: ?after=ts (novas desde ts) ou ?before=ts (mais antigas) e &limit=N
+
+    O cursor completo é (timestamp, id): after_id / before_id com o id de newest / oldest.
+    has_more indica que há mais páginas na mesma direção: o cliente busca de novo a partir de newest (ou oldest)
+    """
+    if not logado:
+        return {'status': 'error', 'message': 'Não autorizado'}, 401
+    
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    after_id = request.args.get('after_id') or None
+    before_id = request.args.get('before_id') or None
+    limit = min(request.args.get('limit', CHAT_MESSAGES_PAGE_SIZE, type=int), 200)
+    messages = [
+        serialize_message(msg)
+        for msg in fetch_chat_messages(instancia, remote_jid, after=after, before=before, limit=limit, after_id=after_id, before_id=before_id)
+    ]
+    return {
+        'status': 'success',
+        'messages': messages,
+        'newest': messages[-1]['messageTimestamp'] if messages else after,
+        'newest_id': messages[-1]['id'] if messages else after_id,
+        'oldest': messages[0]['messageTimestamp'] if messages else before,
+        'oldest_id': messages[0]['id'] if messages else before_id,
+        # Sem id no cursor, uma página inteira no mesmo segundo não avança: para evitar o laço infinito
+        'has_more': len(messages) >= limit and (
+            (before is not None and (before_id is not None or messages[0]['messageTimestamp'] < before))
+            or (after is not None and (after_id is not None or messages[-1]['messageTimestamp'] > after))
+        )
+    }
+
 @app.route('/mensagens/<string:instancia>/<string:remote_jid>')
 def visualizar_mensagens(instancia, remote_jid):
     """Visualiza mensagens de uma conversa"""
@@ -990,16 +3971,30 @@ def visualizar_mensagens(instancia, remote_jid):
         except Error as e:
             print(f"Erro ao buscar contato: {e}")
         finally:
-            if connection.is_connected():
-                cursor.close()
-                connection.close()
+            release_db_connection(connection, cursor)
     
     return render_template('mensagens.html', 
                          messages=messages, 
+                         page_size=CHAT_MESSAGES_PAGE_SIZE,
                          contact_info=contact_info,
                          remote_jid=remote_jid,
                          instancia=instancia)
 
+def render_index(**context):
+    """Renderiza a página de disparo com as opções padrão do formulário"""
+    return render_template(
+        'index.html',
+        render_default=MESSAGE_RENDER_DEFAULT,
+        precheck_default=WHATSAPP_PRECHECK_DEFAULT,
+        dispatch_backend=DISPATCH_BACKEND,
+        status_age=get_instances_snapshot_age(),
+        **context
+    )
+
+def render_numeros(**context):
+    """Renderiza a lista de números com a idade do snapshot de status"""
+    return render_template('numeros.html', status_age=get_instances_snapshot_age(), **context)
+
 @app.route('/', methods=['GET', 'POST'])
 def index():# Verifica se o usuário está autenticado
     if not logado:
@@ -1011,190 +4006,145 @@ def index():# Verifica se o usuário está autenticado
     if request.method == 'POST':
         # Verificar se todos os campos obrigatórios estão presentes
         if 'excel_file' not in request.files:
-            return render_template('index.html', error='Arquivo Excel é obrigatório', numbers=numbers)
+            return render_index(error='Arquivo Excel é obrigatório', numbers=numbers)
         
         file = request.files['excel_file']
         if file.filename == '':
-            return render_template('index.html', error='Nenhum arquivo Excel foi selecionado', numbers=numbers)
+            return render_index(error='Nenhum arquivo Excel foi selecionado', numbers=numbers)
             
         message = request.form.get('message', '').strip()
         message2 = request.form.get('message2', '').strip()
         message3 = request.form.get('message3', '').strip()
         
         if not message:
-            return render_template('index.html', error='Mensagem principal é obrigatória', numbers=numbers)
+            return render_index(error='Mensagem principal é obrigatória', numbers=numbers)
 
-        instancia = request.form.get('whatsapp_number', '').strip()
-        if not instancia:
-            return render_template('index.html', error='Selecione um número do WhatsApp', numbers=numbers)
+        # Um ou mais números: com vários, os leads são divididos entre as instâncias
+        instancias = list(dict.fromkeys(value.strip() for value in request.form.getlist('whatsapp_number') if value.strip()))
+        if not instancias:
+            return render_index(error='Selecione um número do WhatsApp', numbers=numbers)
+        instancia = instancias[0]
             
-        # Buscar link_planilha da instância selecionada
-        link_planilha = None
-        connection = get_db_connection()
-        if connection:
-            try:
-                cursor = connection.cursor(dictionary=True)
-                query = "SELECT link_planilha FROM numeros WHERE instancia = %s LIMIT 1"
-                cursor.execute(query, (instancia,))
-                result = cursor.fetchone()
-                if result:
-                    link_planilha = result.get('link_planilha')
-            except Error as e:
-                print(f"Erro ao buscar link_planilha: {e}")
-            finally:
-                if connection.is_connected():
-                    cursor.close()
-                    connection.close()
+        # Buscar link_planilha das instâncias selecionadas (já carregado junto com os números)
+        links_planilha = {
+            number['instancia']: number.get('link_planilha') for number in numbers if number['instancia'] in instancias
+        }
+        link_planilha = links_planilha.get(instancia)
             
         data_agendamento = request.form.get('schedule_date') if request.form.get('schedule_date') else None
         horario_agendamento = request.form.get('schedule_time') if request.form.get('schedule_time') else None
-        haImg = False
-        haVideo = False
-        leads = []
-
-        # Processar imagem se fornecida
-        image_base64 = None
-        if 'image_file' in request.files and request.files['image_file'] and request.files['image_file'].filename:
-            haImg = True
-            image_file = request.files['image_file']
-            print(f"Arquivo de imagem detectado: {image_file.filename}")
-            
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_file.filename)
-            image_file.save(image_path)
-            with open(image_path, "rb") as img_file:
-                image_base64 = base64.b64encode(img_file.read()).decode('utf-8')
-                print(f"Imagem convertida para base64, tamanho: {len(image_base64)} caracteres")
-
-        # Processar vídeo se fornecida
-        video_url = None
-        if 'video_file' in request.files and request.files['video_file'] and request.files['video_file'].filename:
-            video_file = request.files['video_file']
-            print(f"Arquivo de vídeo detectado: {video_file.filename}")
-            
-            # Verificar se é MP4
-            if not video_file.filename.lower().endswith('.mp4'):
-                print("Erro: Arquivo não é MP4")
-                return render_template('index.html', error='Apenas arquivos MP4 são permitidos para vídeo', numbers=numbers)
-            
-            try:
-                haVideo = True
-                video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_file.filename)
-                video_file.save(video_path)
-                print(f"Vídeo salvo temporariamente em: {video_path}")
-                
-                # Verificar tamanho do arquivo
-                video_size_mb = os.path.getsize(video_path) / (1024 * 1024)
-                print(f"Tamanho do vídeo: {video_size_mb:.2f} MB")
-                
-                # Verificar se o vídeo não é muito grande (limite de 100MB para MinIO)
-                if video_size_mb > 100:
-                    os.remove(video_path)  # Limpar arquivo temporário
-                    print("Erro: Vídeo muito grande")
-                    return render_template('index.html', error=f'Vídeo muito grande ({video_size_mb:.1f}MB). Máximo permitido: 100MB', numbers=numbers)
-                
-                # Upload para MinIO
-                video_url = upload_video_to_minio(video_path, video_file.filename)
-                print(f"Vídeo enviado para MinIO com sucesso")
-                
-                # Remover arquivo temporário
-                os.remove(video_path)
-                print(f"Arquivo temporário removido: {video_path}")
-                
-            except Exception as e:
-                print(f"Erro ao processar vídeo: {e}")
-                return render_template('index.html', error=f'Erro ao processar vídeo: {str(e)}', numbers=numbers)
+        
+        if not file.filename.endswith('.xlsx'):
+            return render_index(error='Por favor, selecione um arquivo Excel válido (.xlsx)', numbers=numbers)
+        
+        try:
+            scheduled_at = parse_schedule(data_agendamento, horario_agendamento)
+        except ValueError:
+            return render_index(error='Data ou horário de agendamento inválido', numbers=numbers)
+        
+        job_id = create_job(f"Disparo {', '.join(instancias)}")
+        campaign = {
+            'message': message,
+            'message2': message2,
+            'message3': message3,
+            'instancia': instancia,
+            'instancias': instancias,
+            'link_planilha': link_planilha,
+            'links_planilha': links_planilha,
+            'data_agendamento': data_agendamento,
+            'horario_agendamento': horario_agendamento,
+            'scheduled_at': scheduled_at,
+            'render_messages': request.form.get('render_messages') == 'on',
+            'precheck_numbers': request.form.get('precheck_numbers') == 'on',
+            'dispatch_backend': 'evolution' if request.form.get('dispatch_backend') == 'evolution' else 'webhook',
+            'excel_path': None,
+            'image': None,
+            'video': None
+        }
 
         try:
-            if file and file.filename.endswith('.xlsx'):
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-                file.save(filepath)
-
-                df = pd.read_excel(filepath)
-                data_list = df.to_dict(orient='records')
-
-                print("Mensagem principal:", message)
-                print("Mensagem 2:", message2 if message2 else "Não informada")
-                print("Mensagem 3:", message3 if message3 else "Não informada")
-                print("Número WhatsApp selecionado:", instancia)
-                print("Data agendamento:", data_agendamento)
-                print("Horário agendamento:", horario_agendamento)
-                print("Tem imagem:", haImg)
-                print("Tem vídeo:", haVideo)
-                print("Dados importados:")
-                for row in data_list:
-                    filial = row.get('Filial')
-                    data = row.get('Data')
-                    nome = row.get('Nome Cliente')
-                    plano = row.get('Plano')
-                    telefone = row.get('Acesso')
-                    complemento = row.get('Complemento')
-
-                    leads.append({
-                        'filial': str(filial) if filial else '',
-                        'data': str(data) if data else '',
-                        'nome': str(nome) if nome else '',
-                        'plano': str(plano) if plano else '',
-                        'telefone': str(telefone) if telefone else '',
-                        'complemento': str(complemento) if complemento else ''
-                    })
-
-                payload = {
-                    'message': message,
-                    'message2': message2 if message2 else message,
-                    'message3': message3 if message3 else message,
-                    'leads': leads,
-                    'haImg': haImg,
-                    'base64': image_base64 if haImg else None,
-                    'haVideo': haVideo,
-                    'video_url': video_url if haVideo else None,
-                    'data_agendamento': data_agendamento,
-                    'horario_agendamento': horario_agendamento,
-                    'instancia': instancia,
-                    'link_planilha': link_planilha
+            # Processar imagem se fornecida
+            if 'image_file' in request.files and request.files['image_file'] and request.files['image_file'].filename:
+                image_file = request.files['image_file']
+                print(f"Arquivo de imagem detectado: {image_file.filename}")
+                campaign['image'] = {
+                    'bytes': image_file.read(),
+                    'filename': image_file.filename,
+                    'mimetype': image_file.mimetype
                 }
 
-                # Log do payload sem os base64 (que são muito grandes)
-                payload_debug = {
-                    'message': message,
-                    'message2': message2 if message2 else None,
-                    'message3': message3 if message3 else None,
-                    'leads_count': len(leads),
-                    'haImg': haImg,
-                    'base64_size': len(image_base64) if image_base64 else 0,
-                    'haVideo': haVideo,
-                    'video_url': video_url if video_url else None,
-                    'data_agendamento': data_agendamento,
-                    'horario_agendamento': horario_agendamento,
-                    'instancia': instancia,
-                    'link_planilha': link_planilha
-                }
-                print("Payload debug:", payload_debug)
+            # Vídeo já guardado no MinIO: o navegador calculou o hash e não enviou o arquivo
+            video_sha256 = request.form.get('video_sha256', '').strip().lower()
+            if video_sha256 and not request.files.get('video_file'):
+                object_name = find_stored_video(video_sha256)
+                if not object_name:
+                    error = fail_campaign_job(job_id, campaign, 'Vídeo não encontrado no MinIO, selecione o arquivo novamente')
+                    return render_index(error=error, numbers=numbers)
+                print(f"Reaproveitando vídeo já enviado: {object_name}")
+                campaign['video'] = {'object_name': object_name, 'filename': os.path.basename(object_name)}
+
+            # Processar vídeo se fornecida
+            if 'video_file' in request.files and request.files['video_file'] and request.files['video_file'].filename:
+                video_file = request.files['video_file']
+                print(f"Arquivo de vídeo detectado: {video_file.filename}")
                 
-                # Usar timeout maior para vídeos
-                timeout_seconds = 300 if haVideo else 60  # 5 minutos para vídeo, 1 minuto para outros
-                print(f"Enviando para webhook com timeout de {timeout_seconds} segundos...")
+                # Verificar se é MP4
+                if not video_file.filename.lower().endswith('.mp4'):
+                    print("Erro: Arquivo não é MP4")
+                    error = fail_campaign_job(job_id, campaign, 'Apenas arquivos MP4 são permitidos para vídeo')
+                    return render_index(error=error, numbers=numbers)
                 
-                try:
-                    response = requests.post('https://rede-confianca-n8n.lpl0df.easypanel.host/webhook/disparo-rede-confianca', 
-                                           json=payload, 
-                                           timeout=timeout_seconds)
-                    print("Resposta do webhook:", response.status_code, response.text)
-                    return render_template('index.html', success=True, data=payload_debug, numbers=numbers)
-                except requests.exceptions.Timeout:
-                    print("Erro: Timeout na requisição do webhook")
-                    return render_template('index.html', error='Timeout ao enviar dados para o webhook. Tente com um vídeo menor.', numbers=numbers)
-                except requests.exceptions.RequestException as e:
-                    print(f"Erro na requisição do webhook: {e}")
-                    return render_template('index.html', error=f'Erro ao enviar dados para o webhook: {str(e)}', numbers=numbers)
-            else:
-                return render_template('index.html', error='Por favor, selecione um arquivo Excel válido (.xlsx)', numbers=numbers)
-            
+                # Vídeo sendo enviado ao MinIO em streaming durante o recebimento da requisição
+                if isinstance(video_file.stream, MinioStreamUpload):
+                    if video_file.stream.too_large:
+                        print("Erro: Vídeo muito grande")
+                        error = fail_campaign_job(job_id, campaign, str(VideoTooLargeError(video_file.stream.size)))
+                        return render_index(error=error, numbers=numbers)
+                    campaign['video'] = {'upload': video_file.stream.claim(), 'filename': video_file.filename}
+                
+                # Fallback: salvar em disco para o job enviar com fput_object
+                else:
+                    video_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{job_id}.mp4")
+                    video_file.save(video_path)
+                    print(f"Vídeo salvo temporariamente em: {video_path}")
+                    
+                    # Verificar se o vídeo não é muito grande (limite de 100MB para MinIO)
+                    video_size = os.path.getsize(video_path)
+                    print(f"Tamanho do vídeo: {video_size / (1024 * 1024):.2f} MB")
+                    if video_size > VIDEO_MAX_BYTES:
+                        os.remove(video_path)  # Limpar arquivo temporário
+                        print("Erro: Vídeo muito grande")
+                        error = fail_campaign_job(job_id, campaign, str(VideoTooLargeError(video_size)))
+                        return render_index(error=error, numbers=numbers)
+                    campaign['video'] = {'path': video_path, 'filename': video_file.filename}
+
+            # A planilha é copiada para o job (o upload é fechado ao fim da requisição)
+            campaign['excel_path'] = os.path.join(app.config['UPLOAD_FOLDER'], f"{job_id}.xlsx")
+            file.save(campaign['excel_path'])
         except Exception as e:
             print(f"Erro durante o processamento: {str(e)}")
-            return render_template('index.html', error=f'Erro ao processar arquivo: {str(e)}', numbers=numbers)
+            fail_campaign_job(job_id, campaign, str(e))
+            return render_index(error=f'Erro ao processar arquivo: {str(e)}', numbers=numbers)
+
+        print("Mensagem principal:", message)
+        print("Mensagem 2:", message2 if message2 else "Não informada")
+        print("Mensagem 3:", message3 if message3 else "Não informada")
+        print("Número WhatsApp selecionado:", instancia)
+        print("Data agendamento:", data_agendamento)
+        print("Horário agendamento:", horario_agendamento)
+        print("Tem imagem:", bool(campaign['image']))
+        print("Tem vídeo:", bool(campaign['video']))
+        
+        enqueue_job(job_id, run_broadcast_job, campaign)
+        print(f"Disparo enfileirado: job {job_id}")
+        return render_index(success=True, job_id=job_id, numbers=numbers)
     
-    return render_template('index.html', success=False, numbers=numbers)
+    return render_index(success=False, numbers=numbers)
 
 if __name__ == '__main__':
+    if INSTANCE_MONITOR_ENABLED:
+        start_instance_monitor()
+    if SCHEDULER_ENABLED:
+        start_scheduler()
     app.run(host="0.0.0.0", port=5000)
     #app.run(host="0.0.0.0", port=5001, debug=True)
\ No newline at end of file
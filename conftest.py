@@ -0,0 +1,92 @@
+"""
+Fixtures compartilhadas pelos testes
+Banco em memória (sqlite) no lugar do pool MySQL, para testar as consultas do app sem servidor
+"""
+
+import os
+import re
+import sqlite3
+import threading
+
+import pytest
+
+os.environ.setdefault('INSTANCE_MONITOR_ENABLED', 'False')
+
+import app
+
+class FakeCursor:
+    """Cursor no formato do mysql.connector (placeholders %s, dictionary=True) sobre o sqlite"""
+
+    def __init__(self, db, dictionary):
+        self.db = db
+        self.dictionary = dictionary
+        self.cursor = db.connection.cursor()
+
+    @staticmethod
+    def translate(query):
+        query = query.replace('%s', '?')
+        query = query.replace('UTC_TIMESTAMP()', "datetime('now')")
+        # Upsert do MySQL no formato do sqlite
+        query = query.replace('ON DUPLICATE KEY UPDATE', 'ON CONFLICT DO UPDATE SET').replace('GREATEST(', 'MAX(')
+        query = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", query)
+        return re.sub(r"NOW\(\) - INTERVAL \? SECOND", "datetime('now', '-' || ? || ' seconds')", query)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def execute(self, query, params=()):
+        with self.db.lock:
+            self.db.queries.append(query)
+            self.cursor.execute(self.translate(query), tuple(params))
+
+    def executemany(self, query, rows):
+        with self.db.lock:
+            self.db.queries.append(query)
+            self.cursor.executemany(self.translate(query), rows)
+
+    def _row(self, row):
+        if row is None or not self.dictionary:
+            return row
+        return dict(zip([column[0] for column in self.cursor.description], row))
+
+    def fetchone(self):
+        return self._row(self.cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self.cursor.fetchall()]
+
+    def close(self):
+        self.cursor.close()
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(self.db, dictionary)
+
+    def commit(self):
+        self.db.connection.commit()
+
+class FakeDatabase:
+    """Banco sqlite compartilhado entre as threads do teste; `queries` guarda o SQL executado"""
+
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.lock = threading.RLock()
+        self.queries = []
+
+    def execute(self, query, params=()):
+        with self.lock:
+            result = self.connection.execute(query, params).fetchall()
+            self.connection.commit()
+            return result
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeDatabase()
+    monkeypatch.setattr(app, 'get_db_connection', lambda: FakeConnection(db))
+    monkeypatch.setattr(app, 'release_db_connection', lambda connection, cursor=None: None)
+    yield db
+    db.connection.close()
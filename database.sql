@@ -16,6 +16,60 @@ CREATE TABLE IF NOT EXISTS whatsapp_numbers (
 CREATE INDEX IF NOT EXISTS idx_remotejid ON whatsapp_numbers(remotejid);
 CREATE INDEX IF NOT EXISTS idx_instancia ON whatsapp_numbers(instancia);
 
+-- Tabela de campanhas agendadas (disparadas pelo agendador do app no horário)
+-- O app também cria esta tabela automaticamente se ela não existir
+CREATE TABLE IF NOT EXISTS campanhas_agendadas (
+    id VARCHAR(32) PRIMARY KEY,
+    instancia VARCHAR(50) NOT NULL,
+    scheduled_at DATETIME NOT NULL, -- horário em UTC
+    status VARCHAR(20) NOT NULL DEFAULT 'pending', -- pending, running, done, failed, interrupted (volte para pending para reenviar)
+    campaign LONGTEXT NOT NULL, -- mensagens, mídias e caminho da planilha (JSON)
+    error TEXT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, -- renovado pelo heartbeat enquanto running
+    INDEX idx_status_scheduled (status, scheduled_at)
+);
+
+-- Cache da verificação de números no WhatsApp (reconsultados após WHATSAPP_CHECK_TTL_DAYS)
+-- O app também cria esta tabela automaticamente se ela não existir
+CREATE TABLE IF NOT EXISTS whatsapp_checks (
+    numero VARCHAR(20) PRIMARY KEY,
+    existe BOOLEAN NOT NULL,
+    jid VARCHAR(100) NULL,
+    checked_at DATETIME NOT NULL, -- horário em UTC
+    INDEX idx_checked_at (checked_at)
+);
+
+-- Conversas e mensagens recebidas pelo webhook de entrada (/webhook/evolution)
+-- O app também cria estas tabelas automaticamente se elas não existirem
+CREATE TABLE IF NOT EXISTS chat_conversas (
+    instancia VARCHAR(50) NOT NULL,
+    remote_jid VARCHAR(100) NOT NULL,
+    push_name VARCHAR(255) NULL,
+    last_message_timestamp BIGINT NOT NULL, -- messageTimestamp (segundos) da mensagem mais recente
+    PRIMARY KEY (instancia, remote_jid),
+    INDEX idx_instancia_ultima (instancia, last_message_timestamp)
+);
+
+CREATE TABLE IF NOT EXISTS chat_mensagens (
+    instancia VARCHAR(50) NOT NULL,
+    message_id VARCHAR(100) NOT NULL,
+    remote_jid VARCHAR(100) NOT NULL,
+    from_me BOOLEAN NOT NULL,
+    push_name VARCHAR(255) NULL,
+    message_type VARCHAR(50) NULL,
+    message_timestamp BIGINT NOT NULL,
+    payload LONGTEXT NOT NULL, -- key, pushName, message, messageType e messageTimestamp do evento (JSON)
+    PRIMARY KEY (instancia, message_id),
+    INDEX idx_chat_timestamp (instancia, remote_jid, message_timestamp)
+);
+
+-- Instâncias cujas conversas anteriores ao webhook já foram copiadas da Evolution para chat_conversas
+CREATE TABLE IF NOT EXISTS chat_backfill (
+    instancia VARCHAR(50) PRIMARY KEY,
+    concluido_em DATETIME NOT NULL
+);
+
 -- Inserir alguns dados de exemplo (opcional)
 -- INSERT INTO whatsapp_numbers (numero, remotejid, descricao, instancia) VALUES
 -- ('+5511999999999', '5511999999999@s.whatsapp.net', 'WhatsApp Principal - Vendas', 'instance_01'),
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Testes do agendador de campanhas
+Campanhas interrompidas (sem heartbeat) não são reenviadas automaticamente
+"""
+
+import pytest
+
+import app
+
+def create_schedule_table(fake_db, rows):
+    fake_db.execute("""
+        CREATE TABLE campanhas_agendadas (
+            id TEXT PRIMARY KEY,
+            instancia TEXT NOT NULL,
+            scheduled_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            campaign TEXT NOT NULL DEFAULT '{}',
+            error TEXT NULL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    for schedule_id, status, updated_at in rows:
+        fake_db.execute(
+            f"INSERT INTO campanhas_agendadas (id, instancia, scheduled_at, status, updated_at) VALUES (?, 'loja1', '2026-01-01 12:00:00', ?, {updated_at})",
+            (schedule_id, status)
+        )
+
+def test_campanha_sem_heartbeat_fica_interrompida(fake_db, monkeypatch):
+    print("🧪 TESTE DE RECUPERAÇÃO DE AGENDAMENTOS")
+    print("=" * 50)
+
+    create_schedule_table(fake_db, [
+        ('caiu', 'running', "datetime('now', '-1 hour')"),
+        ('neste_processo', 'running', "datetime('now', '-1 hour')"),
+        ('com_heartbeat', 'running', "datetime('now')"),
+        ('pendente', 'pending', "datetime('now', '-1 hour')"),
+    ])
+    scheduled = []
+    monkeypatch.setattr(app, 'ensure_scheduled_campaigns_table', lambda cursor: None)
+    monkeypatch.setattr(app, 'schedule_campaign_run', lambda schedule_id, scheduled_at: scheduled.append(schedule_id))
+    monkeypatch.setitem(app.scheduler_state, 'running', {'neste_processo'})
+
+    assert app.load_pending_campaigns()
+
+    statuses = dict(fake_db.execute("SELECT id, status FROM campanhas_agendadas"))
+    print(f"   Status: {statuses}")
+    assert statuses == {
+        'caiu': 'interrupted',
+        'neste_processo': 'running',
+        'com_heartbeat': 'running',
+        'pendente': 'pending'
+    }
+    # Só o que já estava pendente volta para o heap: a interrompida não é reenviada
+    assert scheduled == ['pendente']
+    print("   ✅ Interrompida marcada, em execução preservada")
+
+def test_campanha_em_execucao_registrada_no_processo(monkeypatch):
+    """run_scheduled_campaign registra a campanha enquanto roda e a libera ao terminar (mesmo com erro)"""
+    seen = []
+
+    def load(schedule_id):
+        seen.append(set(app.scheduler_state['running']))
+        raise Exception('banco fora')
+
+    monkeypatch.setitem(app.scheduler_state, 'running', set())
+    monkeypatch.setattr(app, 'load_scheduled_campaign', load)
+    monkeypatch.setattr(app, 'update_scheduled_campaign', lambda *args, **kwargs: True)
+
+    with pytest.raises(Exception, match='banco fora'):
+        app.run_scheduled_campaign('job', 'agendamento')
+
+    assert seen == [{'agendamento'}]
+    assert app.scheduler_state['running'] == set()
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-s']))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Testes do cache LRU de chats e mensagens
+Descarte dos menos usados por quantidade e por bytes, TTL, invalidação por prefixo e métricas
+"""
+
+import pytest
+
+import app
+
+def test_descarta_menos_usado_por_quantidade():
+    cache = app.LRUCache(1024 * 1024, 3, 60)
+    for name in 'abc':
+        cache.set(('messages', 'loja1', name), name)
+
+    # Ler 'a' o torna recente: o próximo set descarta 'b'
+    assert cache.get(('messages', 'loja1', 'a')) == 'a'
+    cache.set(('messages', 'loja1', 'd'), 'd')
+
+    assert cache.get(('messages', 'loja1', 'b')) is None
+    assert [cache.get(('messages', 'loja1', name)) for name in 'acd'] == ['a', 'c', 'd']
+    assert cache.metrics()['evictions'] == 1
+
+def test_descarta_por_bytes():
+    print("🧪 TESTE DE LIMITE DE MEMÓRIA DO CACHE")
+    print("=" * 50)
+
+    value = ['x' * 96]  # 102 bytes serializado
+    size = app.LRUCache.estimate_size(value)
+    cache = app.LRUCache(3 * size, 100, 60)
+    for k in range(5):
+        cache.set(('chats', 'loja1', k), value)
+
+    metrics = cache.metrics()
+    print(f"   Métricas: {metrics}")
+    assert (metrics['entries'], metrics['bytes'], metrics['evictions']) == (3, 3 * size, 2)
+    assert [cache.get(('chats', 'loja1', k)) is not None for k in range(5)] == [False, False, True, True, True]
+
+    # Valor maior que o cache inteiro não entra (nem derruba os demais)
+    cache.set(('chats', 'loja1', 'grande'), 'x' * (4 * size))
+    assert cache.get(('chats', 'loja1', 'grande')) is None
+    assert cache.metrics()['entries'] == 3
+
+    # Substituir uma chave não conta o tamanho antigo duas vezes
+    cache.set(('chats', 'loja1', 4), ['y'])
+    assert cache.metrics()['bytes'] == 2 * size + app.LRUCache.estimate_size(['y'])
+    print("   ✅ Ocupação limitada pelos bytes estimados")
+
+def test_ttl_por_item(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+    cache = app.LRUCache(1024 * 1024, 100, 60)
+    cache.set(('messages', 'loja1', 'jid', 'recent'), [1], ttl=5)
+    cache.set(('messages', 'loja1', 'jid', 'old'), [2])
+
+    now[0] += 10
+    # A página recente expira antes; a de histórico usa o TTL padrão
+    assert cache.get(('messages', 'loja1', 'jid', 'recent')) is None
+    assert cache.get(('messages', 'loja1', 'jid', 'old')) == [2]
+    now[0] += 60
+    assert cache.get(('messages', 'loja1', 'jid', 'old')) is None
+
+    metrics = cache.metrics()
+    assert (metrics['expired'], metrics['hits'], metrics['misses'], metrics['entries'], metrics['bytes']) == (2, 1, 2, 0, 0)
+    assert metrics['hit_rate'] == 0.333
+
+def test_invalidacao_por_prefixo():
+    print("🧪 TESTE DE INVALIDAÇÃO DO CACHE")
+    print("=" * 50)
+
+    cache = app.LRUCache(1024 * 1024, 100, 60)
+    keys = [
+        ('messages', 'loja1', 'jid1', None, 50),
+        ('messages', 'loja1', 'jid1', 1700000000, 50),
+        ('messages', 'loja1', 'jid2', None, 50),
+        ('messages', 'loja2', 'jid1', None, 50),
+        ('chats', 'loja1', None, None, 50),
+        ('chats', 'loja1', 'all'),
+        ('chats', 'loja2', None, None, 50),
+    ]
+    for key in keys:
+        cache.set(key, key)
+
+    # Prefixo (tipo, instância, chat): só as páginas daquele chat
+    assert cache.invalidate('messages', 'loja1', 'jid1') == 2
+    # Vários prefixos de uma vez, incluindo um que não existe
+    assert cache.invalidate_many([('chats', 'loja1'), ('messages', 'loja3')]) == 2
+    assert [key for key in keys if cache.get(key) is not None] == [keys[2], keys[3], keys[6]]
+
+    # Prefixo sem índice (só o tipo) percorre as chaves
+    assert cache.invalidate('messages') == 2
+    assert list(cache.entries) == [keys[6]]
+    # Os índices por prefixo não guardam grupos vazios
+    assert set(cache.groups) == {('chats', 'loja2'), ('chats', 'loja2', None)}
+    assert cache.metrics()['invalidations'] == 6
+    print("   ✅ Só as chaves do prefixo foram removidas")
+
+def test_nova_mensagem_invalida_chat_e_lista(monkeypatch):
+    cache = app.LRUCache(1024 * 1024, 100, 60)
+    monkeypatch.setattr(app, 'chat_cache', cache)
+    for key in [('messages', 'loja1', 'jid1', None), ('messages', 'loja1', 'jid2', None), ('chats', 'loja1', None, None, 50)]:
+        cache.set(key, [])
+
+    app.invalidate_chat_cache('loja1', 'jid1')
+
+    assert list(cache.entries) == [('messages', 'loja1', 'jid2', None)]
+    monkeypatch.setattr(app, 'logado', True)
+    assert app.app.test_client().get('/debug/cache').get_json()['chat_cache']['entries'] == 1
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-s']))
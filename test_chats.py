@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Testes da leitura de chats pelas tabelas locais (gravadas pelo webhook de entrada)
+Paginação por keyset com empates de horário (chats e mensagens), total em cache e volta à Evolution quando o webhook para
+"""
+
+import json
+import time
+
+import pytest
+
+import app
+
+@pytest.fixture
+def chat_store(fake_db, monkeypatch):
+    """Tabelas locais no sqlite, webhook de entrada configurado e cache vazio"""
+    fake_db.execute("""
+        CREATE TABLE chat_conversas (
+            instancia TEXT NOT NULL,
+            remote_jid TEXT NOT NULL,
+            push_name TEXT NULL,
+            last_message_timestamp INTEGER NOT NULL,
+            PRIMARY KEY (instancia, remote_jid)
+        )
+    """)
+    fake_db.execute("""
+        CREATE TABLE chat_mensagens (
+            instancia TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            remote_jid TEXT NOT NULL,
+            from_me BOOLEAN NOT NULL,
+            push_name TEXT NULL,
+            message_type TEXT NULL,
+            message_timestamp INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (instancia, message_id)
+        )
+    """)
+    monkeypatch.setitem(app.inbound_state, 'tables_ready', True)
+    monkeypatch.setitem(app.inbound_state, 'last_stored_at', {})
+    monkeypatch.setattr(app, 'INBOUND_WEBHOOK_TOKEN', 'segredo')
+    monkeypatch.setattr(app, 'CHAT_SOURCE', 'local')
+    monkeypatch.setattr(app, 'chat_cache', app.LRUCache(10 * 1024 * 1024, 1000, 60))
+    return fake_db
+
+def test_chats_paginados_com_empates(chat_store):
+    print("🧪 TESTE DE PAGINAÇÃO DOS CHATS LOCAIS")
+    print("=" * 50)
+
+    # Vários chats com o mesmo horário: o remote_jid desempata sem repetir nem pular
+    rows = [('loja1', f"55119999900{k:02d}@s.whatsapp.net", f"Contato {k}", 1700000000 + k // 4) for k in range(10)]
+    rows.append(('loja2', '5511888888888@s.whatsapp.net', 'Outra loja', 1800000000))
+    for row in rows:
+        chat_store.execute("INSERT INTO chat_conversas VALUES (?, ?, ?, ?)", row)
+
+    seen = []
+    cursor = None
+    while True:
+        page, cursor, total = app.load_local_chats('loja1', cursor, limit=3)
+        seen.extend(chat['remoteJid'] for chat in page)
+        assert total == 10
+        if not cursor:
+            break
+
+    expected = [jid for _, jid, _, _ in sorted(rows[:10], key=lambda row: (row[3], row[1]), reverse=True)]
+    print(f"   Páginas: {len(seen)} chats")
+    assert seen == expected
+    # Sem comparação de tuplas e um único COUNT para as quatro páginas
+    assert not any('(last_message_timestamp, remote_jid) <' in query for query in chat_store.queries)
+    assert sum('COUNT(*)' in query for query in chat_store.queries) == 1
+    print("   ✅ Keyset sem repetições e total em cache")
+
+def test_busca_de_chats_tem_total_proprio(chat_store):
+    for k, name in enumerate(['Ana', 'Bruno', 'Ana Paula']):
+        chat_store.execute("INSERT INTO chat_conversas VALUES ('loja1', ?, ?, ?)", (f"5511999990{k:03d}@s.whatsapp.net", name, 1700000000 + k))
+
+    assert app.load_local_chats('loja1')[2] == 3
+    page, cursor, total = app.load_local_chats('loja1', search='Ana')
+    assert [chat['name'] for chat in page] == ['Ana Paula', 'Ana']
+    assert (cursor, total) == (None, 2)
+
+def test_polling_volta_para_evolution_sem_webhook_recente(chat_store, monkeypatch):
+    print("🧪 TESTE DE POLLING COM WEBHOOK PARADO")
+    print("=" * 50)
+
+    requests_made = []
+
+    class FakeResponse:
+        status_code = 200
+
+        def json(self):
+            return [{'key': {'id': 'evo', 'remoteJid': 'jid'}, 'messageTimestamp': 1700000100}]
+
+    def post(path, json=None, **kwargs):
+        requests_made.append(path)
+        return FakeResponse()
+
+    monkeypatch.setattr(app.evolution_client, 'post', post)
+
+    # Nenhuma mensagem gravada pelo webhook neste processo: o banco local vazio não é confiável
+    messages = app.fetch_chat_messages('loja1', 'jid', after=1700000000)
+    assert [msg['key']['id'] for msg in messages] == ['evo']
+    assert requests_made == ['/chat/findMessages/loja1']
+
+    # Com o webhook entregando eventos da instância, polling vazio fica no banco local
+    app.inbound_state['last_stored_at']['loja1'] = time.time()
+    assert app.fetch_chat_messages('loja1', 'jid', after=1700000200) == []
+    assert len(requests_made) == 1
+
+    # Eventos antigos demais: volta à Evolution
+    app.inbound_state['last_stored_at']['loja1'] = time.time() - app.INBOUND_STALE_AFTER - 1
+    app.fetch_chat_messages('loja1', 'jid', after=1700000300)
+    assert len(requests_made) == 2
+    print("   ✅ Evolution consultada só quando o webhook não está ativo")
+
+def insert_messages(chat_store, messages):
+    for message_id, timestamp in messages:
+        payload = json.dumps({'key': {'id': message_id, 'remoteJid': 'jid', 'fromMe': False}, 'message': {'conversation': message_id}})
+        chat_store.execute(
+            "INSERT INTO chat_mensagens VALUES ('loja1', ?, 'jid', 0, '', 'conversation', ?, ?)",
+            (message_id, timestamp, payload)
+        )
+
+def test_mensagens_paginadas_no_mesmo_segundo(chat_store, monkeypatch):
+    print("🧪 TESTE DE CURSOR DE MENSAGENS")
+    print("=" * 50)
+
+    # Sete mensagens no mesmo segundo, mais que uma página (limit=3)
+    messages = [('A0', 1700000000)] + [(f"B{k}", 1700000100) for k in range(7)] + [('C0', 1700000200)]
+    insert_messages(chat_store, messages)
+    app.inbound_state['last_stored_at']['loja1'] = time.time()
+    monkeypatch.setattr(app, 'logado', True)
+    client = app.app.test_client()
+
+    # Polling (after) a partir da primeira mensagem, repetindo enquanto has_more
+    seen = []
+    query = {'after': 1700000000, 'after_id': 'A0', 'limit': 3}
+    while True:
+        result = client.get('/api/mensagens/loja1/jid', query_string=query).get_json()
+        seen.extend(msg['id'] for msg in result['messages'])
+        query.update(after=result['newest'], after_id=result['newest_id'])
+        if not result['has_more']:
+            break
+    print(f"   Polling: {seen}")
+    assert seen == [message_id for message_id, _ in messages[1:]]
+
+    # Histórico (before) a partir da última mensagem
+    seen = []
+    query = {'before': 1700000200, 'before_id': 'C0', 'limit': 3}
+    while True:
+        result = client.get('/api/mensagens/loja1/jid', query_string=query).get_json()
+        seen = [msg['id'] for msg in result['messages']] + seen
+        query.update(before=result['oldest'], before_id=result['oldest_id'])
+        if not result['has_more']:
+            break
+    print(f"   Histórico: {seen}")
+    assert seen == [message_id for message_id, _ in messages[:-1]]
+    print("   ✅ O id desempata o mesmo segundo sem travar a paginação")
+
+def test_cursor_sem_id_nao_entra_em_laco(chat_store, monkeypatch):
+    """Clientes antigos (só timestamp) recebem has_more falso numa página inteira do mesmo segundo"""
+    insert_messages(chat_store, [(f"B{k}", 1700000100) for k in range(5)])
+    app.inbound_state['last_stored_at']['loja1'] = time.time()
+    monkeypatch.setattr(app, 'logado', True)
+
+    result = app.app.test_client().get('/api/mensagens/loja1/jid?after=1700000100&limit=3').get_json()
+    assert [msg['id'] for msg in result['messages']] == ['B0', 'B1', 'B2']
+    assert result['has_more'] is False
+
+def test_instancia_nova_registra_webhook_do_app(monkeypatch):
+    monkeypatch.setattr(app, 'INBOUND_WEBHOOK_TOKEN', 'a b&c')
+    monkeypatch.setattr(app, 'INBOUND_WEBHOOK_URL', 'https://painel.exemplo.com/webhook/evolution')
+    assert app.instance_webhook_url() == 'https://painel.exemplo.com/webhook/evolution?token=a+b%26c'
+
+    # Sem a URL pública do app, continua o webhook do n8n
+    monkeypatch.setattr(app, 'INBOUND_WEBHOOK_URL', '')
+    assert app.instance_webhook_url() == app.N8N_MESSAGES_WEBHOOK_URL
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-s']))
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Script de teste do disparo direto pela Evolution API
+Sobe um servidor falso da Evolution localmente e verifica limite de envio, retentativas e contadores
+"""
+
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+os.environ.setdefault('SCHEDULER_ENABLED', 'False')
+
+import app
+
+class FakeClock:
+    """Relógio simulado para o token bucket: `sleep` avança o tempo na hora, sem esperar de verdade
+    
+    Threads que dormem ao mesmo tempo não somam as esperas: o relógio vai até o maior despertar.
+    Toda espera avança ao menos 1ns para o arredondamento do float não travar o bucket em 0.999...
+    """
+    
+    def __init__(self):
+        self.now = 0.0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+    
+    def time(self):
+        with self.lock:
+            self.local.read_at = self.now
+            return self.now
+    
+    def sleep(self, seconds):
+        with self.lock:
+            self.now = max(self.now, getattr(self.local, 'read_at', self.now) + max(seconds, 1e-9))
+
+class FakeEvolutionHandler(BaseHTTPRequestHandler):
+    """Simula os endpoints de envio: número terminado em 13 falha sempre, terminado em 07 falha uma vez"""
+    requests_received = []
+    lock = threading.Lock()
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.lock:
+            attempts = sum(1 for _, item in self.requests_received if item['number'] == body['number'])
+            self.requests_received.append((self.path, body))
+        
+        if body['number'].endswith('13'):
+            status = 400
+        elif body['number'].endswith('07') and attempts == 0:
+            status = 503
+        else:
+            status = 201
+        
+        data = json.dumps({'key': {'id': body['number']}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def test_disparo_evolution(monkeypatch):
+    print("🧪 TESTE DO DISPARO DIRETO PELA EVOLUTION API")
+    print("=" * 50)
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeEvolutionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    # 600 mensagens/min (10 por segundo) com rajada de 5 e sem intervalo aleatório
+    clock = FakeClock()
+    monkeypatch.setattr(app.evolution_client, 'base_url', f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(app, 'SEND_JITTER_SECONDS', 0)
+    monkeypatch.setitem(app.send_buckets, 'teste', app.TokenBucket(600, 5, clock=clock.time, sleep=clock.sleep))
+    monkeypatch.setattr(FakeEvolutionHandler, 'requests_received', [])
+    
+    payload = {'instancia': 'teste', 'haImg': False, 'base64': None, 'image_url': None, 'haVideo': False, 'video_url': None}
+    leads = [
+        {'telefone': f"55119999900{i:02d}", 'remoteJid': f"55119999900{i:02d}@s.whatsapp.net", 'mensagem': f"Olá {i}"}
+        for i in range(30)
+    ]
+    progress = []
+    
+    try:
+        summary = app.send_campaign_via_evolution(payload, leads, on_progress=lambda item: progress.append(item['sent']))
+    finally:
+        server.shutdown()
+    
+    print(f"   Enviadas: {summary['sent']} | Falhas: {summary['failed']} | Tempo simulado: {clock.now:.1f}s")
+    assert summary['leads_total'] == 30
+    assert summary['sent'] == 29
+    assert summary['failed'] == 1
+    assert summary['failed_leads'][0]['telefone'].endswith('13')
+    assert len(progress) == 30
+    
+    # 31 chamadas (uma retentativa) a 10/s com rajada de 5: as 26 fichas além da rajada levam 2.6s
+    assert len(FakeEvolutionHandler.requests_received) == 31
+    assert all(path == '/message/sendText/teste' for path, _ in FakeEvolutionHandler.requests_received)
+    assert clock.now == pytest.approx(2.6)
+    print("   ✅ Limite de envio, retentativa e contadores OK")
+    
+    print("\n" + "=" * 50)
+    print("🏁 TESTE CONCLUÍDO")
+
+def test_disparo_varias_instancias(monkeypatch):
+    print("🧪 TESTE DO DISPARO DIVIDIDO ENTRE INSTÂNCIAS")
+    print("=" * 50)
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeEvolutionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    # Um bucket de 10/s com rajada de 5 por instância, todos no mesmo relógio simulado
+    clock = FakeClock()
+    monkeypatch.setattr(app.evolution_client, 'base_url', f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(app, 'SEND_JITTER_SECONDS', 0)
+    for name in ('loja1', 'loja2', 'loja3'):
+        monkeypatch.setitem(app.send_buckets, name, app.TokenBucket(600, 5, clock=clock.time, sleep=clock.sleep))
+    monkeypatch.setattr(FakeEvolutionHandler, 'requests_received', [])
+    
+    # loja3 desconectada: não deve receber nenhum lead
+    statuses = {'loja1': 'open', 'loja2': 'open', 'loja3': 'close'}
+    balancer = app.InstanceBalancer(list(statuses), status_getter=statuses.get)
+    payload = {'instancia': 'loja1', 'haImg': False, 'base64': None, 'image_url': None, 'haVideo': False, 'video_url': None}
+    leads = [
+        {'telefone': f"5521999990{i:02d}1", 'remoteJid': f"5521999990{i:02d}1@s.whatsapp.net", 'mensagem': f"Olá {i}"}
+        for i in range(40)
+    ]
+    
+    try:
+        summary = app.send_campaign_via_evolution(payload, leads, balancer=balancer)
+    finally:
+        server.shutdown()
+    
+    paths = [path for path, _ in FakeEvolutionHandler.requests_received]
+    print(f"   Enviadas: {summary['sent']} | Tempo simulado: {clock.now:.1f}s | Por instância: {summary['instances']}")
+    assert summary['sent'] == len(leads)
+    assert paths.count('/message/sendText/loja1') == paths.count('/message/sendText/loja2') == len(leads) // 2
+    assert '/message/sendText/loja3' not in paths
+    
+    # Duas instâncias a 10/s cada: 20 leads por bucket levam 1.5s, contra 3.5s com uma só
+    assert clock.now == pytest.approx(1.5, abs=0.3)
+    print("   ✅ Divisão entre instâncias conectadas OK")
+    
+    print("\n" + "=" * 50)
+    print("🏁 TESTE CONCLUÍDO")
+
+def test_balancer_primeira_consulta(monkeypatch):
+    """Enquanto a primeira consulta de status não termina, ninguém escolhe instância desconectada"""
+    monkeypatch.setattr(app, 'SHARD_STATUS_INTERVAL', 60)
+    started = threading.Event()
+    
+    def slow_status(name):
+        started.set()
+        threading.Event().wait(0.3)
+        return {'loja1': 'open', 'loja2': 'close'}[name]
+    
+    balancer = app.InstanceBalancer(['loja1', 'loja2'], status_getter=slow_status)
+    chosen = []
+    threads = [threading.Thread(target=lambda: chosen.append(balancer.choose())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+        started.wait()
+    for thread in threads:
+        thread.join()
+    
+    assert chosen == ['loja1'] * 8
+
+def test_balancer_webhook_registra_resultados(monkeypatch):
+    """No backend webhook, lotes com falha também reduzem o peso da instância"""
+    monkeypatch.setattr(app, 'WEBHOOK_CHUNK_SIZE', 1)
+    monkeypatch.setattr(app, 'post_webhook_chunk', lambda payload, correlation_id: (
+        (payload['instancia'] == 'loja1', None if payload['instancia'] == 'loja1' else 'HTTP 500')
+    ))
+    balancer = app.InstanceBalancer(['loja1', 'loja2'], status_getter=lambda name: 'open')
+    base_payload = {'instancia': 'loja1', 'link_planilha': ''}
+    leads = [{'telefone': str(i)} for i in range(10)]
+    
+    summary = app.dispatch_campaign(base_payload, leads, balancer=balancer)
+    
+    assert summary['chunks_total'] == 10
+    assert list(balancer.results['loja1']) and all(balancer.results['loja1'])
+    assert list(balancer.results['loja2']) and not any(balancer.results['loja2'])
+    assert summary['instances']['loja2']['weight'] < summary['instances']['loja1']['weight']
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-s']))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Testes da normalização dos telefones dos leads (coluna Acesso)
+Formatos aceitos, floats do Excel, descarte de inválidos e duplicados e tempo para 500 mil linhas
+"""
+
+import random
+import time
+
+import pytest
+
+import app
+
+@pytest.mark.parametrize('value, expected', [
+    ('11999999999', 5511999999999),
+    ('(11) 99999-9999', 5511999999999),
+    ('+55 (11) 99999-9999', 5511999999999),
+    ('5511999999999', 5511999999999),
+    ('1133334444', 551133334444),
+    ('011 99999-9999', 5511999999999),
+    ('00011999999999', 5511999999999),
+    # Floats do Excel: parte decimal só de zeros é descartada
+    ('11999999999.0', 5511999999999),
+    ('11999999999.00', 5511999999999),
+    ('5511999999999.000', 5511999999999),
+    (11999999999.0, 5511999999999),
+    (11999999999, 5511999999999),
+    ('11999999999.', 5511999999999),
+    # Pontos como separador (mais de um ponto) não são float
+    ('11.99999.9999', 5511999999999),
+    # Parte decimal com dígitos significativos invalida o número em vez de virar dígitos extras
+    ('119999.99990', 0),
+    ('11999999999.5', 0),
+    ('5511999999999.0001', 0),
+    ('.11999999999', 0),
+    ('', 0),
+    (None, 0),
+    ('ção', 0),
+    ('0000', 0),
+    ('0.0', 0),
+    ('99999', 0),
+    ('12345678901234', 0),
+    ('4411999999999', 0),
+    ('99999999999999999999999999', 0),
+])
+def test_normalize_phone_numbers(value, expected):
+    assert app.normalize_phone_numbers([value]).tolist() == [expected]
+
+def test_normalize_phone_numbers_vazio_e_quebras_de_linha():
+    assert app.normalize_phone_numbers([]).tolist() == []
+    # Quebra de linha dentro do valor não desalinha as linhas seguintes
+    phones = app.normalize_phone_numbers(['11 99999-\n9999', '21988887777', 'x'])
+    assert phones.tolist() == [5511999999999, 5521988887777, 0]
+
+def test_normalize_leads_descarta_invalidos_e_duplicados(monkeypatch):
+    print("🧪 TESTE DE NORMALIZAÇÃO DOS LEADS")
+    print("=" * 50)
+
+    # Blocos de dois: Caio repete Ana no mesmo bloco, Eva repete Davi do bloco anterior
+    monkeypatch.setattr(app, 'PHONE_NORMALIZE_BLOCK', 2)
+    leads = [
+        {'nome': 'Ana', 'telefone': '(11) 99999-9999'},
+        {'nome': 'Caio', 'telefone': '11999999999.0'},
+        {'nome': 'Bia', 'telefone': '119999.99990'},
+        {'nome': 'Davi', 'telefone': '21988887777'},
+        {'nome': 'Eva', 'telefone': '021 98888-7777'},
+        {'nome': 'Fabi', 'telefone': '31977776666.0'},
+    ]
+    stats = {}
+
+    normalized = list(app.normalize_leads(leads, stats))
+
+    print(f"   Aceitos: {[lead['nome'] for lead in normalized]} | {stats}")
+    assert [(lead['nome'], lead['telefone'], lead['remoteJid']) for lead in normalized] == [
+        ('Ana', '5511999999999', '5511999999999@s.whatsapp.net'),
+        ('Davi', '5521988887777', '5521988887777@s.whatsapp.net'),
+        ('Fabi', '5531977776666', '5531977776666@s.whatsapp.net'),
+    ]
+    assert stats == {'leads_invalid': 1, 'leads_duplicated': 2}
+    print("   ✅ Inválidos e duplicados descartados")
+
+def test_normalize_leads_500_mil_linhas():
+    random.seed(14)
+    formats = [
+        lambda number: number,
+        lambda number: number + '.0',
+        lambda number: f"({number[:2]}) {number[2:7]}-{number[7:]}",
+        lambda number: '+55 ' + number,
+        lambda number: '0' + number,
+        lambda number: number[:5],
+    ]
+    values = [
+        random.choice(formats)(f"{random.randint(11, 99)}9{random.randint(0, 99999999):08d}")
+        for _ in range(500000)
+    ]
+
+    # Melhor de três execuções: a etapa inteira (normalização, descarte e leads atualizados)
+    timings = []
+    for _ in range(3):
+        leads = [{'nome': 'Lead', 'telefone': value} for value in values]
+        started = time.perf_counter()
+        normalized = list(app.normalize_leads(leads, {}))
+        timings.append(time.perf_counter() - started)
+
+    print(f"   ⏱️ 500 mil linhas: {min(timings):.3f}s ({len(normalized)} aceitos)")
+    assert normalized
+    assert min(timings) < 1.0
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-s']))
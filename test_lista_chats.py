@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Testes da lista de chats vinda da Evolution (sem as tabelas locais)
+Página remota com take/skip (cursor "o:<offset>"), cursor updatedAt|remoteJid com empates e busca por nome ou número
+"""
+
+import pytest
+
+import app
+
+CHATS = [
+    {'remoteJid': f"55119999900{k:02d}@s.whatsapp.net", 'pushName': f"Contato {k}", 'updatedAt': f"2026-10-0{1 + k // 4}T10:00:00.000Z"}
+    for k in range(10)
+] + [
+    {'remoteJid': '5521988887777@s.whatsapp.net', 'pushName': 'Ana Paula', 'updatedAt': '2026-10-05T09:00:00.000Z'},
+    {'remoteJid': '120363000000000000@g.us', 'pushName': 'Grupo', 'updatedAt': '2026-10-09T09:00:00.000Z'},
+]
+
+class FakeResponse:
+    status_code = 200
+    text = ''
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+@pytest.fixture
+def evolution_chats(monkeypatch):
+    """Evolution falsa com os CHATS; `calls` registra (endpoint, take, skip)"""
+    state = {'ignore_take': False, 'calls': []}
+    ordered = sorted(CHATS, key=lambda chat: chat['updatedAt'], reverse=True)
+
+    def post(path, json=None, **kwargs):
+        json = json or {}
+        state['calls'].append((path.split('/')[2], json.get('take'), json.get('skip')))
+        if 'take' in json and not state['ignore_take']:
+            return FakeResponse(ordered[json['skip']:json['skip'] + json['take']])
+        return FakeResponse(ordered)
+
+    monkeypatch.setattr(app.evolution_client, 'post', post)
+    monkeypatch.setattr(app, 'local_chats_ready', lambda instance_name: False)
+    monkeypatch.setattr(app, 'chat_cache', app.LRUCache(10 * 1024 * 1024, 1000, 60))
+    return state
+
+def read_all_pages(search=None, limit=3):
+    seen, cursor, cursors = [], None, []
+    while True:
+        page, cursor, total = app.get_instance_chats('loja1', cursor, search, limit)
+        seen.extend(chat['remoteJid'] for chat in page)
+        if not cursor:
+            return seen, cursors, total
+        cursors.append(cursor)
+
+def test_paginacao_remota_por_offset(evolution_chats):
+    print("🧪 TESTE DE PÁGINAS DO findChats")
+    print("=" * 50)
+
+    seen, cursors, total = read_all_pages()
+
+    print(f"   Cursores: {cursors} | chamadas: {evolution_chats['calls']}")
+    # O grupo some da página, mas o offset segue o findChats (sem pular nem repetir contatos)
+    assert seen == [chat['remoteJid'] for chat in app.parse_evolution_chats(CHATS)]
+    assert cursors == ['o:3', 'o:6', 'o:9']
+    assert total is None
+    # Cada página pede só take=limit+1 registros, nunca a lista completa
+    assert evolution_chats['calls'] == [('findChats', 4, 0), ('findChats', 4, 3), ('findChats', 4, 6), ('findChats', 4, 9)]
+
+    # Página repetida dentro do TTL vem do cache
+    app.get_instance_chats('loja1', 'o:3', None, 3)
+    assert len(evolution_chats['calls']) == 4
+    print("   ✅ Só a página pedida é buscada na Evolution")
+
+def test_evolution_que_ignora_take_usa_lista_completa(evolution_chats):
+    evolution_chats['ignore_take'] = True
+
+    seen, cursors, total = read_all_pages()
+
+    assert seen == [chat['remoteJid'] for chat in app.parse_evolution_chats(CHATS)]
+    assert total == 11
+    # A partir da segunda página o cursor é a posição updatedAt|remoteJid, com a lista completa em cache
+    assert cursors[0] == '2026-10-03T10:00:00.000Z|5511999990009@s.whatsapp.net'
+    assert [name for name, _, _ in evolution_chats['calls']].count('findContacts') == 1
+
+def test_cursor_com_empates_de_updated_at():
+    print("🧪 TESTE DE CURSOR COM EMPATES")
+    print("=" * 50)
+
+    contacts = app.parse_evolution_chats(CHATS)
+    seen, cursor = [], None
+    for _ in range(len(contacts)):
+        page, cursor, total = app.paginate_chats(contacts, cursor, limit=3)
+        seen.extend(chat['remoteJid'] for chat in page)
+        if not cursor:
+            break
+
+    # Quatro chats por horário: o remoteJid desempata sem repetir nem pular
+    assert seen == [chat['remoteJid'] for chat in contacts]
+    assert len(set(seen)) == total == 11
+    # Cursor de offset (paginação remota que falhou no meio da rolagem) continua da mesma posição
+    page, cursor, _ = app.paginate_chats(contacts, 'o:9', limit=3)
+    assert ([chat['remoteJid'] for chat in page], cursor) == ([chat['remoteJid'] for chat in contacts[9:]], None)
+    print("   ✅ Empates resolvidos pelo remoteJid")
+
+def test_busca_por_nome_ou_numero(evolution_chats):
+    page, cursor, total = app.get_instance_chats('loja1', search='ana')
+    assert ([chat['name'] for chat in page], cursor, total) == (['Ana Paula'], None, 1)
+
+    # Dígitos com máscara casam com o número do jid
+    page, cursor, total = app.get_instance_chats('loja1', search='(21) 98888', limit=3)
+    assert [chat['remoteJid'] for chat in page] == ['5521988887777@s.whatsapp.net']
+
+    seen, _, total = read_all_pages(search='contato')
+    assert total == 10
+    assert seen == [chat['remoteJid'] for chat in app.parse_evolution_chats(CHATS) if chat['pushName'].startswith('Contato')]
+    # A busca filtra a lista completa, buscada uma única vez
+    assert [name for name, _, _ in evolution_chats['calls']] == ['findContacts']
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-s']))
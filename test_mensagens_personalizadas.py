@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Testes das mensagens personalizadas (@variáveis) renderizadas no servidor
+Substituição das variáveis, escolha determinística da variação e pré-visualização da planilha
+"""
+
+import io
+
+import pytest
+from openpyxl import Workbook
+
+import app
+
+LEAD = {
+    'filial': 'Centro',
+    'data': '10/10/2026',
+    'nome': 'Ana',
+    'plano': 'Fibra 500',
+    'telefone': '5511999999999',
+    'complemento': ''
+}
+
+def test_template_substitui_variaveis():
+    template = app.MessageTemplate('Olá @nome! Seu plano @plano (@filial) vence em @data.@complemento')
+    assert template.variables == ['complemento', 'data', 'filial', 'nome', 'plano']
+    assert template.render(LEAD) == 'Olá Ana! Seu plano Fibra 500 (Centro) vence em 10/10/2026.'
+
+def test_template_mantem_texto_sem_variavel():
+    # Só as colunas conhecidas são variáveis: e-mails e @desconhecida ficam como estão
+    template = app.MessageTemplate('@nome, fale com contato@loja.com ou @desconhecida')
+    assert template.variables == ['nome']
+    assert template.render(LEAD) == 'Ana, fale com contato@loja.com ou @desconhecida'
+    assert app.MessageTemplate('Sem variáveis').render(LEAD) == 'Sem variáveis'
+
+def test_variacao_deterministica():
+    print("🧪 TESTE DE VARIAÇÕES DE MENSAGEM")
+    print("=" * 50)
+
+    templates = app.compile_message_templates('Oi @nome', '', 'Olá @nome', 'E aí @nome')
+    assert len(templates) == 3
+
+    leads = [dict(LEAD, telefone=f"55119999{k:05d}") for k in range(300)]
+    first = list(app.render_campaign_messages(templates, leads))
+    # Mesma ordem ou outra ordem (retentativa, reagendamento): cada lead recebe sempre a mesma variação
+    again = {lead['telefone']: lead['variante'] for lead in app.render_campaign_messages(templates, reversed(leads))}
+    assert all(again[lead['telefone']] == lead['variante'] for lead in first)
+
+    counts = {variant: sum(lead['variante'] == variant for lead in first) for variant in (1, 2, 3)}
+    print(f"   Distribuição: {counts}")
+    assert all(count > 50 for count in counts.values())
+    assert all(lead['mensagem'] == templates[lead['variante'] - 1].render(lead) for lead in first)
+    # O lead original não é alterado
+    assert 'mensagem' not in leads[0]
+    print("   ✅ Variação estável por telefone")
+
+def test_preview_da_planilha(monkeypatch):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(['Filial', 'Data', 'Nome Cliente', 'Plano', 'Acesso', 'Complemento'])
+    sheet.append(['Centro', '10/10/2026', 'Ana', 'Fibra', 11999999999, None])
+    sheet.append(['Centro', '10/10/2026', 'Ana de novo', 'Fibra', '(11) 99999-9999', None])
+    sheet.append(['Norte', '11/10/2026', 'Bia', 'Móvel', 'sem número', None])
+    sheet.append(['Sul', '12/10/2026', 'Caio', 'TV', '21988887777', None])
+    excel = io.BytesIO()
+    workbook.save(excel)
+    excel.seek(0)
+    monkeypatch.setattr(app, 'logado', True)
+
+    response = app.app.test_client().post(
+        '/api/preview-mensagens',
+        data={'message': 'Oi @nome, plano @plano', 'excel_file': (excel, 'leads.xlsx')},
+        content_type='multipart/form-data'
+    )
+
+    result = response.get_json()
+    assert result['status'] == 'success'
+    assert (result['variantes'], result['variaveis']) == (1, ['nome', 'plano'])
+    # Duplicado e inválido não entram na pré-visualização
+    assert [(lead['telefone'], lead['mensagem']) for lead in result['mensagens']] == [
+        ('5511999999999', 'Oi Ana, plano Fibra'),
+        ('5521988887777', 'Oi Caio, plano TV'),
+    ]
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-s']))
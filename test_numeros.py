@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Testes da listagem de números (/numeros) com status das instâncias
+Consultas em paralelo com prazo total: instâncias lentas aparecem sem status e não prendem os workers
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+
+def test_status_com_prazo_nao_prende_workers(fake_db, monkeypatch):
+    print("🧪 TESTE DE STATUS COM PRAZO")
+    print("=" * 50)
+
+    fake_db.execute("CREATE TABLE numeros (id INTEGER PRIMARY KEY, numero TEXT, instancia TEXT)")
+    for k in range(4):
+        fake_db.execute("INSERT INTO numeros (numero, instancia) VALUES (?, ?)", (f"55119999900{k:02d}", f"loja{k}"))
+
+    calls = []
+    lock = threading.Lock()
+
+    def slow_status(instance_name, timeout=None):
+        # Evolution que não responde: a consulta dura o timeout recebido e cai em 'close', como no requests
+        with lock:
+            calls.append((instance_name, timeout))
+        time.sleep(min(timeout or 10, 10))
+        return 'close'
+
+    # Um único worker: só a primeira instância chega a ser consultada dentro do prazo
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(app, 'status_executor', executor)
+    monkeypatch.setattr(app, 'STATUS_CHECK_DEADLINE', 0.3)
+    monkeypatch.setitem(app.instance_monitor_state, 'running', False)
+    monkeypatch.setattr(app, 'get_instance_status', slow_status)
+
+    started = time.time()
+    numbers = app.get_whatsapp_numbers()
+    elapsed = time.time() - started
+    executor.shutdown(wait=True)
+    released = time.time() - started
+
+    print(f"   Página em {elapsed:.2f}s, worker livre em {released:.2f}s, consultas: {calls}")
+    assert elapsed < 1
+    # A primeira termina junto com o prazo (desconhecida ou desconectada); as demais ficam desconhecidas
+    assert numbers[0]['status'] in ('Desconhecido', 'Desconectado')
+    assert [number['status'] for number in numbers[1:]] == ['Desconhecido'] * 3
+    # A consulta em andamento recebeu só o tempo restante do prazo e as demais nem começaram
+    assert [name for name, _ in calls] == ['loja0']
+    assert calls[0][1] <= 0.3
+    assert released < 1
+    print("   ✅ Prazo respeitado sem prender o pool")
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-s']))
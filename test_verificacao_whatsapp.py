@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Testes da verificação prévia de WhatsApp dos leads (/chat/whatsappNumbers)
+Descarte dos números sem WhatsApp, jid devolvido pela Evolution, lotes com erro e cache no banco
+"""
+
+import datetime
+
+import pytest
+
+import app
+
+@pytest.fixture
+def checks_store(fake_db, monkeypatch):
+    """Tabela de cache no sqlite e Evolution falsa que registra os lotes consultados"""
+    fake_db.execute("""
+        CREATE TABLE whatsapp_checks (
+            numero TEXT PRIMARY KEY,
+            existe BOOLEAN NOT NULL,
+            jid TEXT NULL,
+            checked_at DATETIME NOT NULL
+        )
+    """)
+    monkeypatch.setitem(app.whatsapp_checks_state, 'table_ready', True)
+    monkeypatch.setattr(app, 'WHATSAPP_CHECK_BATCH_SIZE', 3)
+    return fake_db
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+def fake_evolution(monkeypatch, answers):
+    """Responde cada número conforme `answers`; lotes com número ausente de `answers` recebem um objeto de erro"""
+    batches = []
+
+    def post(path, json=None, **kwargs):
+        assert path == '/chat/whatsappNumbers/loja1'
+        batches.append(json['numbers'])
+        if any(numero not in answers for numero in json['numbers']):
+            return FakeResponse({'status': 500, 'error': 'Internal Server Error'})
+        return FakeResponse([answers[numero] for numero in json['numbers']])
+
+    monkeypatch.setattr(app.evolution_client, 'post', post)
+    return batches
+
+def make_leads(*numbers):
+    return [{'telefone': numero, 'remoteJid': numero + '@s.whatsapp.net'} for numero in numbers]
+
+def test_precheck_descarta_sem_whatsapp_e_usa_cache(checks_store, monkeypatch):
+    print("🧪 TESTE DE VERIFICAÇÃO PRÉVIA")
+    print("=" * 50)
+
+    answers = {
+        '5511999990001': {'exists': True, 'jid': '5511999990001@s.whatsapp.net', 'number': '5511999990001'},
+        # Número antigo sem o 9º dígito: a Evolution devolve o jid real
+        '5511999990002': {'exists': True, 'jid': '551199990002@s.whatsapp.net', 'number': '5511999990002'},
+        '5511999990003': {'exists': False, 'jid': '5511999990003@s.whatsapp.net', 'number': '5511999990003'},
+    }
+    batches = fake_evolution(monkeypatch, answers)
+    # O quarto número cai num lote cuja resposta não é uma lista
+    leads = make_leads('5511999990001', '5511999990002', '5511999990003', '5511999990004')
+    stats = {}
+
+    kept = list(app.precheck_leads(leads, 'loja1', stats))
+
+    print(f"   Lotes: {batches} | {stats}")
+    assert [(lead['telefone'], lead['remoteJid']) for lead in kept] == [
+        ('5511999990001', '5511999990001@s.whatsapp.net'),
+        ('5511999990002', '551199990002@s.whatsapp.net'),
+        ('5511999990004', '5511999990004@s.whatsapp.net'),
+    ]
+    assert stats == {'leads_not_on_whatsapp': 1, 'leads_unchecked': 1}
+    assert sorted(batches) == [['5511999990001', '5511999990002', '5511999990003'], ['5511999990004']]
+
+    # Segunda campanha: os verificados vêm do cache e só o número sem resposta volta à Evolution
+    batches.clear()
+    stats = {}
+    kept = list(app.precheck_leads(make_leads('5511999990001', '5511999990002', '5511999990003', '5511999990004'), 'loja1', stats))
+    assert batches == [['5511999990004']]
+    assert [lead['remoteJid'] for lead in kept][:2] == ['5511999990001@s.whatsapp.net', '551199990002@s.whatsapp.net']
+    assert stats == {'leads_not_on_whatsapp': 1, 'leads_unchecked': 1}
+    print("   ✅ Sem WhatsApp descartados, jid real usado e cache reaproveitado")
+
+def test_cache_expirado_e_renovado(checks_store, monkeypatch):
+    numero = '5511999990001'
+    batches = fake_evolution(monkeypatch, {numero: {'exists': False, 'number': numero}})
+    expired = datetime.datetime.utcnow() - app.WHATSAPP_CHECK_TTL - datetime.timedelta(days=1)
+    checks_store.execute("INSERT INTO whatsapp_checks VALUES (?, 1, ?, ?)", (numero, numero + '@s.whatsapp.net', expired))
+
+    # Fora do TTL o cache é ignorado e a nova resposta substitui a linha antiga
+    assert app.check_whatsapp_numbers('loja1', [numero]) == {numero: (False, None)}
+    assert batches == [[numero]]
+    rows = checks_store.execute("SELECT existe, jid, checked_at > ? FROM whatsapp_checks", (expired,))
+    assert rows == [(0, None, 1)]
+    assert app.check_whatsapp_numbers('loja1', [numero]) == {numero: (False, None)}
+    assert len(batches) == 1
+
+def test_lote_com_resposta_inesperada(monkeypatch):
+    monkeypatch.setattr(app.evolution_client, 'post', lambda path, json=None, **kwargs: FakeResponse({'error': 'instance not connected'}))
+    with pytest.raises(ValueError):
+        app.fetch_whatsapp_numbers_batch('loja1', ['5511999990001'])
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-s']))